@@ -1,28 +1,141 @@
 import os
+import shutil
 import subprocess
 import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 # Define paths
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 SCRAPY_PATH = os.path.join(PROJECT_ROOT, "scrapy", "src")
 TRANSFORMATION_PATH = os.path.join(SCRAPY_PATH, "transformation")
+TRAINING_PATH = os.path.join(SCRAPY_PATH, "training")
+UPLOAD_PATH = os.path.join(SCRAPY_PATH, "upload_to_db")
+SHARDS_PATH = os.path.join(PROJECT_ROOT, "data", "raw", "shards") # JOBDIR of each shard, removed once every shard finished
+SHARD_METRICS_PATH = os.path.join(PROJECT_ROOT, "data", "raw", "metrics") # Crawl metrics of each shard (Prometheus textfiles), kept after the crawl
 
-def run_scrapy_spider():
+# Stages in the order they run
+STAGES = ["crawl", "clean", "transform", "dedup", "aggregate", "train", "upload"]
+
+def run_scrapy_spider(shards=1, workers=None):
+    if shards > 1:
+        return run_sharded_crawl(shards, workers)
     print("📥 Starting Scrapy spider...")
+    subprocess.run(["scrapy", "crawl", "scrape_car_listing"], cwd=SCRAPY_PATH, check=True) # Writes a raw segment, see FEEDS in settings.py
+
+# Crawl one shard of the manufacturer/model pairs into its own raw segment, registered in the manifest when the shard closes
+# Its request queue and spider state are persisted in a JOBDIR, so an interrupted shard resumes where it stopped
+def run_crawl_shard(shard, shards):
+    shard_name = f"shard-{shard}-of-{shards}"
+    shard_path = os.path.join(SHARDS_PATH, shard_name)
     subprocess.run([
         "scrapy", "crawl", "scrape_car_listing",
-        "-o", os.path.join(PROJECT_ROOT, "data", "raw", "car_listing.jsonl")
+        "-a", f"shard={shard}/{shards}",
+        "-a", f"feed_name=car_listing-{shard_name}",
+        "-s", f"JOBDIR={shard_path}",
+        "-s", f"TELEMETRY_FILE={os.path.join(SHARD_METRICS_PATH, shard_name)}.prom"
     ], cwd=SCRAPY_PATH, check=True)
 
-def run_script(script_filename):
-    print(f"▶️ Running script: {script_filename}")
-    subprocess.run([sys.executable, os.path.join(TRANSFORMATION_PATH, script_filename)], check=True)
+# Run the shards in parallel processes, failed shards keep their JOBDIR and resume on the next run
+# Each shard's segments are registered in the raw manifest, which is what clean_data() reads as one feed
+def run_sharded_crawl(shards, workers=None):
+    print(f"📥 Starting Scrapy spider in {shards} shards...")
+    os.makedirs(SHARDS_PATH, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers or min(shards, os.cpu_count() or 1)) as executor:
+        futures = {shard: executor.submit(run_crawl_shard, shard, shards) for shard in range(shards)}
+    failed_shards = [shard for shard, future in futures.items() if future.exception()]
+    if failed_shards:
+        raise RuntimeError(f"Crawl shards {failed_shards} failed, run the crawl again with --shards {shards} to resume them")
+    shutil.rmtree(SHARDS_PATH)
+
+# Reset the peak resident memory of the process, so that it is measured per stage (Linux only)
+def reset_peak_memory():
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+# Peak resident memory of the process in MB, since the last reset on Linux and since the start elsewhere
+def get_peak_memory_mb():
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1024 ** 2 if sys.platform == "darwin" else max_rss / 1024 # Bytes on macOS, KB elsewhere
+
+# Run one stage, reporting its wall time and peak memory
+def run_stage(stage, function, *args, **kwargs):
+    print(f"▶️ Running stage: {stage}")
+    reset_peak_memory()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    peak_memory_mb = get_peak_memory_mb()
+    print(f"⏱️ {stage}: {elapsed:.1f}s" + (f", peak memory {peak_memory_mb:.0f} MB" if peak_memory_mb else ""))
+    return result
+
+# Run the stages from first_stage to last_stage in this process
+# With in_memory=True, each stage hands its DataFrame to the next one and intermediates are only saved if persist=True
+def run_pipeline(first_stage="clean", last_stage="aggregate", in_memory=False, persist=False, full=False, export_csv=False, shards=1, workers=None):
+    stages = STAGES[STAGES.index(first_stage):STAGES.index(last_stage) + 1]
+    os.chdir(PROJECT_ROOT) # Stages use paths relative to the project root
+    sys.path[:0] = [TRANSFORMATION_PATH, TRAINING_PATH, UPLOAD_PATH]
+
+    df = None
+    for stage in stages:
+        save_output = not in_memory or persist or stage == last_stage
+        if stage == "crawl":
+            run_stage(stage, run_scrapy_spider, shards, workers)
+        elif stage == "clean":
+            from clean_car_listing import clean_data
+            df = run_stage(stage, clean_data, incremental=not full, export_csv=export_csv, in_memory=in_memory, persist=save_output)
+        elif stage == "transform":
+            from transform_car_listing import transform_data
+            df = run_stage(stage, transform_data, df, incremental=not full, export_csv=export_csv, persist=save_output)
+        elif stage == "dedup":
+            from dedup_car_listing import dedup_data
+            df = run_stage(stage, dedup_data, df, in_memory=in_memory, export_csv=export_csv, persist=save_output)
+        elif stage == "aggregate":
+            from aggregate_car_listing import aggregate_data
+            # Aggregates the rows not aggregated yet (in memory, df is the whole transformed data and they are rebuilt from it), df is passed on unchanged
+            run_stage(stage, aggregate_data, df, full=full or in_memory, export_csv=export_csv)
+        elif stage == "train":
+            from train_car_listing import train_model # Imported here as scikit-learn is only needed to train
+            run_stage(stage, train_model, df if in_memory else None) # Trains on all the transformed data, df is passed on to the upload unchanged
+        elif stage == "upload":
+            from upload_car_listing import upload_data_to_db # Imported here as it connects to the database
+            run_stage(stage, upload_data_to_db, df)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the car listing pipeline.")
+    parser.add_argument("--from", dest="first_stage", choices=STAGES, default="clean", help="First stage to run")
+    parser.add_argument("--to", dest="last_stage", choices=STAGES, default="aggregate", help="Last stage to run")
+    parser.add_argument("--in-memory", action="store_true", help="Hand DataFrames between stages instead of reading the saved outputs (full run)")
+    parser.add_argument("--persist", action="store_true", help="With --in-memory, also save the outputs of intermediate stages")
+    parser.add_argument("--full", action="store_true", help="Process all raw data instead of the segments and lines added since the last run")
+    parser.add_argument("--csv", action="store_true", help="Also export the cleaned and transformed data and the market price aggregates as CSV")
+    parser.add_argument("--shards", type=int, default=1, help="Split the crawl by manufacturer/model into this many resumable shards")
+    parser.add_argument("--workers", type=int, help="Shards crawled in parallel (default: one per core)")
+    args = parser.parse_args()
+    if STAGES.index(args.first_stage) > STAGES.index(args.last_stage):
+        parser.error("--from must come before --to")
+    return args
 
 if __name__ == "__main__":
+    args = parse_args()
     try:
-        #run_scrapy_spider()
-        run_script("clean_car_listing.py")
-        run_script("transform_car_listing.py")
+        run_pipeline(args.first_stage, args.last_stage, args.in_memory, args.persist, args.full, args.csv, args.shards, args.workers)
         print("✅ Pipeline finished successfully.")
-    except subprocess.CalledProcessError as e:
+    except Exception as e:
         print(f"❌ Error: {e}")
+        sys.exit(1)
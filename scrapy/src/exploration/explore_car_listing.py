@@ -1,34 +1,29 @@
 import os
-import json
+import sys
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "transformation"))
+from clean_car_listing import EQUIPMENT_FEATURES, get_raw_file_size, load_raw_manifest, get_readable_segments, get_raw_sources, read_raw_data_in_chunks, build_sparse_equipment_frame
+
 def explore_data():
   # Define file paths
-  RAW_FILE_PATH = "data/raw/car_listing.jsonl"
-  TRANSFORMED_FILE_PATH = "data/transformed/transformed_car_listing.csv"
+  TRANSFORMED_FILE_PATH = "data/transformed/transformed_car_listing.parquet"
   OUTPUT_DIR = "data/exploration"
 
   # Ensure output directory exists
   os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-  # Load raw data
+  # Load raw data, from the raw segments of the manifest and the legacy raw file
   def load_data():
-    with open(RAW_FILE_PATH, "r", encoding="utf-8") as file:
-      data = []
-      for line in file:
-        try:
-          data.append(json.loads(line.strip()))
-        except json.JSONDecodeError as e:
-          print(f"Skipping malformed JSON line: {e}")
-
-    return pd.DataFrame(data)
+    raw_file_size = get_raw_file_size()
+    return pd.concat(read_raw_data_in_chunks(get_raw_sources(get_readable_segments(load_raw_manifest()), end=raw_file_size)), ignore_index=True)
   df_raw = load_data()
   df_raw.name = "raw"
 
-  df = pd.read_csv(TRANSFORMED_FILE_PATH)
+  df = pd.read_parquet(TRANSFORMED_FILE_PATH, memory_map=True)
   df.name = "transformed"
 
 
@@ -64,7 +59,7 @@ def explore_data():
   
   # Histograms for Numerical Features
   def plot_histograms(df):
-      num_cols = df.select_dtypes(include=["int64", "float64"]).columns
+      num_cols = df.select_dtypes(include="number").columns
       df[num_cols].hist(figsize=(12, 6), bins=10, edgecolor="black")
       plt.suptitle("Histograms of Numerical Features")
       plt.savefig(f"{OUTPUT_DIR}/histograms.png", dpi=300)
@@ -90,7 +85,7 @@ def explore_data():
 
   # Correlation Heatmap
   def plot_correlation_matrix(df):
-    numeric_df = df.select_dtypes(include=["int64", "float64"])
+    numeric_df = df.select_dtypes(include="number")
     plt.figure(figsize=(12, 6))
     sns.heatmap(numeric_df.corr(), annot=True, cmap="coolwarm", fmt=".2f", linewidths=0.5)
     plt.title("Correlation Heatmap")
@@ -130,6 +125,24 @@ def explore_data():
     plt.show()
   plot_boxplots(df)
 
+  # Equipment frequency over the whole equipment vocabulary, to review the selected EQUIPMENT_FEATURES
+  def plot_equipment_frequency(df):
+    equipment = build_sparse_equipment_frame(df["equipment"])
+    frequency = (equipment.apply(lambda column: column.sparse.npoints) / len(equipment) * 100).sort_values(ascending=False).rename("percentage_of_listings").to_frame()
+    frequency["selected"] = frequency.index.isin(EQUIPMENT_FEATURES)
+    frequency.to_csv(f"{OUTPUT_DIR}/equipment_frequency.csv")
+    print(f"{len(frequency)} equipment items, {equipment.sparse.density:.1%} of the listing/item pairs are set")
+    plt.figure(figsize=(12, 10))
+    top_frequency = frequency.head(50)
+    top_frequency["percentage_of_listings"].plot(kind="barh", color=top_frequency["selected"].map({True: "skyblue", False: "lightgrey"}), edgecolor="black")
+    plt.gca().invert_yaxis()
+    plt.xlabel("Percentage of Listings")
+    plt.title("Most Common Equipment (selected features in blue)")
+    plt.grid(axis="x")
+    plt.savefig(f"{OUTPUT_DIR}/equipment_frequency.png", dpi=300)
+    plt.show()
+  plot_equipment_frequency(df_raw)
+
   print(f"Exploratory Analysis Completed! Results saved in '{OUTPUT_DIR}'")
 
 # Run exploratory analysis
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import hashlib
+from datetime import datetime
+from collections import defaultdict
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+# Upper bounds of the response latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.25, 0.5, 1, 2, 5, 10, float("inf")]
+
+def format_labels(labels):
+  return ",".join(f'{name}="{value}"' for name, value in labels)
+
+# Per (manufacturer, model, callback) crawl counters
+class ModelMetrics:
+  def __init__(self):
+    self.requests = 0
+    self.retries = 0
+    self.responses_by_status = defaultdict(int)
+    self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+    self.latency_sum = 0.0
+    self.items = 0
+    self.parse_cpu_seconds = 0.0
+
+  def observe_latency(self, latency):
+    self.latency_sum += latency
+    for i, upper_bound in enumerate(LATENCY_BUCKETS):
+      if latency <= upper_bound:
+        self.latency_buckets[i] += 1
+
+# Records request counts, retries, response statuses and latencies, items and parse CPU time per manufacturer/model,
+# using the request meta set by the spider, and writes them as a Prometheus textfile every TELEMETRY_INTERVAL seconds and at close
+class CrawlTelemetry:
+  def __init__(self, crawler, file_path, interval):
+    self.crawler = crawler
+    self.file_path = file_path
+    self.interval = interval
+    self.metrics = defaultdict(ModelMetrics)
+    self.task = None
+
+  @classmethod
+  def from_crawler(cls, crawler):
+    file_path = crawler.settings.get("TELEMETRY_FILE")
+    if not file_path:
+      raise NotConfigured
+    extension = cls(crawler, file_path, crawler.settings.getfloat("TELEMETRY_INTERVAL", 60))
+    crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+    crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+    crawler.signals.connect(extension.request_scheduled, signal=signals.request_scheduled)
+    crawler.signals.connect(extension.response_downloaded, signal=signals.response_downloaded)
+    crawler.signals.connect(extension.item_scraped, signal=signals.item_scraped)
+    return extension
+
+  def get_metrics(self, request):
+    callback = request.callback.__name__ if callable(request.callback) else "parse"
+    return self.metrics[(request.meta.get("manufacturer", ""), request.meta.get("model", ""), callback)]
+
+  def spider_opened(self, spider):
+    self.start_time = time.time()
+    self.task = task.LoopingCall(self.write_metrics)
+    self.task.start(self.interval, now=False)
+
+  def spider_closed(self, spider, reason):
+    if self.task and self.task.running:
+      self.task.stop()
+    self.write_metrics()
+
+  def request_scheduled(self, request, spider):
+    metrics = self.get_metrics(request)
+    metrics.requests += 1
+    if request.meta.get("retry_times"):
+      metrics.retries += 1
+
+  # Counted as downloaded, before the downloader middlewares: a response that RetryMiddleware retries (e.g. a 429) never
+  # reaches the engine, so response_received would only count the last attempt
+  def response_downloaded(self, response, request, spider):
+    metrics = self.get_metrics(request)
+    metrics.responses_by_status[response.status] += 1
+    if "download_latency" in request.meta:
+      metrics.observe_latency(request.meta["download_latency"])
+
+  def item_scraped(self, item, response, spider):
+    metrics = self.get_metrics(response.request)
+    metrics.items += 1
+    metrics.parse_cpu_seconds += response.meta.get("parse_cpu_time", 0.0)
+
+  def build_metrics_text(self):
+    lines = [
+      "# TYPE scrapy_crawl_elapsed_seconds gauge",
+      f"scrapy_crawl_elapsed_seconds {time.time() - self.start_time:.3f}"
+    ]
+
+    # Current download delay of each slot (domain), as set by AutoThrottle
+    lines.append("# TYPE scrapy_download_delay_seconds gauge")
+    engine = self.crawler.engine
+    slots = engine.downloader.slots if engine and engine.downloader else {}
+    for slot_key, slot in slots.items():
+      lines.append(f'scrapy_download_delay_seconds{{slot="{slot_key}"}} {slot.delay:.3f}')
+
+    counters = [
+      ("scrapy_requests_total", lambda metrics: metrics.requests),
+      ("scrapy_retries_total", lambda metrics: metrics.retries),
+      ("scrapy_items_total", lambda metrics: metrics.items),
+      ("scrapy_parse_cpu_seconds_total", lambda metrics: round(metrics.parse_cpu_seconds, 6))
+    ]
+    for name, get_value in counters:
+      lines.append(f"# TYPE {name} counter")
+      for (manufacturer, model, callback), metrics in sorted(self.metrics.items()):
+        lines.append(f"{name}{{{format_labels([('manufacturer', manufacturer), ('model', model), ('callback', callback)])}}} {get_value(metrics)}")
+
+    lines.append("# TYPE scrapy_responses_total counter")
+    for (manufacturer, model, callback), metrics in sorted(self.metrics.items()):
+      for status, count in sorted(metrics.responses_by_status.items()):
+        labels = format_labels([("manufacturer", manufacturer), ("model", model), ("callback", callback), ("status", status)])
+        lines.append(f"scrapy_responses_total{{{labels}}} {count}")
+
+    lines.append("# TYPE scrapy_response_latency_seconds histogram")
+    for (manufacturer, model, callback), metrics in sorted(self.metrics.items()):
+      labels = [("manufacturer", manufacturer), ("model", model), ("callback", callback)]
+      for upper_bound, count in zip(LATENCY_BUCKETS, metrics.latency_buckets):
+        le = "+Inf" if upper_bound == float("inf") else upper_bound
+        lines.append(f"scrapy_response_latency_seconds_bucket{{{format_labels(labels + [('le', le)])}}} {count}")
+      lines.append(f"scrapy_response_latency_seconds_sum{{{format_labels(labels)}}} {metrics.latency_sum:.6f}")
+      lines.append(f"scrapy_response_latency_seconds_count{{{format_labels(labels)}}} {metrics.latency_buckets[-1]}")
+    return "\n".join(lines) + "\n"
+
+  # Write to a temporary file and rename it, so that readers never see a partial file
+  def write_metrics(self):
+    os.makedirs(os.path.dirname(self.file_path) or ".", exist_ok=True)
+    temporary_file_path = f"{self.file_path}.tmp"
+    with open(temporary_file_path, "w") as file:
+      file.write(self.build_metrics_text())
+    os.replace(temporary_file_path, self.file_path)
+
+# Registers each raw feed segment in the manifest (one JSON line per segment) once it's completely written, with its row count,
+# time range, size and checksum. Readers only use registered segments, so a segment still being written or left by a crash is never read
+class RawSegmentManifest:
+  def __init__(self, manifest_file):
+    self.manifest_file = manifest_file
+    self.first_timestamp = None
+    self.last_timestamp = None
+
+  @classmethod
+  def from_crawler(cls, crawler):
+    manifest_file = crawler.settings.get("RAW_MANIFEST_FILE")
+    if not manifest_file:
+      raise NotConfigured
+    extension = cls(manifest_file)
+    crawler.signals.connect(extension.item_scraped, signal=signals.item_scraped)
+    crawler.signals.connect(extension.feed_slot_closed, signal=signals.feed_slot_closed)
+    return extension
+
+  def item_scraped(self, item, response, spider):
+    timestamp = item.get("timestamp")
+    if timestamp:
+      self.first_timestamp = min(self.first_timestamp or timestamp, timestamp)
+      self.last_timestamp = max(self.last_timestamp or timestamp, timestamp)
+
+  def feed_slot_closed(self, slot):
+    sha256 = hashlib.sha256()
+    with open(slot.uri, "rb") as file:
+      for block in iter(lambda: file.read(1 << 20), b""):
+        sha256.update(block)
+    entry = {
+      "segment": os.path.relpath(slot.uri, os.path.dirname(self.manifest_file)),
+      "rows": slot.itemcount,
+      "first_timestamp": self.first_timestamp,
+      "last_timestamp": self.last_timestamp,
+      "bytes": os.path.getsize(slot.uri),
+      "sha256": sha256.hexdigest(),
+      "closed_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+    # A single small append, so that shards closing at the same time don't interleave their lines
+    with open(self.manifest_file, "a", encoding="utf-8") as file:
+      file.write(json.dumps(entry) + "\n")
@@ -0,0 +1,17 @@
+import time
+
+# Adds the CPU time spent in a callback to response.meta["parse_cpu_time"], read by the telemetry extension when the item is scraped.
+# Callbacks are generators, so the time is measured while their output is iterated
+class ParseTimingMiddleware:
+  def process_spider_output(self, response, result, spider):
+    iterator = iter(result)
+    response.meta["parse_cpu_time"] = 0.0
+    while True:
+      start = time.process_time()
+      try:
+        output = next(iterator)
+      except StopIteration:
+        return
+      finally:
+        response.meta["parse_cpu_time"] = response.meta["parse_cpu_time"] + time.process_time() - start
+      yield output
@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import math
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from scrapy.exceptions import NotConfigured
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "transformation"))
+from clean_car_listing import DEDUP_COLUMNS, clean_item
+from aggregate_car_listing import hash_rows
+
+# Listings are priced against the listings of the same car, age and km bucket
+AGE_BUCKET_MONTHS = 12
+KM_BUCKET = 20_000
+PRICE_REFERENCE_COLUMNS = list(dict.fromkeys(["manufacturer", "car", "built_in", "km", "price", "timestamp", *DEDUP_COLUMNS]))
+
+# Price bucket of a listing cleaned by clean_item(), with its age when it was listed. None if the listing can't be bucketed
+def get_price_bucket(listing, listed_at):
+  if not listing["car"] or listing["built_in"] is None or listing["km"] is None:
+    return None
+  age_in_months = max((listed_at.year - listing["built_in"].year) * 12 + listed_at.month - listing["built_in"].month, 0)
+  return (listing["manufacturer"], listing["car"], age_in_months // AGE_BUCKET_MONTHS, listing["km"] // KM_BUCKET)
+
+# Hashes of the transformed rows included in the price reference (see hash_rows()), saved next to it
+def get_price_reference_rows_file_path(file_path):
+  return f"{os.path.splitext(file_path)[0]}_rows.parquet"
+
+# Load the price reference: listings count and sum of log prices per bucket, the timestamp of the last listing included
+# and the hashes of the rows included. A reference saved without its row hashes is rebuilt, as re-crawled rows can't be told apart
+def load_price_reference(file_path):
+  rows_file_path = get_price_reference_rows_file_path(file_path)
+  if not os.path.exists(file_path) or not os.path.exists(rows_file_path):
+    return {}, None, np.empty(0, dtype=np.uint64)
+  with open(file_path, "r", encoding="utf-8") as file:
+    reference = json.load(file)
+  buckets = {tuple(bucket): [count, log_price_sum] for *bucket, count, log_price_sum in reference["buckets"]}
+  return buckets, reference["watermark"], pd.read_parquet(rows_file_path)["row_hash"].to_numpy()
+
+# Write to temporary files and rename them, so that crawl shards refreshing them at the same time never see a partial file
+def save_price_reference(file_path, buckets, watermark, row_hashes):
+  os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+  rows_file_path = get_price_reference_rows_file_path(file_path)
+  pd.DataFrame({"row_hash": row_hashes}).to_parquet(f"{rows_file_path}.{os.getpid()}.tmp", index=False)
+  temporary_file_path = f"{file_path}.{os.getpid()}.tmp"
+  with open(temporary_file_path, "w", encoding="utf-8") as file:
+    json.dump({"watermark": watermark, "buckets": [[*bucket, *stats] for bucket, stats in buckets.items()]}, file)
+  os.replace(f"{rows_file_path}.{os.getpid()}.tmp", rows_file_path)
+  os.replace(temporary_file_path, file_path)
+
+# Add the listings of the transformed data newer than the watermark to the buckets, returns the new watermark and row hashes
+# Only those rows are read, so the reference is refreshed incrementally as the transformed data grows. A listing crawled again
+# without changes replaces its row with a newer one of the same hash, which is skipped like in aggregate_data()
+def refresh_price_reference(buckets, watermark, row_hashes, source_file_path):
+  if not os.path.exists(source_file_path):
+    return watermark, row_hashes
+  filters = [("timestamp", ">=", pd.Timestamp(watermark))] if watermark else None # Rows of the last second that were already included are skipped by hash
+  df = pd.read_parquet(source_file_path, columns=PRICE_REFERENCE_COLUMNS, filters=filters).dropna()
+  df = df[df["price"] > 0]
+  if df.empty:
+    return watermark, row_hashes
+  new_watermark = df["timestamp"].max().strftime("%Y-%m-%d %H:%M:%S")
+  new_row_hashes = hash_rows(df)
+  new_rows = ~np.isin(new_row_hashes, row_hashes)
+  df = df[new_rows]
+  if df.empty:
+    return new_watermark, row_hashes
+  listed_at, built_in = df["timestamp"].dt, df["built_in"].dt
+  age_in_months = ((listed_at.year - built_in.year) * 12 + listed_at.month - built_in.month).clip(lower=0)
+  new_buckets = pd.DataFrame({
+    "manufacturer": df["manufacturer"].astype(str),
+    "car": df["car"].astype(str),
+    "age_bucket": age_in_months // AGE_BUCKET_MONTHS,
+    "km_bucket": df["km"].astype("int64") // KM_BUCKET,
+    "log_price": np.log(df["price"].astype("float64"))
+  }).groupby(["manufacturer", "car", "age_bucket", "km_bucket"])["log_price"].agg(["count", "sum"])
+  for (manufacturer, car, age_bucket, km_bucket), count, log_price_sum in new_buckets.itertuples(name=None):
+    stats = buckets.setdefault((manufacturer, car, int(age_bucket), int(km_bucket)), [0, 0.0])
+    stats[0] += int(count)
+    stats[1] += float(log_price_sum)
+  return new_watermark, np.union1d(row_hashes, new_row_hashes[new_rows])
+
+# Flags under-priced listings as they are scraped: each item is cleaned with clean_item() and its price compared to the
+# geometric mean price of its bucket (car, age, km). Listings at least DEAL_DISCOUNT below it, in buckets of at least
+# DEAL_MIN_REFERENCE_LISTINGS listings, are appended to DEALS_FILE right away. Items are passed on unchanged
+# The reference is refreshed from the transformed data when the spider opens, and every priced item is added to it
+class UnderpricedListingPipeline:
+  def __init__(self, stats, deals_file, reference_file, reference_source, discount, min_reference_listings):
+    self.stats = stats
+    self.deals_file = deals_file
+    self.reference_file = reference_file
+    self.reference_source = reference_source
+    self.discount = discount
+    self.min_reference_listings = min_reference_listings
+    self.processing_time = 0.0
+
+  @classmethod
+  def from_crawler(cls, crawler):
+    settings = crawler.settings
+    deals_file = settings.get("DEALS_FILE")
+    if not deals_file:
+      raise NotConfigured
+    return cls(
+      crawler.stats, deals_file, settings.get("PRICE_REFERENCE_FILE"), settings.get("PRICE_REFERENCE_SOURCE"),
+      settings.getfloat("DEAL_DISCOUNT", 0.2), settings.getint("DEAL_MIN_REFERENCE_LISTINGS", 5)
+    )
+
+  def open_spider(self, spider):
+    self.buckets, watermark, row_hashes = load_price_reference(self.reference_file)
+    refreshed_watermark, row_hashes = refresh_price_reference(self.buckets, watermark, row_hashes, self.reference_source)
+    if refreshed_watermark != watermark:
+      save_price_reference(self.reference_file, self.buckets, refreshed_watermark, row_hashes)
+    self.stats.set_value("deals/reference_buckets", len(self.buckets))
+    os.makedirs(os.path.dirname(self.deals_file) or ".", exist_ok=True)
+    self.deals = open(self.deals_file, "a", encoding="utf-8")
+
+  def close_spider(self, spider):
+    self.deals.close()
+    items = self.stats.get_value("deals/items", 0)
+    if items:
+      self.stats.set_value("deals/microseconds_per_item", round(self.processing_time / items * 1_000_000, 1))
+
+  def process_item(self, item, spider):
+    start = time.perf_counter()
+    self.score_item(item)
+    self.processing_time += time.perf_counter() - start
+    self.stats.inc_value("deals/items")
+    return item
+
+  def score_item(self, item):
+    listing = clean_item(item)
+    try:
+      listed_at = datetime.strptime(item.get("timestamp") or "", "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+      listed_at = datetime.now()
+    bucket = get_price_bucket(listing, listed_at)
+    if bucket is None or not listing["price"]:
+      self.stats.inc_value("deals/unpriced")
+      return
+    stats = self.buckets.setdefault(bucket, [0, 0.0])
+    if stats[0] >= self.min_reference_listings:
+      reference_price = math.exp(stats[1] / stats[0])
+      if listing["price"] <= (1 - self.discount) * reference_price:
+        self.write_deal(item, listing, reference_price, stats[0])
+    stats[0] += 1
+    stats[1] += math.log(listing["price"])
+
+  # A single small append per deal, flushed right away, so deals can be followed during the crawl and shards don't interleave
+  def write_deal(self, item, listing, reference_price, reference_listings):
+    deal = {
+      "listing_url": item.get("listing_url"),
+      "manufacturer": listing["manufacturer"],
+      "car": listing["car"],
+      "built_in": item.get("built_in"),
+      "km": listing["km"],
+      "price": listing["price"],
+      "reference_price": round(reference_price),
+      "reference_listings": reference_listings,
+      "discount": round(1 - listing["price"] / reference_price, 3),
+      "timestamp": item.get("timestamp")
+    }
+    self.deals.write(json.dumps(deal) + "\n")
+    self.deals.flush()
+    self.stats.inc_value("deals/flagged")
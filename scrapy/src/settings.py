@@ -47,9 +47,9 @@ COOKIES_ENABLED = False
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
-#    "src.middlewares.SrcSpiderMiddleware": 543,
-#}
+SPIDER_MIDDLEWARES = {
+    "src.middlewares.ParseTimingMiddleware": 950,
+}
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
@@ -62,13 +62,29 @@ COOKIES_ENABLED = False
 EXTENSIONS = {
    "scrapy.extensions.telnet.TelnetConsole": None,
    'scrapy.extensions.logstats.LogStats': None,
+   "src.extensions.CrawlTelemetry": 500,
+   "src.extensions.RawSegmentManifest": 500,
 }
 
+# Manifest of the raw feed segments, read by clean_data() and explore_data()
+RAW_MANIFEST_FILE = "../../data/raw/manifest.jsonl"
+
+# Per manufacturer/model crawl metrics (Prometheus textfile), written every TELEMETRY_INTERVAL seconds and at close
+TELEMETRY_FILE = "../../data/raw/crawl_metrics.prom"
+TELEMETRY_INTERVAL = 60
+
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-#ITEM_PIPELINES = {
-#    "src.pipelines.SrcPipeline": 300,
-#}
+ITEM_PIPELINES = {
+    "src.pipelines.UnderpricedListingPipeline": 300,
+}
+
+# Under-priced listings, flagged as they are scraped against a price reference per car, age and km bucket
+DEALS_FILE = "../../data/deals/deals.jsonl"
+PRICE_REFERENCE_FILE = "../../data/reference/price_reference.json" # Refreshed from PRICE_REFERENCE_SOURCE when the spider opens
+PRICE_REFERENCE_SOURCE = "../../data/transformed/transformed_car_listing.parquet"
+DEAL_DISCOUNT = 0.2 # Listings at least 20% below the reference price of their bucket are flagged
+DEAL_MIN_REFERENCE_LISTINGS = 5 # Buckets with fewer listings are not used to flag deals
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
@@ -97,13 +113,15 @@ TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
 FEED_EXPORT_ENCODING = "utf-8"
 
 FEEDS = {
-    '../../data/raw/car_listing.jsonl': {
+    # One gzip compressed segment per run, registered in RAW_MANIFEST_FILE. feed_name is a spider attribute, set per shard by main.py
+    '../../data/raw/segments/%(feed_name)s-%(time)s.jsonl.gz': {
         'format': 'jsonlines',
         'encoding': 'utf8',
         'store_empty': False,
         'append': True,
         'indent': None,
         'line_separator': "\n",
+        'postprocessing': ['scrapy.extensions.postprocessing.GzipPlugin'],
     },
 }
 
@@ -1,141 +1,444 @@
+import os
+import re
+import json
+import sqlite3
 import scrapy
-from datetime import datetime
-
-def load_project_variables():
-  # Returns project variables as a dictionary.
-  return {
-    "MAX_PAGES": 20,
-    "AD_AGE": 20,
-    "PRICE_FROM": 5000,
-    "PRICE_TO": 75000,
-    "YEAR_FROM": 2016,
-    "MANUFACTURERS_MODELS": {
-        "audi": ["a3", "a4"],
-        "cupra": ["formentor"],
-        "honda": ["civic", "hr-v"],
-        "hyundai": ["tucson"],
-        "kia": ["ev6", "niro"],
-        "lexus": ["ux-250h"],
-        "lynk-&-co": ["01"],
-        "mazda": ["3", "cx-30"],
-        "tesla": ["model-3", "model-y"],
-        "toyota": ["c-hr", "corolla", "yaris-cross"],
-        "volvo": ["s60", "xc40"]
-    }
-  }
+from datetime import datetime, timedelta
+from lxml import etree
+
+# Search space and per-model overrides, see load_project_variables()
+CRAWL_CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "crawl_config.json")
+
+# Variables of the crawl configuration that spider arguments can override, with their types
+CONFIG_VARIABLES = {"max_pages": int, "ad_age": int, "price_from": int, "price_to": int, "year_from": int, "seen_listings_ttl_days": float}
+
+# Index of the listings already scraped, relative to scrapy/src like the feed
+SEEN_LISTINGS_FILE = "../../data/raw/seen_listings.sqlite"
+SQLITE_MAX_VARIABLES = 500 # Listing URLs per SELECT ... IN (...) query
+
+# Paths in the page's embedded Next.js state (__NEXT_DATA__) to the result list of a search page and to the listing of a detail page
+NEXT_DATA_LISTINGS_PATH = ["props", "pageProps", "listings"]
+NEXT_DATA_LISTING_DETAILS_PATH = ["props", "pageProps", "listingDetails"]
+NEXT_DATA_NUMBER_OF_RESULTS_PATH = ["props", "pageProps", "numberOfResults"]
+
+# Fields of a search result card that identify a changed listing (price and mileage)
+NEXT_DATA_CARD_FINGERPRINT_PATHS = [["price", "priceFormatted"], ["vehicle", "mileageInKm"]]
+
+# Item fields read from the listing details of the embedded state, the other fields come from the page itself
+NEXT_DATA_FIELDS = {
+  "manufacturer": ["vehicle", "make"],
+  "model": ["vehicle", "model"],
+  "description": ["vehicle", "modelVersionInput"],
+  "price": ["prices", "public", "price"],
+  "km": ["vehicle", "mileageInKm"],
+  "gear_type": ["vehicle", "transmissionType"],
+  "built_in": ["vehicle", "firstRegistrationDate"],
+  "fuel": ["vehicle", "fuelCategory", "formatted"],
+  "engine_power": ["vehicle", "power"],
+  "seller_type": ["seller", "type"],
+  "seller_name": ["seller", "companyName"],
+  "street": ["location", "street"],
+  "zip": ["location", "zip"],
+  "city": ["location", "city"]
+}
+
+# Seller types of the embedded state, as shown on the page
+NEXT_DATA_SELLER_TYPES = {"Dealer": "Dealer", "Private": "Private seller"}
+
+# Fields of the item header, as parse_car_header() and parse_car_header_json() return them
+HEADER_FIELDS = [
+  "manufacturer", "description", "price", "km", "gear_type", "built_in", "fuel", "engine_power", "seller_type", "seller_name",
+  "seller_address_1", "seller_address_2"
+]
+
+# Labels of the vehicle overview on the page, by header field
+OVERVIEW_LABELS = {
+  "km": "Mileage",
+  "gear_type": "Gearbox",
+  "built_in": "First registration",
+  "fuel": "Fuel type",
+  "engine_power": "Power",
+  "seller_type": "Seller"
+}
+
+# Selectors of the header fields read from a single text node of the page
+HEADER_SELECTORS = {
+  "manufacturer": "span.StageTitle_boldClassifiedInfo__sQb0l::text",
+  #"car": "span.StageTitle_model__EbfjC.StageTitle_boldClassifiedInfo__sQb0l::text", # Website structure changed
+  "description": "div.StageTitle_modelVersion__Yof2Z::text",
+  "price": "span.PriceInfo_price__XU0aF::text",
+  "seller_name": "div.RatingsAndCompanyName_dealer__EaECM div::text"
+}
+
+# Header fields a seller type doesn't have: a private seller has no company name and a single address line
+SELLER_TYPE_ABSENT_FIELDS = {"Private seller": ["seller_name", "seller_address_2"]}
+SELLER_FIELDS = ["seller_type", "seller_name", "seller_address_1", "seller_address_2"]
+
+def get_path(value, path):
+  # Returns the value at a path of nested dictionaries, None if any key is missing
+  for key in path:
+    value = value.get(key) if isinstance(value, dict) else None
+  return value
+
+def get_missing_header_fields(header):
+  # Returns the header fields to read with the selectors: the fields the embedded state should have for the seller type but
+  # doesn't. Without a known seller type, the address lines can't be placed and every seller field is read from the page
+  if not header:
+    return HEADER_FIELDS
+  missing_fields = [field for field in HEADER_FIELDS if header[field] is None]
+  if header["seller_type"] not in NEXT_DATA_SELLER_TYPES.values():
+    return [field for field in HEADER_FIELDS if field in missing_fields or field in SELLER_FIELDS]
+  absent_fields = SELLER_TYPE_ABSENT_FIELDS.get(header["seller_type"], [])
+  return [field for field in missing_fields if field not in absent_fields]
+
+def format_next_data_power(power):
+  # The embedded state has the power as a number of hp, the page shows it as "104 kW (141 hp)" and only the hp are cleaned
+  if isinstance(power, (int, float)) and not isinstance(power, bool):
+    return f"{round(power)} hp"
+  if isinstance(power, str) and (power.strip().isdigit() or "hp" in power):
+    return power if "hp" in power else f"{power.strip()} hp"
+  return None
+
+def format_next_data_date(date):
+  # The embedded state has the first registration as an ISO date, the page shows it as month/year
+  if isinstance(date, str) and re.fullmatch(r"\d{2}/\d{4}", date):
+    return date
+  try:
+    return datetime.fromisoformat(str(date)[:10]).strftime("%m/%Y")
+  except ValueError:
+    return None
+
+# Fields of the embedded state formatted like the page shows them, None if the value isn't in a known format
+NEXT_DATA_FORMATTERS = {"engine_power": format_next_data_power, "built_in": format_next_data_date}
+
+def load_project_variables(config_file=CRAWL_CONFIG_FILE):
+  # Returns project variables as a dictionary: the search space (MANUFACTURERS_MODELS, MAX_PAGES, AD_AGE, PRICE_FROM, PRICE_TO, YEAR_FROM),
+  # SEEN_LISTINGS_TTL_DAYS (unchanged listings are scraped again after this many days, 0 scrapes every listing)
+  # and MODEL_OVERRIDES ({"manufacturer/model": {"MAX_PAGES": ..., "PRIORITY": ...}}, models with a higher priority are fetched first)
+  with open(config_file) as file:
+    return json.load(file)
 
 class CarListingSpider(scrapy.Spider):
   name = "scrape_car_listing"
 
-  # Load settings as a dictionary
-  settings = load_project_variables()
+  # Crawl configuration file (-a config=...), its variables can be overridden with spider arguments such as -a max_pages=5
+  # or -a models=kia/niro,tesla/model-3, and it's reloaded when it changes during the crawl
+  config = CRAWL_CONFIG_FILE
+  shard = "0/1" # -a shard=i/n crawls every n-th manufacturer/model pair starting at the i-th, see run_scrapy_spider() in main.py
+  feed_name = "car_listing" # Feed file in data/raw (see FEEDS), -a feed_name=... writes a shard to its own feed
+
+  # "json" reads the embedded page state and falls back to the selectors for the fields it's missing, "css" only uses the selectors (-a extraction_mode=css)
+  extraction_mode = "json"
+  next_data_xpath = etree.XPath("//script[@id='__NEXT_DATA__']/text()")
+
+  # Spec sheet selectors, compiled once and evaluated in a single pass over the dt/dd pairs of a page
+  spec_labels_xpath = etree.XPath("//dt[following-sibling::*[1][self::dd]]")
+  spec_label_text_xpath = etree.XPath("normalize-space(.)")
+  spec_text_xpath = etree.XPath("text()")
+  spec_paragraph_text_xpath = etree.XPath(".//p/text()")
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.arguments = kwargs
+    self.load_config()
+
+  def load_config(self):
+    # Loads the crawl configuration, the spider arguments take precedence over the file. Nothing is changed if it fails
+    # (e.g. a file being edited), and the modification time is only recorded once the whole configuration is applied
+    config_mtime = os.path.getmtime(self.config)
+    variables = load_project_variables(self.config)
+    config = {name: cast(self.arguments.get(name, variables[name.upper()])) for name, cast in CONFIG_VARIABLES.items()}
+    config["manufacturers_models"] = variables["MANUFACTURERS_MODELS"]
+    if self.arguments.get("models"):
+      config["manufacturers_models"] = {}
+      for pair in self.arguments["models"].split(","):
+        manufacturer, model = pair.strip().split("/")
+        config["manufacturers_models"].setdefault(manufacturer, []).append(model)
+    config["model_overrides"] = variables.get("MODEL_OVERRIDES", {})
+    for name, value in config.items():
+      setattr(self, name, value)
+    self.config_mtime = config_mtime
+
+  def refresh_config(self):
+    # Reloads the configuration if its file changed, the new page limits and priorities apply to the next requests
+    # An invalid file keeps the previous configuration and is tried again on the next call, with one warning per change
+    try:
+      config_mtime = os.path.getmtime(self.config)
+    except OSError:
+      return # Being replaced
+    if config_mtime == self.config_mtime:
+      return
+    try:
+      self.load_config()
+    except (OSError, json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+      if config_mtime != getattr(self, "invalid_config_mtime", None):
+        self.invalid_config_mtime = config_mtime
+        self.logger.warning(f"Keeping the previous crawl configuration, {self.config} is invalid: {e}")
+      return
+    self.logger.info(f"Reloaded the crawl configuration from {self.config}")
 
-  # Extract values correctly using dictionary keys
-  max_pages = settings["MAX_PAGES"]
-  ad_age = settings["AD_AGE"]
-  price_from = settings["PRICE_FROM"]
-  price_to = settings["PRICE_TO"]
-  year_from = settings["YEAR_FROM"]
-  manufacturers_models = settings["MANUFACTURERS_MODELS"]
+  def get_model_config(self, manufacturer, model):
+    # Returns the max pages and the request priority of a model
+    overrides = self.model_overrides.get(f"{manufacturer}/{model}", {})
+    return overrides.get("MAX_PAGES", self.max_pages), overrides.get("PRIORITY", 0)
+
+  def get_shard_models(self):
+    # Returns the (manufacturer, model) pairs of this spider's shard
+    shard_index, shard_count = (int(part) for part in self.shard.split("/"))
+    pairs = [(manufacturer, model) for manufacturer, models in self.manufacturers_models.items() for model in models]
+    return pairs[shard_index::shard_count]
 
   def start_requests(self):
-    self.current_page = 1
-    for manufacturer, models in self.manufacturers_models.items():
-      for model in models:
-        for page in range(1, self.max_pages + 1):
-          url = self.construct_url(manufacturer, model, self.year_from, self.price_from, self.price_to, self.ad_age, page)
-          yield scrapy.Request(url=url, callback=self.parse, meta={"manufacturer": manufacturer, "model": model, "page": page})
+    # Only the first page of each model is seeded, parse() follows the next pages while there are new results.
+    # With a JOBDIR, the listings seen so far are kept in the spider state and the pages already requested are skipped on resume
+    self.seen_listing_urls = getattr(self, "state", {}).setdefault("seen_listing_urls", set())
+    self.seen_index = self.open_seen_index()
+    self.scraped_listings = []
+    for manufacturer, model in self.get_shard_models():
+      url = self.construct_url(manufacturer, model, self.year_from, self.price_from, self.price_to, self.ad_age, 1)
+      _, priority = self.get_model_config(manufacturer, model)
+      yield scrapy.Request(url=url, callback=self.parse, priority=priority, meta={"manufacturer": manufacturer, "model": model, "page": 1})
 
   def construct_url(self, manufacturer, model, year_from, price_from, price_to, ad_age, page):
     url = f"https://www.autoscout24.com/lst/{manufacturer}/{model}?body=1%2C4%2C6&cy=NL&gear=A%2CM&fregfrom={year_from}&pricefrom={price_from}&priceto={price_to}&adage={ad_age}&desc=1&sort=age&page={page}"
     return url
 
-  def parse(self, response):
-    car_links = response.css("a.ListItem_title__ndA4s::attr(href)").getall()
+  def open_seen_index(self):
+    os.makedirs(os.path.dirname(SEEN_LISTINGS_FILE), exist_ok=True)
+    conn = sqlite3.connect(SEEN_LISTINGS_FILE, timeout=60) # Shards running in parallel share the index
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+      CREATE TABLE IF NOT EXISTS seen_listings (
+        listing_url TEXT PRIMARY KEY,
+        fingerprint TEXT,
+        scraped_at TEXT NOT NULL
+      )
+    """)
+    return conn
 
-    for link in car_links:
-      absolute_url = response.urljoin(link)
-      yield scrapy.Request(url=absolute_url, callback=self.parse_car, meta=response.meta)
+  def write_scraped_listings(self):
+    # Writes the scraped listings to the index in one short transaction when the spider closes, so that a crawl
+    # interrupted before its feed is flushed re-fetches its listings instead of skipping them
+    with self.seen_index:
+      self.seen_index.executemany("INSERT OR REPLACE INTO seen_listings (listing_url, fingerprint, scraped_at) VALUES (?, ?, ?)", self.scraped_listings)
+    self.scraped_listings = []
+
+  def closed(self, reason):
+    self.write_scraped_listings()
+    self.seen_index.close()
+
+  def get_fresh_listings(self, fingerprints_by_url):
+    # Returns the listing URLs scraped within the TTL whose card fingerprint hasn't changed (or is unknown)
+    ttl_days = float(self.seen_listings_ttl_days)
+    if ttl_days <= 0:
+      return set()
+    cutoff = (datetime.now() - timedelta(days=ttl_days)).strftime("%Y-%m-%d %H:%M:%S")
+    urls = list(fingerprints_by_url)
+    fresh_listings = set()
+    for i in range(0, len(urls), SQLITE_MAX_VARIABLES):
+      batch = urls[i:i + SQLITE_MAX_VARIABLES]
+      rows = self.seen_index.execute(
+        f"SELECT listing_url, fingerprint FROM seen_listings WHERE listing_url IN ({', '.join('?' * len(batch))}) AND scraped_at >= ?",
+        [*batch, cutoff]
+      )
+      for listing_url, fingerprint in rows:
+        if fingerprints_by_url[listing_url] is None or fingerprints_by_url[listing_url] == fingerprint:
+          fresh_listings.add(listing_url)
+    return fresh_listings
+
+  def load_next_data(self, response):
+    # Decodes the embedded page state, None if it's missing
+    if self.extraction_mode != "json":
+      return None
+    next_data = self.next_data_xpath(response.selector.root)
+    if not next_data:
+      return None
+    try:
+      return json.loads(next_data[0])
+    except json.JSONDecodeError:
+      return None
 
+  def parse(self, response):
+    self.refresh_config()
     # Get the current page, manufacturer, and model from the response meta
     current_page = response.meta["page"]
     manufacturer = response.meta["manufacturer"]
     model = response.meta["model"]
+    max_pages, priority = self.get_model_config(manufacturer, model)
+
+    next_data = self.load_next_data(response)
+    listings = get_path(next_data, NEXT_DATA_LISTINGS_PATH)
+    if listings:
+      listings = [listing for listing in listings if isinstance(listing, dict) and listing.get("url")]
+      car_links = [listing["url"] for listing in listings]
+      fingerprints = [json.dumps([get_path(listing, path) for path in NEXT_DATA_CARD_FINGERPRINT_PATHS]) for listing in listings]
+    else:
+      car_links = response.css("a.ListItem_title__ndA4s::attr(href)").getall()
+      fingerprints = [None] * len(car_links)
+
+    # Listings new to this crawl, the ones scraped recently and unchanged since are skipped
+    fingerprints_by_url = {}
+    for link, fingerprint in zip(car_links, fingerprints):
+      absolute_url = response.urljoin(link)
+      if absolute_url not in self.seen_listing_urls:
+        self.seen_listing_urls.add(absolute_url)
+        fingerprints_by_url[absolute_url] = fingerprint
+    new_listings = len(fingerprints_by_url)
+    fresh_listings = self.get_fresh_listings(fingerprints_by_url)
+    self.crawler.stats.inc_value("seen_listings/skipped", len(fresh_listings))
+
+    for absolute_url, fingerprint in fingerprints_by_url.items():
+      if absolute_url not in fresh_listings:
+        yield scrapy.Request(url=absolute_url, callback=self.parse_car, priority=priority, meta={"manufacturer": manufacturer, "model": model, "page": current_page, "listing_url": absolute_url, "fingerprint": fingerprint})
 
-    if current_page < self.max_pages:
+    # The results shown so far, counted with the first page's size as the page size
+    page_size = response.meta.get("page_size") or len(car_links)
+    number_of_results = get_path(next_data, NEXT_DATA_NUMBER_OF_RESULTS_PATH)
+    results_shown = (current_page - 1) * page_size + len(car_links)
+
+    # Stop when the page is empty, only has listings seen before, reaches the total number of results or the page limit
+    if not car_links or not new_listings:
+      self.logger.debug(f"Stopping {manufacturer} {model} at page {current_page}: no new listings")
+    elif isinstance(number_of_results, int) and results_shown >= number_of_results:
+      self.logger.debug(f"Stopping {manufacturer} {model} at page {current_page}: all {number_of_results} results shown")
+    elif current_page < max_pages:
       next_page_url = self.construct_url(manufacturer, model, self.year_from, self.price_from, self.price_to, self.ad_age, current_page + 1)
-      yield scrapy.Request(url=next_page_url, callback=self.parse, meta={"manufacturer": manufacturer, "model": model, "page": current_page + 1})
+      yield scrapy.Request(url=next_page_url, callback=self.parse, priority=priority, meta={"manufacturer": manufacturer, "model": model, "page": current_page + 1, "page_size": page_size})
 
-  def parse_car(self, response):
-    # Extract overview data
-    overview_containers = response.css("div.VehicleOverview_itemContainer__XSLWi")
-    vehicle_overview_data = {}
+  def parse_spec_sheet(self, response):
+    # Returns the spec sheet as {dt label: (first dd text, dd paragraph texts)}, keeping the first dd of a repeated label
+    spec_sheet = {}
+    for label in self.spec_labels_xpath(response.selector.root):
+      value = label.getnext()
+      texts = self.spec_text_xpath(value)
+      spec_sheet.setdefault(self.spec_label_text_xpath(label), (str(texts[0]) if texts else None, [str(text) for text in self.spec_paragraph_text_xpath(value)]))
+    return spec_sheet
+
+  def get_spec(self, spec_sheet, label, paragraphs=False):
+    # Matches the label exactly, or else the first label containing it like the former "dt:contains(...)" selectors
+    match = spec_sheet.get(label)
+    if match is None:
+      match = next((spec for spec_label, spec in spec_sheet.items() if label in spec_label), (None, []))
+    return match[1] if paragraphs else match[0]
+
+  def parse_car_header(self, response, fields=HEADER_FIELDS):
+    # Extracts the vehicle, overview and seller fields with the page selectors, only the given fields
+    header = {}
+    if any(field in OVERVIEW_LABELS for field in fields):
+      # Extract overview data
+      overview_containers = response.css("div.VehicleOverview_itemContainer__XSLWi")
+      vehicle_overview_data = {}
+
+      for overview in overview_containers:
+        label_overview = overview.css("div.VehicleOverview_itemTitle__S2_lb::text").get()
+        value_overview = overview.css("div.VehicleOverview_itemText__AI4dA::text").get()
+        if label_overview:
+          vehicle_overview_data[label_overview.strip()] = value_overview.strip() if value_overview else None
+      header.update({field: vehicle_overview_data.get(label) for field, label in OVERVIEW_LABELS.items()})
+
+    if "seller_address_1" in fields or "seller_address_2" in fields:
+      seller_address = response.css("a.scr-link.Department_link__xMUEe::text").getall()
+      header["seller_address_1"] = seller_address[0] if seller_address else None
+      header["seller_address_2"] = seller_address[3] if len(seller_address) > 3 else None
 
-    for overview in overview_containers:
-      label_overview = overview.css("div.VehicleOverview_itemTitle__S2_lb::text").get()
-      value_overview = overview.css("div.VehicleOverview_itemText__AI4dA::text").get()
-      if label_overview:
-        vehicle_overview_data[label_overview.strip()] = value_overview.strip() if value_overview else None
+    for field, selector in HEADER_SELECTORS.items():
+      if field in fields:
+        header[field] = response.css(selector).get(default=None)
+    return {field: header[field] for field in fields}
+
+  def parse_car_header_json(self, listing_details):
+    # Maps the vehicle, overview and seller fields from the listing details of the embedded page state, in the format of
+    # parse_car_header(). Fields that are missing or in an unknown format are None
+    header = {}
+    for field, path in NEXT_DATA_FIELDS.items():
+      value = get_path(listing_details, path)
+      if value is not None and field in NEXT_DATA_FORMATTERS:
+        header[field] = NEXT_DATA_FORMATTERS[field](value)
+      else:
+        header[field] = str(value) if value is not None else None
+
+    # The page shows the model after the make, and the cleaning splits them again
+    model = header.pop("model")
+    header["manufacturer"] = f"{header['manufacturer']} {model}" if header["manufacturer"] and model else None
+
+    # The page shows a private seller's postcode on the first address line and a dealer's on the second, after the street
+    seller_type = NEXT_DATA_SELLER_TYPES.get(header["seller_type"], header["seller_type"])
+    location = " ".join(part for part in (header.pop("zip"), header.pop("city")) if part) or None
+    street = header.pop("street")
+    header["seller_type"] = seller_type
+    header["seller_address_1"] = location if seller_type == "Private seller" else street
+    header["seller_address_2"] = location if seller_type != "Private seller" else None
+    return header
+
+  def parse_car(self, response):
+    spec_sheet = self.parse_spec_sheet(response)
+    listing_details = get_path(self.load_next_data(response), NEXT_DATA_LISTING_DETAILS_PATH)
+    header = self.parse_car_header_json(listing_details) if listing_details else {}
+    missing_fields = get_missing_header_fields(header)
+    if missing_fields:
+      # Fields missing from the embedded state are read with the selectors, the others aren't parsed again
+      header.update(self.parse_car_header(response, missing_fields))
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    self.scraped_listings.append((response.meta.get("listing_url", response.url), response.meta.get("fingerprint"), timestamp))
 
     yield {
         # Vehicle information
-        "manufacturer": response.css("span.StageTitle_boldClassifiedInfo__sQb0l::text").get(default=None),
-        #"car": response.css("span.StageTitle_model__EbfjC.StageTitle_boldClassifiedInfo__sQb0l::text").get(default=None), # Website structure changed
-        "description": response.css("div.StageTitle_modelVersion__Yof2Z::text").get(default=None),
-        "price": response.css("span.PriceInfo_price__XU0aF::text").get(default=None),
+        "manufacturer": header["manufacturer"],
+        "description": header["description"],
+        "price": header["price"],
         "lease_price_per_month": response.css("div.FinancialLeaseStage_rate__h8aCR span:nth-child(2)::text").get(default=None),
 
         # Overview data
-        "km": vehicle_overview_data.get("Mileage"),
-        "gear_type": vehicle_overview_data.get("Gearbox"),
-        "built_in": vehicle_overview_data.get("First registration"),
-        "fuel": vehicle_overview_data.get("Fuel type"),
-        "engine_power": vehicle_overview_data.get("Power"),
-        "seller_type": vehicle_overview_data.get("Seller"),
+        "km": header["km"],
+        "gear_type": header["gear_type"],
+        "built_in": header["built_in"],
+        "fuel": header["fuel"],
+        "engine_power": header["engine_power"],
+        "seller_type": header["seller_type"],
 
         # Basic data
-        "body_type": response.css("dt:contains('Body type') + dd::text").get(default=None),
-        "used_or_new": response.css("dt:contains('Type') + dd::text").get(default=None),
-        "drive_train": response.css("dt:contains('Drivetrain') + dd::text").get(default=None),
-        "seats": response.css("dt:contains('Seats') + dd::text").get(default=None),
-        "doors": response.css("dt:contains('Doors') + dd::text").get(default=None),
+        "body_type": self.get_spec(spec_sheet, "Body type"),
+        "used_or_new": self.get_spec(spec_sheet, "Type"),
+        "drive_train": self.get_spec(spec_sheet, "Drivetrain"),
+        "seats": self.get_spec(spec_sheet, "Seats"),
+        "doors": self.get_spec(spec_sheet, "Doors"),
 
         # Vehicle history
-        "previous_owners": response.css("dt:contains('Previous owner') + dd::text").get(default=None),
-        "full_service_history": response.css("dt:contains('Full service history') + dd::text").get(default=None),
-        "non-smoker": response.css("dt:contains('Non-smoker vehicle') + dd::text").get(default=None),
+        "previous_owners": self.get_spec(spec_sheet, "Previous owner"),
+        "full_service_history": self.get_spec(spec_sheet, "Full service history"),
+        "non-smoker": self.get_spec(spec_sheet, "Non-smoker vehicle"),
 
         # Technical data
-        "engine_size": response.css("dt:contains('Engine size') + dd::text").get(default=None),
-        "gears": response.css("dt:contains('Gears') + dd::text").get(default=None),
-        "cylinders": response.css("dt:contains('Cylinders') + dd::text").get(default=None),
-        "empty_weight": response.css("dt:contains('Empty weight') + dd::text").get(default=None),
+        "engine_size": self.get_spec(spec_sheet, "Engine size"),
+        "gears": self.get_spec(spec_sheet, "Gears"),
+        "cylinders": self.get_spec(spec_sheet, "Cylinders"),
+        "empty_weight": self.get_spec(spec_sheet, "Empty weight"),
 
         # Energy consumption
-        "emission_class": response.css("dt:contains('Emission class') + dd::text").get(default=None),
-        "fuel_consumption": " ".join(response.css("dt:contains('Fuel consumption') + dd p::text").getall()),
-        "co2_emission": response.css("dt:contains('CO₂-emissions') + dd::text").get(default=None),
-        "electric_range": response.css("dt:contains('Electric Range') + dd::text").get(default=None),
+        "emission_class": self.get_spec(spec_sheet, "Emission class"),
+        "fuel_consumption": " ".join(self.get_spec(spec_sheet, "Fuel consumption", paragraphs=True)),
+        "co2_emission": self.get_spec(spec_sheet, "CO₂-emissions"),
+        "electric_range": self.get_spec(spec_sheet, "Electric Range"),
 
         # Appearance
-        "car_color": response.css("dt:contains('Colour') + dd::text").get(default=None),
-        "manufacturer_color": response.css("dt:contains('Manufacturer colour') + dd::text").get(default=None),
-        "paint": response.css("dt:contains('Paint') + dd::text").get(default=None),
-        "upholstery_color": response.css("dt:contains('Upholstery colour') + dd::text").get(default=None),
-        "upholstery": response.css("dt:contains('Upholstery') + dd::text").get(default=None),
+        "car_color": self.get_spec(spec_sheet, "Colour"),
+        "manufacturer_color": self.get_spec(spec_sheet, "Manufacturer colour"),
+        "paint": self.get_spec(spec_sheet, "Paint"),
+        "upholstery_color": self.get_spec(spec_sheet, "Upholstery colour"),
+        "upholstery": self.get_spec(spec_sheet, "Upholstery"),
 
         # Equipment
         "equipment": response.css("dd.DataGrid_defaultDdStyle__3IYpG ul li::text").getall() or None,
 
         # Seller details
-        "seller_name": response.css("div.RatingsAndCompanyName_dealer__EaECM div::text").get(default=None),
+        "seller_name": header["seller_name"],
         "active_since": response.css("span.RatingsAndCompanyName_customerSince__Zf7h4::text").get(default=None),
-        "seller_address_1": response.css("a.scr-link.Department_link__xMUEe::text").getall()[0] if response.css("a.scr-link.Department_link__xMUEe::text").getall() else None,
-        "seller_address_2": response.css("a.scr-link.Department_link__xMUEe::text").getall()[3] if len(response.css("a.scr-link.Department_link__xMUEe::text").getall()) > 3 else None,
+        "seller_address_1": header["seller_address_1"],
+        "seller_address_2": header["seller_address_2"],
 
         # Metadata
         "listing_url": response.url,
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),  
+        "timestamp": timestamp,  
     }
 
 # To run the spider, execute the following command in the terminal:   
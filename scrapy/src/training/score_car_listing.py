@@ -0,0 +1,291 @@
+import os
+import sys
+import json
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pandas as pd
+import numpy as np
+import joblib
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "transformation"))
+from clean_car_listing import get_raw_file_size, load_raw_manifest, get_readable_segments, get_raw_sources, read_raw_data_in_chunks, clean_columns, apply_column_dtypes
+from transform_car_listing import TRANSFORMATION_RULES, TRANSFORMED_COLUMN_DTYPES, POSTCODES_FILE_PATH, apply_transformation_rules, add_postcode_data, add_geonames_data
+from train_car_listing import MODEL_FILE_PATH, build_features
+
+# Fields of the listings to score, as yielded by parse_car() in spiders/scrape_car_listing.py. Missing fields are left empty
+RECORD_FIELDS = [
+  "manufacturer", "description", "price", "lease_price_per_month", "km", "gear_type", "built_in", "fuel", "engine_power",
+  "seller_type", "body_type", "used_or_new", "drive_train", "seats", "doors", "previous_owners", "full_service_history",
+  "non-smoker", "engine_size", "gears", "cylinders", "empty_weight", "emission_class", "fuel_consumption", "co2_emission",
+  "electric_range", "car_color", "manufacturer_color", "paint", "upholstery_color", "upholstery", "equipment",
+  "seller_name", "active_since", "seller_address_1", "seller_address_2", "listing_url", "timestamp"
+]
+RECORD_LIST_FIELDS = ["equipment"] # Fields holding a list of text, every other field holds text
+
+# Server settings
+SERVER_HOST = "127.0.0.1" # Local only
+SERVER_PORT = int(os.getenv("SCORING_PORT", 8000))
+MAX_BATCH_SIZE = 256 # Records scored together by the micro-batcher
+MAX_BATCH_WAIT_MS = 5 # Time the micro-batcher waits for more requests after the first one of a batch
+LATENCY_WINDOW = 10_000 # Latest requests the p50 and p99 latencies are computed on
+
+# Benchmark settings
+BENCHMARK_RECORDS = 10_000 # Raw listings scored by the benchmark, the first ones of the raw data
+BENCHMARK_BATCH_SIZES = [1_000, BENCHMARK_RECORDS]
+BENCHMARK_SINGLE_RECORDS = 500 # Listings scored one at a time, directly and through the server
+BENCHMARK_CLIENTS = 8 # Concurrent clients sending single-record requests to the server
+
+# Check the fields of a record, numbers (e.g. a price of 22950 sent as a JSON number) are converted to text
+# so that the cleaning functions can parse them. Raises ValueError on any other value
+def normalize_record(record):
+  normalized = {}
+  for field, value in record.items():
+    if field in RECORD_LIST_FIELDS:
+      if value is not None and not (isinstance(value, list) and all(isinstance(item, str) for item in value)):
+        raise ValueError(f"Field {field} must be a list of text")
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+      value = str(int(value)) if isinstance(value, float) and value.is_integer() else str(value) # 45210.0 isn't read as 452100
+    elif value is not None and not isinstance(value, str):
+      raise ValueError(f"Field {field} must be text or a number")
+    normalized[field] = value
+  return normalized
+
+# Scores raw listings with the saved price model. The model and the geodata are loaded once, then each batch of records is
+# cleaned and transformed column-wise like the pipeline does, except that no row is dropped: every record gets a prediction
+class PriceScorer:
+  def __init__(self, model_file_path=MODEL_FILE_PATH):
+    self.model = joblib.load(model_file_path)
+    self.use_postcode_reference = os.path.exists(POSTCODES_FILE_PATH)
+
+  # Clean and transform the records into the transformed columns, the Geonames cache is read but never fetched from
+  def prepare_records(self, records):
+    records = [normalize_record(record) for record in records]
+    df = pd.DataFrame.from_records(records, columns=RECORD_FIELDS).astype(object) # Text columns even if a field is empty in every record
+    df = clean_columns(df)
+    df = apply_transformation_rules(df, TRANSFORMATION_RULES, datetime.now(), drop_rows=False)
+    df = add_postcode_data(df, verbose=False) if self.use_postcode_reference else add_geonames_data(df, fetch_missing=False)
+    return apply_column_dtypes(df, TRANSFORMED_COLUMN_DTYPES)
+
+  # Predicted price of each record, in the order of the records
+  def predict(self, records):
+    if not records:
+      return np.empty(0)
+    return self.model.predict(build_features(self.prepare_records(records)))
+
+# Groups the records of concurrent requests into batches of up to MAX_BATCH_SIZE records, waiting at most MAX_BATCH_WAIT_MS
+# for more requests, so that the model runs once per batch rather than once per request. Batches are scored by one thread
+class MicroBatcher:
+  def __init__(self, scorer, max_batch_size=MAX_BATCH_SIZE, max_batch_wait_ms=MAX_BATCH_WAIT_MS):
+    self.scorer = scorer
+    self.max_batch_size = max_batch_size
+    self.max_batch_wait = max_batch_wait_ms / 1000
+    self.pending = queue.Queue()
+    self.latencies = deque(maxlen=LATENCY_WINDOW)
+    self.requests, self.records, self.batches = 0, 0, 0
+    self.lock = threading.Lock()
+    threading.Thread(target=self.score_batches, daemon=True).start()
+
+  # Score the records of one request, blocking until its batch is scored
+  def submit(self, records):
+    start = time.perf_counter()
+    future = Future()
+    self.pending.put((records, future))
+    predictions = future.result()
+    with self.lock:
+      self.latencies.append(time.perf_counter() - start)
+      self.requests += 1
+    return predictions
+
+  # Collect the pending requests into a batch: the first one, then any arriving before the batch is full or the wait is over
+  def collect_batch(self):
+    batch = [self.pending.get()]
+    size = len(batch[0][0])
+    deadline = time.perf_counter() + self.max_batch_wait
+    while size < self.max_batch_size:
+      timeout = deadline - time.perf_counter()
+      if timeout <= 0:
+        break
+      try:
+        batch.append(self.pending.get(timeout=timeout))
+      except queue.Empty:
+        break
+      size += len(batch[-1][0])
+    return batch
+
+  # Score each batch at once. If it fails, its requests are scored one by one so that only the failing ones get the exception
+  def score_batches(self):
+    while True:
+      batch = self.collect_batch()
+      try:
+        predictions = self.scorer.predict([record for records, _ in batch for record in records])
+      except Exception as e:
+        if len(batch) == 1:
+          batch[0][1].set_exception(e)
+        else:
+          for records, future in batch:
+            self.score_request(records, future)
+        continue
+      offset = 0
+      for records, future in batch:
+        future.set_result(predictions[offset:offset + len(records)])
+        offset += len(records)
+      with self.lock:
+        self.records += offset
+        self.batches += 1
+
+  def score_request(self, records, future):
+    try:
+      predictions = self.scorer.predict(records)
+    except Exception as e:
+      future.set_exception(e)
+      return
+    with self.lock:
+      self.records += len(records)
+      self.batches += 1
+    future.set_result(predictions)
+
+  # Request counts and latencies (from the request being queued to its predictions) over the last LATENCY_WINDOW requests
+  def get_metrics(self):
+    with self.lock:
+      latencies = np.array(self.latencies) * 1_000
+      metrics = {"requests": self.requests, "records": self.records, "batches": self.batches}
+    metrics["mean_batch_size"] = metrics["records"] / metrics["batches"] if metrics["batches"] else None
+    metrics["p50_latency_ms"] = float(np.percentile(latencies, 50)) if len(latencies) else None
+    metrics["p99_latency_ms"] = float(np.percentile(latencies, 99)) if len(latencies) else None
+    return metrics
+
+# HTTP server of the price model:
+# - POST /predict with a listing or a list of listings as JSON, returns {"predicted_prices": [...]} in the same order
+# - GET /metrics returns the request counts and latencies of the micro-batcher
+def create_server(batcher, host=SERVER_HOST, port=SERVER_PORT):
+  class ScoringHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, clients don't reconnect for every request
+
+    def send_json(self, status, body):
+      content = json.dumps(body).encode("utf-8")
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(content)))
+      self.end_headers()
+      self.wfile.write(content)
+
+    def do_GET(self):
+      if self.path == "/metrics":
+        self.send_json(200, batcher.get_metrics())
+      else:
+        self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+      try:
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+      except ValueError as e:
+        return self.send_json(400, {"error": f"Invalid JSON: {e}"})
+      if self.path != "/predict":
+        return self.send_json(404, {"error": f"Unknown path {self.path}"})
+      records = payload if isinstance(payload, list) else [payload]
+      if not all(isinstance(record, dict) for record in records):
+        return self.send_json(400, {"error": "Expected a listing or a list of listings as JSON objects"})
+      try:
+        records = [normalize_record(record) for record in records]
+      except ValueError as e:
+        return self.send_json(400, {"error": str(e)})
+      try:
+        predictions = batcher.submit(records)
+      except Exception as e:
+        return self.send_json(500, {"error": str(e)})
+      self.send_json(200, {"predicted_prices": [round(float(prediction)) for prediction in predictions]})
+
+    def log_message(self, format, *args):
+      pass # One line per request would cost more than scoring it
+
+  return ThreadingHTTPServer((host, port), ScoringHandler)
+
+# Serve the price model until interrupted, then print the latencies
+def serve(host=SERVER_HOST, port=SERVER_PORT):
+  batcher = MicroBatcher(PriceScorer())
+  server = create_server(batcher, host, port)
+  print(f"Serving the price model on http://{host}:{port} (POST /predict, GET /metrics)")
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    print(f"\t{batcher.get_metrics()}")
+
+### Benchmark ###
+
+# First BENCHMARK_RECORDS raw listings, as the spider yielded them
+def load_benchmark_records():
+  raw_file_size = get_raw_file_size()
+  chunks = read_raw_data_in_chunks(get_raw_sources(get_readable_segments(load_raw_manifest()), end=raw_file_size), chunk_size=BENCHMARK_RECORDS)
+  df = next(chunks, pd.DataFrame())
+  return df.astype(object).where(df.notna(), None).to_dict("records")
+
+def format_latencies(latencies):
+  latencies = np.array(latencies) * 1_000
+  return f"p50 {np.percentile(latencies, 50):.1f} ms, p99 {np.percentile(latencies, 99):.1f} ms"
+
+# Benchmark the batch throughput and the single-record latency of the scorer, then the latency of single-record requests
+# sent to the server by BENCHMARK_CLIENTS concurrent clients, which the micro-batcher scores together
+def run_benchmark():
+  print("Initiating price model benchmark...")
+  records = load_benchmark_records()
+  if not records:
+    print("\tNo raw data to benchmark on.")
+    return
+  start = time.perf_counter()
+  scorer = PriceScorer()
+  print(f"\tLoaded the model in {time.perf_counter() - start:.2f}s, scoring {len(records)} raw listings")
+  scorer.predict(records[:1]) # Warm-up
+
+  for batch_size in BENCHMARK_BATCH_SIZES:
+    start = time.perf_counter()
+    for i in range(0, len(records), batch_size):
+      scorer.predict(records[i:i + batch_size])
+    elapsed = time.perf_counter() - start
+    print(f"\tBatches of {batch_size}: {len(records) / elapsed:.0f} records/s")
+
+  single_records = records[:BENCHMARK_SINGLE_RECORDS]
+  latencies = []
+  for record in single_records:
+    start = time.perf_counter()
+    scorer.predict([record])
+    latencies.append(time.perf_counter() - start)
+  print(f"\tSingle records: {format_latencies(latencies)} ({len(latencies) / sum(latencies):.0f} records/s)")
+
+  batcher = MicroBatcher(scorer)
+  server = create_server(batcher, port=0) # Any free port
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  url = f"http://{SERVER_HOST}:{server.server_address[1]}/predict"
+  sessions = threading.local()
+
+  def send_request(record):
+    if not hasattr(sessions, "session"):
+      sessions.session = requests.Session()
+    start = time.perf_counter()
+    sessions.session.post(url, json=record).raise_for_status()
+    return time.perf_counter() - start
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=BENCHMARK_CLIENTS) as executor:
+    latencies = list(executor.map(send_request, single_records))
+  elapsed = time.perf_counter() - start
+  server.shutdown()
+  server.server_close()
+  print(f"\tServer, {BENCHMARK_CLIENTS} concurrent clients: {format_latencies(latencies)} ({len(latencies) / elapsed:.0f} records/s, "
+        f"{batcher.get_metrics()['mean_batch_size']:.1f} records per batch)")
+  print("\tPrice model benchmark completed!")
+
+# Serve the price model on SERVER_HOST:SERVER_PORT, pass --benchmark to benchmark it on the raw data instead
+if __name__ == "__main__":
+  if "--benchmark" in sys.argv:
+    run_benchmark()
+  else:
+    serve()
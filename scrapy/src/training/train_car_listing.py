@@ -0,0 +1,155 @@
+import os
+import sys
+import json
+import time
+from datetime import datetime
+import pandas as pd
+import numpy as np
+import joblib
+from sklearn.compose import ColumnTransformer, TransformedTargetRegressor
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.impute import SimpleImputer
+from sklearn.linear_model import Ridge
+from sklearn.model_selection import KFold, cross_validate
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "transformation"))
+from clean_car_listing import EQUIPMENT_FEATURES, read_table
+from transform_car_listing import TRANSFORMED_FILE_PATH, TRANSFORMED_COLUMN_DTYPES
+from dedup_car_listing import add_vehicle_cluster_ids, keep_latest_per_cluster
+
+# Define paths
+MODEL_FOLDER_PATH = "data/models"
+MODEL_FILE_PATH = os.path.join(MODEL_FOLDER_PATH, "price_model.joblib")
+METRICS_FILE_PATH = os.path.join(MODEL_FOLDER_PATH, "price_model_metrics.json")
+
+# Features of the price model, built from the transformed columns by build_features()
+TARGET_COLUMN = "price"
+CATEGORICAL_FEATURES = [
+  "manufacturer", "car", "fuel", "body_type", "gear_type", "drive_train", "used_or_new",
+  "emission_class", "upholstery", "car_color", "seller_type", "province"
+]
+NUMERIC_FEATURES = [
+  "km", "car_age_in_months", "engine_power_hp", "engine_size_cc", "empty_weight_kg", "co2_emission_g_per_km",
+  "electric_range", "previous_owners", "gears", "cylinders", "full_service_history", "years_active_on_platform", "lat", "lon"
+]
+MIN_CATEGORY_FREQUENCY = 5 # Categories seen in fewer listings are grouped together by the one-hot encoder
+
+# Training settings
+MODEL_KIND = "gradient_boosting" # Or "linear" for a ridge regression baseline
+CV_FOLDS = 5
+CV_JOBS = -1 # Folds fitted in parallel processes, -1 uses every core
+RANDOM_STATE = 0
+
+# Build the feature frame of the price model: categories as strings (missing ones included), numeric columns as float32
+# and the equipment flags as they are. Columns missing from df (e.g. older transformed data) are left empty
+# The frame is built in one go rather than column by column, as it is also built for every batch scored
+def build_features(df):
+  features = {}
+  for column in CATEGORICAL_FEATURES:
+    features[column] = df[column].astype(str).to_numpy() if column in df.columns else "nan"
+  for column in NUMERIC_FEATURES:
+    features[column] = df[column].to_numpy(dtype="float32", na_value=np.nan) if column in df.columns else np.float32(np.nan)
+  equipment = df.reindex(columns=EQUIPMENT_FEATURES, fill_value=0).to_numpy(dtype=np.uint8)
+  features.update(zip(EQUIPMENT_FEATURES, equipment.T))
+  return pd.DataFrame(features, index=df.index)
+
+# Price model: categories one-hot encoded, then gradient boosting (missing values are handled natively) or ridge regression
+# (missing values imputed and features scaled). Prices are modeled on a log scale, as errors grow with the price
+def build_model(kind=MODEL_KIND):
+  one_hot_encoder = OneHotEncoder(handle_unknown="infrequent_if_exist", min_frequency=MIN_CATEGORY_FREQUENCY, sparse_output=kind == "linear")
+  if kind == "gradient_boosting":
+    preprocessor = ColumnTransformer([("categorical", one_hot_encoder, CATEGORICAL_FEATURES)], remainder="passthrough")
+    regressor = HistGradientBoostingRegressor(max_iter=500, learning_rate=0.05, early_stopping=True, random_state=RANDOM_STATE)
+  elif kind == "linear":
+    preprocessor = ColumnTransformer([
+      ("categorical", one_hot_encoder, CATEGORICAL_FEATURES),
+      ("numeric", make_pipeline(SimpleImputer(strategy="median"), StandardScaler()), NUMERIC_FEATURES)
+    ], remainder="passthrough")
+    regressor = Ridge(alpha=1.0)
+  else:
+    raise ValueError(f"Unknown model kind: {kind}")
+  return TransformedTargetRegressor(regressor=make_pipeline(preprocessor, regressor), func=np.log, inverse_func=np.exp)
+
+# Load the listings to train on: the most recent listing of each vehicle, so that re-posted cars don't weigh more
+# and a vehicle can't be in both the training and the validation folds
+def load_training_data(df=None):
+  if df is None:
+    df = add_vehicle_cluster_ids(read_table(TRANSFORMED_FILE_PATH, column_dtypes=TRANSFORMED_COLUMN_DTYPES))
+  if "vehicle_cluster_id" in df.columns:
+    df = keep_latest_per_cluster(df)
+  return df.dropna(subset=[TARGET_COLUMN]).reset_index(drop=True)
+
+# Cross-validate the model with the folds fitted in parallel processes, returns the metrics of each fold
+def cross_validate_model(model, X, y):
+  scores = cross_validate(
+    model, X, y, cv=KFold(n_splits=CV_FOLDS, shuffle=True, random_state=RANDOM_STATE), n_jobs=CV_JOBS,
+    scoring={
+      "mae": "neg_mean_absolute_error",
+      "rmse": "neg_root_mean_squared_error",
+      "mape": "neg_mean_absolute_percentage_error",
+      "r2": "r2"
+    }
+  )
+  return pd.DataFrame({
+    "mae": -scores["test_mae"],
+    "rmse": -scores["test_rmse"],
+    "mape": -scores["test_mape"],
+    "r2": scores["test_r2"],
+    "fit_time": scores["fit_time"],
+    "score_time": scores["score_time"]
+  })
+
+# Save the fitted model and its metrics, the model is written to a temporary file first so a failed save keeps the previous one
+def save_model(model, metrics):
+  os.makedirs(MODEL_FOLDER_PATH, exist_ok=True)
+  temporary_file_path = f"{MODEL_FILE_PATH}.tmp"
+  joblib.dump(model, temporary_file_path)
+  os.replace(temporary_file_path, MODEL_FILE_PATH)
+  with open(METRICS_FILE_PATH, "w", encoding="utf-8") as file:
+    json.dump(metrics, file, indent=2)
+
+# Train the price model on the transformed data (df if given, else the saved transformed data): cross-validate it, fit it
+# on all listings and save it with its metrics. Returns the metrics
+def train_model(df=None, kind=MODEL_KIND):
+  print("Initiating price model training...")
+  df = load_training_data(df)
+  if len(df) < CV_FOLDS:
+    print(f"\tNot enough listings to train on ({len(df)}).")
+    return None
+  X, y = build_features(df), df[TARGET_COLUMN].astype("float64")
+  print(f"\tTraining a {kind} model on {len(X)} listings and {X.shape[1]} features")
+
+  start = time.perf_counter()
+  folds = cross_validate_model(build_model(kind), X, y)
+  cv_time = time.perf_counter() - start
+  cv_rows = len(X) * (CV_FOLDS - 1) # Each listing is in the training set of every fold but one
+  print(f"\tCross-validation: MAE {folds['mae'].mean():.0f} (± {folds['mae'].std():.0f}), RMSE {folds['rmse'].mean():.0f}, "
+        f"MAPE {folds['mape'].mean():.1%}, R² {folds['r2'].mean():.3f}")
+  print(f"\tCross-validation took {cv_time:.1f}s for {CV_FOLDS} folds ({cv_rows / cv_time:.0f} training rows/s, {folds['fit_time'].sum() / cv_time:.1f}x parallel speedup)")
+
+  start = time.perf_counter()
+  model = build_model(kind).fit(X, y)
+  training_time = time.perf_counter() - start
+  print(f"\tFinal model trained in {training_time:.1f}s")
+
+  metrics = {
+    "trained_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    "model": kind,
+    "rows": len(X),
+    "features": X.shape[1],
+    "cv_folds": CV_FOLDS,
+    "cv": {metric: {"mean": folds[metric].mean(), "std": folds[metric].std()} for metric in ["mae", "rmse", "mape", "r2"]},
+    "cv_time_seconds": cv_time,
+    "cv_training_rows_per_second": cv_rows / cv_time,
+    "training_time_seconds": training_time
+  }
+  save_model(model, metrics)
+  print(f"\tSaved the model to {MODEL_FILE_PATH} and its metrics to {METRICS_FILE_PATH}")
+  print("\tPrice model training completed!")
+  return metrics
+
+# Train the price model, pass --linear to train the ridge regression baseline instead of gradient boosting
+if __name__ == "__main__":
+  train_model(kind="linear" if "--linear" in sys.argv else MODEL_KIND)
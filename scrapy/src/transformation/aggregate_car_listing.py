@@ -0,0 +1,169 @@
+import os
+import sys
+import math
+from datetime import datetime
+import pandas as pd
+import numpy as np
+from clean_car_listing import DEDUP_COLUMNS, read_table
+from transform_car_listing import TRANSFORMED_FILE_PATH, TRANSFORMED_COLUMN_DTYPES
+
+# Define paths
+AGGREGATES_FOLDER_PATH = "data/aggregates"
+AGGREGATES_FILE_PATH = os.path.join(AGGREGATES_FOLDER_PATH, "market_price_aggregates.parquet")
+AGGREGATES_CSV_FILE_PATH = os.path.join(AGGREGATES_FOLDER_PATH, "market_price_aggregates.csv") # Only written with --csv, without the price sketches
+AGGREGATED_ROWS_FILE_PATH = os.path.join(AGGREGATES_FOLDER_PATH, "aggregated_rows.parquet") # Hashes of the transformed rows already aggregated
+
+# Aggregates are kept per group of these columns, the age bucket being car_age_in_months // AGE_BUCKET_MONTHS
+AGGREGATE_KEYS = ["manufacturer", "car", "fuel", "age_bucket"]
+AGE_BUCKET_MONTHS = 12
+AGGREGATE_COLUMNS_USED = ["manufacturer", "car", "fuel", "car_age_in_months", "price", "km", *DEDUP_COLUMNS]
+
+# Sums kept per group, from which the statistics are computed. New rows are aggregated by adding up their sums
+# (prices with km are the prices of the listings with a known km, used with the km sums for the price per km slope)
+AGGREGATE_SUM_COLUMNS = [
+  "listings", "price_sum", "price_squared_sum", "km_count", "km_sum", "km_squared_sum", "price_with_km_sum", "km_price_sum"
+]
+
+# Price quantile sketch: listings counted in logarithmic price bins, so that quantiles are within PRICE_SKETCH_RELATIVE_ERROR
+# of the exact ones and sketches are merged by adding them up. Prices outside the range are counted in the first or last bin
+PRICE_SKETCH_RELATIVE_ERROR = 0.01
+PRICE_SKETCH_RANGE = (100, 1_000_000)
+PRICE_SKETCH_GAMMA = (1 + PRICE_SKETCH_RELATIVE_ERROR) / (1 - PRICE_SKETCH_RELATIVE_ERROR)
+PRICE_SKETCH_BINS = math.ceil(math.log(PRICE_SKETCH_RANGE[1] / PRICE_SKETCH_RANGE[0], PRICE_SKETCH_GAMMA)) + 1
+PRICE_QUANTILES = {"p10_price": 0.1, "p25_price": 0.25, "median_price": 0.5, "p75_price": 0.75, "p90_price": 0.9}
+
+# Hash of the dedup columns of each row: the transformed data holds one row per hash, a row crawled again replaces
+# the previous one and is only aggregated once
+def hash_rows(df):
+  keys = pd.DataFrame({
+    column: df[column].to_numpy(dtype="float64", na_value=np.nan) if pd.api.types.is_numeric_dtype(df[column]) else df[column].astype(str).to_numpy(dtype=object)
+    for column in DEDUP_COLUMNS
+  })
+  return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+# Sketch bin of each price
+def get_price_sketch_bins(price):
+  bins = np.floor(np.log(np.maximum(price, PRICE_SKETCH_RANGE[0]) / PRICE_SKETCH_RANGE[0]) / np.log(PRICE_SKETCH_GAMMA))
+  return np.minimum(bins, PRICE_SKETCH_BINS - 1).astype(np.int64)
+
+# Price of a sketch bin, within PRICE_SKETCH_RELATIVE_ERROR of every price counted in it
+def get_price_sketch_values(bins):
+  return PRICE_SKETCH_RANGE[0] * PRICE_SKETCH_GAMMA ** bins * 2 * PRICE_SKETCH_GAMMA / (PRICE_SKETCH_GAMMA + 1)
+
+# Sums and price sketch of each group of the rows, indexed by AGGREGATE_KEYS
+def build_aggregates(df):
+  df = df.dropna(subset=["manufacturer", "car", "fuel", "car_age_in_months", "price"])
+  price = df["price"].to_numpy(dtype="float64", na_value=np.nan)
+  km = df["km"].to_numpy(dtype="float64", na_value=np.nan)
+  has_km = ~np.isnan(km)
+  km = np.where(has_km, km, 0)
+  rows = pd.DataFrame({
+    "manufacturer": df["manufacturer"].astype(str).to_numpy(),
+    "car": df["car"].astype(str).to_numpy(),
+    "fuel": df["fuel"].astype(str).to_numpy(),
+    "age_bucket": df["car_age_in_months"].to_numpy(dtype="int64") // AGE_BUCKET_MONTHS,
+    "listings": 1,
+    "price_sum": price,
+    "price_squared_sum": price ** 2,
+    "km_count": has_km.astype(np.int64),
+    "km_sum": km,
+    "km_squared_sum": km ** 2,
+    "price_with_km_sum": np.where(has_km, price, 0),
+    "km_price_sum": km * price
+  })
+  groups = rows.groupby(AGGREGATE_KEYS)
+  aggregates = groups[AGGREGATE_SUM_COLUMNS].sum()
+  sketches = np.zeros((len(aggregates), PRICE_SKETCH_BINS), dtype=np.int64)
+  np.add.at(sketches, (groups.ngroup().to_numpy(), get_price_sketch_bins(price)), 1)
+  aggregates["price_sketch"] = list(sketches)
+  return aggregates
+
+# Add up the sums and price sketches of two aggregates
+def merge_aggregates(aggregates, new_aggregates):
+  combined = pd.concat([aggregates, new_aggregates])
+  merged = combined[AGGREGATE_SUM_COLUMNS].groupby(level=AGGREGATE_KEYS).sum()
+  sketches = np.zeros((len(merged), PRICE_SKETCH_BINS), dtype=np.int64)
+  np.add.at(sketches, merged.index.get_indexer(combined.index), np.vstack(combined["price_sketch"].to_numpy()))
+  merged["price_sketch"] = list(sketches)
+  return merged
+
+# Statistics of each group: listings, mean and standard deviation of the price, price quantiles from the sketch
+# and the slope of the price by km (least squares, per 1,000 km)
+def summarize_aggregates(aggregates):
+  count = aggregates["listings"].to_numpy(dtype="float64")
+  summary = pd.DataFrame({"listings": aggregates["listings"]}, index=aggregates.index)
+  summary["mean_price"] = aggregates["price_sum"] / count
+  price_variance = (aggregates["price_squared_sum"] - aggregates["price_sum"] ** 2 / count).clip(lower=0)
+  summary["std_price"] = np.sqrt(price_variance / (count - 1)).where(count > 1)
+
+  cumulative_counts = np.cumsum(np.vstack(aggregates["price_sketch"].to_numpy()), axis=1)
+  for column, quantile in PRICE_QUANTILES.items():
+    bins = (cumulative_counts > (quantile * (count - 1))[:, None]).argmax(axis=1)
+    summary[column] = get_price_sketch_values(bins)
+
+  km_count = aggregates["km_count"]
+  km_variance = km_count * aggregates["km_squared_sum"] - aggregates["km_sum"] ** 2
+  km_price_covariance = km_count * aggregates["km_price_sum"] - aggregates["km_sum"] * aggregates["price_with_km_sum"]
+  summary["price_per_1000_km"] = (km_price_covariance / km_variance * 1_000).where(km_variance > 0)
+  return summary.round(2)
+
+# Load the saved aggregates, indexed by AGGREGATE_KEYS, and the hashes of the rows they include
+def load_aggregates():
+  if not os.path.exists(AGGREGATES_FILE_PATH) or not os.path.exists(AGGREGATED_ROWS_FILE_PATH):
+    return None, np.empty(0, dtype=np.uint64)
+  aggregates = pd.read_parquet(AGGREGATES_FILE_PATH, columns=[*AGGREGATE_KEYS, *AGGREGATE_SUM_COLUMNS, "price_sketch"])
+  row_hashes = pd.read_parquet(AGGREGATED_ROWS_FILE_PATH)["row_hash"].to_numpy()
+  return aggregates.set_index(AGGREGATE_KEYS), row_hashes
+
+# Save the statistics, sums and sketches of each group in one file, then the hashes of the rows aggregated
+# Both are written to temporary files first, so a failed run keeps the previous ones
+def save_aggregates(aggregates, row_hashes):
+  os.makedirs(AGGREGATES_FOLDER_PATH, exist_ok=True)
+  output = pd.concat([summarize_aggregates(aggregates), aggregates.drop(columns="listings")], axis=1).reset_index()
+  output["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+  output.to_parquet(f"{AGGREGATES_FILE_PATH}.tmp", index=False)
+  pd.DataFrame({"row_hash": row_hashes}).to_parquet(f"{AGGREGATED_ROWS_FILE_PATH}.tmp", index=False)
+  os.replace(f"{AGGREGATES_FILE_PATH}.tmp", AGGREGATES_FILE_PATH)
+  os.replace(f"{AGGREGATED_ROWS_FILE_PATH}.tmp", AGGREGATED_ROWS_FILE_PATH)
+  return output
+
+# Update the market price aggregates with the transformed rows that aren't aggregated yet: the rows of df if given
+# (e.g. the rows transformed by this run), else the saved transformed data. With full=True they are rebuilt from df
+# or the saved transformed data instead. Without saved aggregates, df only holds part of the transformed data,
+# so they are built from the saved transformed data. Returns the statistics of each group
+def aggregate_data(df=None, full=False, export_csv=False):
+  print("Initiating market price aggregation...")
+  aggregates, aggregated_row_hashes = (None, np.empty(0, dtype=np.uint64)) if full else load_aggregates()
+  if df is not None and aggregates is None and not full:
+    print("\tNo saved aggregates, aggregating the whole transformed data.")
+    df = None
+  elif df is not None and (df.empty or not set(DEDUP_COLUMNS) <= set(df.columns)):
+    print("\tNo new rows since the last run.")
+    return summarize_aggregates(aggregates) if aggregates is not None else None
+  if df is None:
+    if not os.path.exists(TRANSFORMED_FILE_PATH):
+      print(f"\t{TRANSFORMED_FILE_PATH} not found, run the transformation first.")
+      return None
+    df = read_table(TRANSFORMED_FILE_PATH, columns=list(dict.fromkeys(AGGREGATE_COLUMNS_USED)), column_dtypes=TRANSFORMED_COLUMN_DTYPES)
+
+  row_hashes = hash_rows(df)
+  new_rows = ~np.isin(row_hashes, aggregated_row_hashes)
+  print(f"\tRows to aggregate: {new_rows.sum()} of {len(df)}")
+  if not new_rows.any():
+    print("\tNo new rows since the last run.")
+    return summarize_aggregates(aggregates) if aggregates is not None else None
+
+  new_aggregates = build_aggregates(df[new_rows])
+  aggregates = new_aggregates if aggregates is None else merge_aggregates(aggregates, new_aggregates)
+  output = save_aggregates(aggregates, np.union1d(aggregated_row_hashes, row_hashes[new_rows]))
+  print(f"\tGroups: {len(aggregates)} ({len(new_aggregates)} updated), listings: {aggregates['listings'].sum()}")
+  if export_csv:
+    output.drop(columns="price_sketch").to_csv(AGGREGATES_CSV_FILE_PATH, index=False)
+    print(f"\tExported {AGGREGATES_FILE_PATH} to {AGGREGATES_CSV_FILE_PATH}")
+  print("\tMarket price aggregation completed!")
+  return summarize_aggregates(aggregates)
+
+# Update the market price aggregates with the new transformed rows, pass --full to rebuild them from the whole transformed data
+# and --csv to also export them as CSV
+if __name__ == "__main__":
+  aggregate_data(full="--full" in sys.argv, export_csv="--csv" in sys.argv)
@@ -1,12 +1,43 @@
 import json
 import pandas as pd
+import numpy as np
 import os
 import re
+import sys
+import gzip
+import hashlib
+from datetime import datetime
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 # Define paths
-RAW_FILE_PATH = "data/raw/car_listing.jsonl"
+RAW_FOLDER_PATH = "data/raw"
+RAW_MANIFEST_FILE_PATH = os.path.join(RAW_FOLDER_PATH, "manifest.jsonl") # Compressed raw segments written by the spider, one JSON line per segment
+RAW_FILE_PATH = os.path.join(RAW_FOLDER_PATH, "car_listing.jsonl") # Raw file appended to before the segments, still read if present
 TRANSFORMED_FOLDER_PATH = "data/transformed"
-os.makedirs(TRANSFORMED_FOLDER_PATH, exist_ok=True)
+CLEANED_FILE_PATH = os.path.join(TRANSFORMED_FOLDER_PATH, "cleaned_car_listing.parquet")
+CLEANED_CSV_FILE_PATH = os.path.join(TRANSFORMED_FOLDER_PATH, "cleaned_car_listing.csv") # Only written with --csv
+CLEANED_DELTA_FILE_PATH = os.path.join(TRANSFORMED_FOLDER_PATH, "cleaned_car_listing_delta.parquet") # Cleaned rows not yet picked up by the transformation
+CHECKPOINT_FILE_PATH = os.path.join(TRANSFORMED_FOLDER_PATH, "checkpoint.json")
+
+# Streaming settings
+CHUNK_SIZE = 50_000 # Raw lines parsed and cleaned at a time, None loads the whole file at once
+BATCH_SIZE = 100_000 # Rows read at a time when indexing, copying or exporting Parquet files
+DEDUP_COLUMNS = ["km", "price", "car", "listing_url"] # Rows with the same values are duplicates, the last one by timestamp is kept
+CHECKPOINT_HASH_BYTES = 4_096 # Raw bytes before the checkpoint offset that are hashed to detect a rewritten raw file
+
+KM_RANGE = (0, 400_000) # Kilometers outside this range are set to missing, in clean_columns() and clean_item()
+
+# Dtypes of the cleaned data, applied when it is cleaned and when it is loaded: category for low-cardinality strings,
+# nullable integers sized to the range of each column once clipped, other columns keep their dtype
+CLEANED_COLUMN_DTYPES = {
+  "manufacturer": "category", "car": "category", "fuel": "category", "gear_type": "category", "body_type": "category",
+  "used_or_new": "category", "drive_train": "category", "full_service_history": "category", "emission_class": "category",
+  "car_color": "category", "upholstery": "category", "seller_type": "category",
+  "price": "Int32", "lease_price_per_month": "Int32", "km": "Int32",
+  "previous_owners": "Int16", "gears": "Int16", "cylinders": "Int16", "electric_range": "Int16", "active_since": "Int16",
+  "engine_power_hp": "Int16", "engine_size_cc": "Int16", "empty_weight_kg": "Int16", "co2_emission_g_per_km": "Int16"
+}
 
 ### Define cleaning functions ###
 
@@ -30,10 +61,11 @@ def extract_hp(text):
 
 # Convert fuel consumption to km per liter from text
 def convert_fuel_consumption(text):
-  match = re.search(r'(\d+(\.\d+)?)', text)
-  if match:
-    liters_per_100km = float(match.group(1))
-    return round(100 / liters_per_100km, 2) if liters_per_100km else None
+  if text:
+    match = re.search(r'(\d+(\.\d+)?)', text)
+    if match:
+      liters_per_100km = float(match.group(1))
+      return round(100 / liters_per_100km, 2) if liters_per_100km else None
   return None
 
 # Extract year active on autoscout platform
@@ -43,40 +75,96 @@ def extract_year_active_on_autoscout(text):
     return int(match.group(1)) if match else None
   return None
 
+### Define column-wise cleaning functions ###
+# Vectorized counterparts of the functions above: same values (missing results are NaN), one regex pass per column
+
+# Precompiled patterns
+NON_DIGIT_PATTERN = re.compile(r'\D')
+HP_PATTERN = re.compile(r'(\d+)\s*hp')
+FUEL_CONSUMPTION_PATTERN = re.compile(r'(\d+(?:\.\d+)?)')
+YEAR_ACTIVE_PATTERN = re.compile(r'(\d{4})$')
+ZIP_CODE_PATTERN = re.compile(r'(\b\d{4}\s?[A-Za-z]{2}\b)', re.IGNORECASE)
+
+# Remove leading and trailing whitespaces from a column
+def clean_text_column(series):
+  return series.str.strip()
+
+# Extract numbers from a text column (all digits are concatenated, like extract_number)
+def extract_number_column(series):
+  digits = series.str.replace(NON_DIGIT_PATTERN, '', regex=True)
+  return pd.to_numeric(digits.where(digits != ''), errors="coerce")
+
+# Extract horsepower from a text column
+def extract_hp_column(series):
+  return pd.to_numeric(series.str.extract(HP_PATTERN, expand=False), errors="coerce")
+
+# Convert a fuel consumption text column to km per liter
+def convert_fuel_consumption_column(series):
+  liters_per_100km = pd.to_numeric(series.str.extract(FUEL_CONSUMPTION_PATTERN, expand=False), errors="coerce")
+  return (100 / liters_per_100km.where(liters_per_100km != 0)).round(2)
+
+# Extract year active on autoscout platform from a text column
+def extract_year_active_on_autoscout_column(series):
+  return pd.to_numeric(series.str.extract(YEAR_ACTIVE_PATTERN, expand=False), errors="coerce")
+
+# Keep values within [lower, upper], set the others to None
+def clip_to_range_column(series, lower, upper):
+  return series.where(series.between(lower, upper))
+
 # Extract zip code from seller address
 def extract_zip_code(df):
-
-  def extract_zip(address):
-      if not isinstance(address, str):
-          return None
-      match = re.search(r'\b\d{4}\s?[A-Za-z]{2}\b', address, re.IGNORECASE)
-      return match.group() if match else None
-  
   # Initialize the column for zip code
   df['zip_code'] = None
   
   # Handle rows where seller_type is "Private seller"
   private_seller_filter = df['seller_type'] == "Private seller"
-  df.loc[private_seller_filter, 'zip_code'] = df.loc[private_seller_filter, 'seller_address_1'].apply(extract_zip)
+  df.loc[private_seller_filter, 'zip_code'] = df.loc[private_seller_filter, 'seller_address_1'].str.extract(ZIP_CODE_PATTERN, expand=False)
   
   # Handle rows where seller_type is "Dealer"
   dealer_filter = df['seller_type'] == "Dealer"
-  df.loc[dealer_filter, 'zip_code'] = df.loc[dealer_filter, 'seller_address_2'].apply(extract_zip)
+  df.loc[dealer_filter, 'zip_code'] = df.loc[dealer_filter, 'seller_address_2'].str.extract(ZIP_CODE_PATTERN, expand=False)
 
   return df
 
-def extract_equipment_features(df):
-  # Define relevant features to keep based on your refined list, grouped under specific categories
-  relevant_features = {"360° camera", "Adaptive Cruise Control", "Ambient lighting", "Android Auto", "Apple CarPlay", "Armrest", "Blind spot monitor", "Bluetooth", "Distance warning system", "Electrically adjustable seats", "Electrically heated windshield", "Electronic parking brake", "Emergency brake assistant", "Induction charging for smartphones", "Keyless central door lock", "Lane departure warning system", "Leather seats", "Navigation system", "On-board computer", "Panorama roof", "Parking assist system camera", "Parking assist system self-steering", "Rain sensor", "Rear airbag", "Rear seat heating", "Seat heating", "Seat ventilation", "Shift paddles", "Speed limit control system", "Sport seats", "Sport suspension", "Start-stop system", "Sunroof", "Touch screen", "Traffic sign recognition", "WLAN / WiFi hotspot", "Xenon headlights"}
-
-  # Convert the 'equipment' list into a dictionary of binary indicators
-  equipment_df = df["equipment"].apply(lambda x: {feature: 1 if feature in (x or []) else 0 for feature in relevant_features})
+# Define relevant features to keep based on your refined list, grouped under specific categories
+EQUIPMENT_FEATURES = sorted({"360° camera", "Adaptive Cruise Control", "Ambient lighting", "Android Auto", "Apple CarPlay", "Armrest", "Blind spot monitor", "Bluetooth", "Distance warning system", "Electrically adjustable seats", "Electrically heated windshield", "Electronic parking brake", "Emergency brake assistant", "Induction charging for smartphones", "Keyless central door lock", "Lane departure warning system", "Leather seats", "Navigation system", "On-board computer", "Panorama roof", "Parking assist system camera", "Parking assist system self-steering", "Rain sensor", "Rear airbag", "Rear seat heating", "Seat heating", "Seat ventilation", "Shift paddles", "Speed limit control system", "Sport seats", "Sport suspension", "Start-stop system", "Sunroof", "Touch screen", "Traffic sign recognition", "WLAN / WiFi hotspot", "Xenon headlights"})
+
+# Match the equipment lists against a vocabulary in a single vectorized pass, instead of checking every feature in every list
+# Returns the row position and vocabulary position of each match, and the vocabulary (every item found, sorted, if None)
+def match_equipment(equipment, vocabulary=None):
+  items = equipment.reset_index(drop=True).explode().dropna() # One row per equipment item, indexed by the position of its listing
+  codes = pd.Categorical(items, categories=vocabulary)
+  matched = codes.codes >= 0
+  return items.index.to_numpy()[matched], codes.codes[matched], codes.categories.tolist()
+
+# Binary indicators of the vocabulary's features as a dense uint8 matrix (1 byte per flag), one row per listing
+def build_equipment_matrix(equipment, vocabulary=EQUIPMENT_FEATURES):
+  rows, codes, vocabulary = match_equipment(equipment, vocabulary)
+  matrix = np.zeros((len(equipment), len(vocabulary)), dtype=np.uint8)
+  matrix[rows, codes] = 1
+  return matrix, vocabulary
+
+# Binary indicators of every equipment item as a DataFrame of Sparse[uint8] columns, only the matches are stored
+# so the whole vocabulary (hundreds of items, most of them rare) fits in memory
+def build_sparse_equipment_frame(equipment, vocabulary=None):
+  rows, codes, vocabulary = match_equipment(equipment, vocabulary)
+  order = np.argsort(codes, kind="stable")
+  boundaries = np.searchsorted(codes[order], np.arange(len(vocabulary) + 1))
+  column = np.zeros(len(equipment), dtype=np.uint8) # Reused for every feature, so only one column is ever dense
+  columns = {}
+  for i, feature in enumerate(vocabulary):
+    feature_rows = rows[order[boundaries[i]:boundaries[i + 1]]]
+    column[feature_rows] = 1
+    columns[feature] = pd.arrays.SparseArray(column, fill_value=0)
+    column[feature_rows] = 0
+  return pd.DataFrame(columns, index=equipment.index)
 
-  # Convert the list of dictionaries into a DataFrame
-  equipment_df = pd.DataFrame(equipment_df.tolist())
+def extract_equipment_features(df):
+  # Convert the 'equipment' lists into binary indicators of the selected features
+  matrix, vocabulary = build_equipment_matrix(df["equipment"])
 
   # Concatenate the new features with the original DataFrame
-  df = pd.concat([df, equipment_df], axis=1)
+  df = pd.concat([df, pd.DataFrame(matrix, columns=vocabulary, index=df.index)], axis=1)
 
   return df
 
@@ -102,48 +190,304 @@ KNOWN_MANUFACTURERS = [
 KNOWN_MANUFACTURERS = sorted(KNOWN_MANUFACTURERS, key=len, reverse=True)
 
 # The structure of the website changed, and the car name is now in the 'manufacturer' column
-# This function splits the 'manufacturer' column into 'manufacturer' and 'car' again
+# This function splits the 'manufacturer' column into 'manufacturer' and 'car' again, with one regex pass over the column
+MERGED_MANUFACTURER_PATTERN = re.compile(r'^(' + '|'.join(re.escape(brand) for brand in KNOWN_MANUFACTURERS) + r')(.*)$', re.DOTALL)
 def fix_merged_manufacturer_model(df):
-  def split_manufacturer(row):
-    manufacturer = row.get('manufacturer')
-    car = row.get('car')
-
-    if pd.isnull(car) and isinstance(manufacturer, str):
-      for brand in KNOWN_MANUFACTURERS:
-        if manufacturer.startswith(brand):
-          model = manufacturer[len(brand):].strip()
-          return pd.Series([brand, model])
-    return pd.Series([manufacturer, car])
-
-  df[['manufacturer', 'car']] = df.apply(split_manufacturer, axis=1)
+  if "car" not in df.columns:
+    df["car"] = None
+  merged = df["car"].isna() & df["manufacturer"].map(lambda manufacturer: isinstance(manufacturer, str))
+  parts = df.loc[merged, "manufacturer"].astype(str).str.extract(MERGED_MANUFACTURER_PATTERN).dropna()
+  df["car"] = df["car"].astype(object)
+  df.loc[parts.index, "manufacturer"] = parts[0]
+  df.loc[parts.index, "car"] = parts[1].str.strip()
   return df
 
+# Clean the fields a listing's price depends on for a single raw item, with the row-wise functions: the counterpart of
+# clean_columns() for items handled one at a time as they are scraped (see pipelines.py)
+def clean_item(item):
+  manufacturer, car = clean_text(item.get("manufacturer")), item.get("car")
+  if car is None and isinstance(manufacturer, str):
+    match = MERGED_MANUFACTURER_PATTERN.match(manufacturer)
+    if match:
+      manufacturer, car = match.group(1), match.group(2).strip()
+  km = extract_number(item.get("km"))
+  try:
+    built_in = datetime.strptime(item.get("built_in") or "", "%m/%Y")
+  except ValueError:
+    built_in = None
+  return {
+    "manufacturer": manufacturer,
+    "car": car,
+    "price": extract_number(item.get("price")),
+    "km": km if km is not None and KM_RANGE[0] <= km <= KM_RANGE[1] else None,
+    "built_in": built_in
+  }
+
+
+### Read raw data ###
+
+# Read the manifest of the raw segments, in the order they were written
+def load_raw_manifest():
+  if not os.path.exists(RAW_MANIFEST_FILE_PATH):
+    return []
+  segments = []
+  with open(RAW_MANIFEST_FILE_PATH, "r", encoding="utf-8") as file:
+    for line in file:
+      try:
+        segment = json.loads(line)
+      except json.JSONDecodeError as e:
+        print(f"\tSkipping malformed manifest line: {e}")
+        continue
+      segment["path"] = os.path.join(RAW_FOLDER_PATH, segment["segment"])
+      segments.append(segment)
+  return segments
+
+def hash_file(file_path):
+  sha256 = hashlib.sha256()
+  with open(file_path, "rb") as file:
+    for block in iter(lambda: file.read(1 << 20), b""):
+      sha256.update(block)
+  return sha256.hexdigest()
+
+# Size of the legacy raw file up to its last newline: a line still being written (or cut off) is left for the next run
+# rather than skipped as malformed and checkpointed past
+def get_raw_file_size():
+  if not os.path.exists(RAW_FILE_PATH):
+    return 0
+  with open(RAW_FILE_PATH, "rb") as file:
+    end = file.seek(0, os.SEEK_END)
+    while end > 0:
+      start = max(end - (1 << 16), 0)
+      file.seek(start)
+      newline = file.read(end - start).rfind(b"\n")
+      if newline >= 0:
+        return start + newline + 1
+      end = start
+  return 0
+
+# Segments that can be read, the ones that are missing or don't match their checksum are skipped
+# Only these are recorded in the checkpoint, so a skipped segment is read by the first run after it's restored
+def get_readable_segments(segments):
+  readable_segments = []
+  for segment in segments:
+    if not os.path.exists(segment["path"]) or hash_file(segment["path"]) != segment["sha256"]:
+      print(f"\tSkipping raw segment {segment['segment']}: missing or checksum mismatch")
+      continue
+    readable_segments.append(segment)
+  return readable_segments
+
+# Raw data to read, as (file path, start, end) sources: the bytes of the legacy raw file between start and end, then the given
+# segments (see get_readable_segments())
+def get_raw_sources(segments, start=0, end=0):
+  sources = [(RAW_FILE_PATH, start, end)] if end > start else []
+  sources += [(segment["path"], 0, None) for segment in segments]
+  print(f"\tReading {len(sources)} raw files ({sum(segment['rows'] for segment in segments)} rows in {len(segments)} segments)")
+  return sources
+
+# Parse the raw sources lazily, yielding DataFrames of at most chunk_size rows (a single DataFrame if chunk_size is None)
+# Only the bytes between start and end of each source are read, compressed segments are read whole
+def read_raw_data_in_chunks(raw_sources, chunk_size=None):
+  records = []
+  for file_path, start, end in raw_sources:
+    with (gzip.open(file_path, "rb") if file_path.endswith(".gz") else open(file_path, "rb")) as file:
+      file.seek(start)
+      position = start
+      for line in file:
+        position += len(line)
+        if end is not None and position > end:
+          break
+        try:
+          records.append(json.loads(line))
+        except json.JSONDecodeError as e:
+          print(f"\tSkipping malformed JSON line: {e}")
+          continue
+        if len(records) == chunk_size:
+          yield pd.DataFrame(records)
+          records = []
+  if records:
+    yield pd.DataFrame(records)
+
+
+### Column dtypes ###
+
+# Cast a column to a dtype of the schema, integer values out of the dtype's range (or not whole) become missing instead of raising
+def cast_column(series, dtype):
+  dtype = pd.api.types.pandas_dtype(dtype)
+  if isinstance(dtype, pd.CategoricalDtype) or not pd.api.types.is_integer_dtype(dtype):
+    return series.astype(dtype)
+  values = pd.to_numeric(series.astype(object) if isinstance(series.dtype, pd.CategoricalDtype) else series, errors="coerce")
+  values = values.to_numpy(dtype="float64", na_value=np.nan)
+  bounds = np.iinfo(dtype.numpy_dtype)
+  valid = (values >= bounds.min) & (values <= bounds.max) & (values % 1 == 0) # False for missing values
+  integers = np.where(valid, values, 0).astype(dtype.numpy_dtype)
+  return pd.Series(pd.arrays.IntegerArray(integers, ~valid), index=series.index, name=series.name)
+
+# Cast the columns of df listed in column_dtypes
+def apply_column_dtypes(df, column_dtypes=CLEANED_COLUMN_DTYPES):
+  for column, dtype in column_dtypes.items():
+    if column in df.columns and df[column].dtype != dtype:
+      df[column] = cast_column(df[column], dtype)
+  return df
+
+# Memory used by a DataFrame in MB, including the strings it holds
+def get_memory_usage_mb(df):
+  return df.memory_usage(deep=True).sum() / 1024 ** 2
+
+
+### Read and write tables ###
+# Cleaned and transformed data are stored as Parquet files, CSV is only used for exports
+
+# Arrow type used to store a column, so that every chunk written to the same file has the same schema
+def infer_arrow_type(series):
+  if series.name in EQUIPMENT_FEATURES:
+    return pa.uint8()
+  if pd.api.types.is_bool_dtype(series):
+    return pa.bool_()
+  if pd.api.types.is_datetime64_any_dtype(series):
+    return pa.timestamp("ns")
+  if pd.api.types.is_extension_array_dtype(series) and pd.api.types.is_integer_dtype(series):
+    return pa.from_numpy_dtype(series.dtype.numpy_dtype) # Nullable integers of the dtype schemas keep their size
+  if series.dtype == np.float32:
+    return pa.float32()
+  if pd.api.types.is_numeric_dtype(series):
+    return pa.float64() # A chunk without missing values holds integers, another one floats
+  if pd.api.types.infer_dtype(series, skipna=True) in ("integer", "floating", "mixed-integer-float", "decimal"):
+    return pa.float64()
+  return pa.string()
+
+def build_arrow_schema(df):
+  return pa.schema([(column, infer_arrow_type(df[column])) for column in df.columns])
+
+# Write DataFrames or Arrow tables to a single Parquet file one chunk at a time, the first chunk defines the schema unless one is given
+class TableWriter:
+  def __init__(self, file_path, schema=None):
+    self.file_path = file_path
+    self.schema = schema
+    self.writer = None
+    self.rows = 0
+
+  def write(self, data):
+    if isinstance(data, pd.DataFrame):
+      if self.schema is None:
+        self.schema = build_arrow_schema(data)
+      data = pa.Table.from_pandas(data.reindex(columns=self.schema.names), schema=self.schema, preserve_index=False)
+    else:
+      if self.schema is None:
+        self.schema = data.schema
+      data = data.select(self.schema.names).cast(self.schema)
+    if self.writer is None:
+      os.makedirs(os.path.dirname(self.file_path) or ".", exist_ok=True)
+      self.writer = pq.ParquetWriter(self.file_path, self.schema)
+    self.writer.write_table(data)
+    self.rows += data.num_rows
+
+  def close(self):
+    if self.writer is not None:
+      self.writer.close()
+    elif self.schema is not None:
+      os.makedirs(os.path.dirname(self.file_path) or ".", exist_ok=True)
+      pq.write_table(self.schema.empty_table(), self.file_path) # Nothing was written, leave an empty file with the schema
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+# Write a DataFrame to a Parquet file
+def write_table(df, file_path):
+  with TableWriter(file_path) as writer:
+    writer.write(df)
+
+# Read a Parquet file (only the given columns and the rows matching the pyarrow filters if any), memory mapped, with the dtypes of column_dtypes
+def read_table(file_path, columns=None, column_dtypes=CLEANED_COLUMN_DTYPES, filters=None):
+  return apply_column_dtypes(pd.read_parquet(file_path, columns=columns, filters=filters, memory_map=True), column_dtypes)
+
+# Empty DataFrame with the columns of a Parquet file, with the dtypes of column_dtypes
+def read_empty_table(file_path, column_dtypes=CLEANED_COLUMN_DTYPES):
+  return apply_column_dtypes(pq.read_schema(file_path).empty_table().to_pandas(), column_dtypes)
+
+# Read a Parquet file batch by batch as Arrow record batches (only the given columns if any), memory mapped
+def iter_table_batches(file_path, columns=None):
+  yield from pq.ParquetFile(file_path, memory_map=True).iter_batches(batch_size=BATCH_SIZE, columns=columns)
+
+# Copy the rows of input_file flagged in keep (all rows if keep is None) to a TableWriter, without converting them to pandas
+def copy_table_rows(input_file, writer, keep=None):
+  position = 0
+  for batch in iter_table_batches(input_file):
+    if keep is not None:
+      batch = batch.filter(pa.array(keep[position:position + batch.num_rows]))
+    writer.write(pa.Table.from_batches([batch]))
+    position += batch.num_rows
+
+# Append the rows of new_file to output_file (Parquet files cannot be appended to, so output_file is rewritten)
+# The schema of new_file is used, so an output_file written with older column types is converted on the way
+def append_table(new_file, output_file):
+  appended_file = f"{output_file}.appending"
+  with TableWriter(appended_file, pq.read_schema(new_file)) as writer:
+    copy_table_rows(output_file, writer)
+    copy_table_rows(new_file, writer)
+  os.replace(appended_file, output_file)
+
+# Export a Parquet file to CSV, batch by batch
+def export_to_csv(file_path, csv_file_path):
+  pd.DataFrame(columns=pq.read_schema(file_path).names).to_csv(csv_file_path, index=False)
+  for batch in iter_table_batches(file_path):
+    batch.to_pandas().to_csv(csv_file_path, mode="a", header=False, index=False)
+  print(f"\tExported {file_path} to {csv_file_path}")
+
+
+### Checkpoint of the last run ###
+
+def load_checkpoint():
+  if os.path.exists(CHECKPOINT_FILE_PATH):
+    with open(CHECKPOINT_FILE_PATH, "r", encoding="utf-8") as file:
+      return json.load(file)
+  return {}
+
+def save_checkpoint(checkpoint):
+  os.makedirs(TRANSFORMED_FOLDER_PATH, exist_ok=True)
+  with open(CHECKPOINT_FILE_PATH, "w", encoding="utf-8") as file:
+    json.dump(checkpoint, file, indent=2)
+
+# Hash the raw bytes right before offset, so a raw file that was rewritten (not only appended to) is detected
+def hash_raw_file_tail(offset):
+  if not os.path.exists(RAW_FILE_PATH):
+    return None
+  with open(RAW_FILE_PATH, "rb") as file:
+    file.seek(max(offset - CHECKPOINT_HASH_BYTES, 0))
+    return hashlib.sha256(file.read(min(offset, CHECKPOINT_HASH_BYTES))).hexdigest()
+
+# Byte offset of the raw file where the last run stopped, None if the raw file no longer matches the checkpoint
+def get_raw_resume_offset(checkpoint, raw_file_size):
+  offset = checkpoint.get("raw_offset", 0)
+  if offset > raw_file_size or checkpoint.get("raw_tail_hash") != hash_raw_file_tail(offset):
+    return None
+  return offset
+
+# Record the raw data read so far: the legacy raw file up to raw_file_size and the given segments
+def update_raw_checkpoint(checkpoint, raw_file_size, segments):
+  checkpoint["raw_offset"] = raw_file_size
+  checkpoint["raw_tail_hash"] = hash_raw_file_tail(raw_file_size)
+  checkpoint["raw_segments"] = [segment["segment"] for segment in segments]
+
 
 ### Apply data cleaning rules ###
-def clean_data():
-  print("Initiating data cleaning...")
-  with open(RAW_FILE_PATH, "r", encoding="utf-8") as file:
-    try:
-      data = [json.loads(line) for line in file]
-    except json.JSONDecodeError as e:
-      print(f"Skipping malformed JSON line: {e}")
-      return data
-    
-  df = pd.DataFrame(data)
-  print(f"\tRows before any filters: {len(df)}")
 
+# Clean and type the columns, without dropping any row: the cleaning of listings that are scored rather than stored
+def clean_columns(df):
   # Call functions
-  df["manufacturer"] = df["manufacturer"].apply(clean_text)
-  df["price"] = df["price"].apply(extract_number)
-  df["lease_price_per_month"] = df["lease_price_per_month"].apply(extract_number)
-  df["km"] = df["km"].apply(extract_number)
-  df["electric_range"] = df["electric_range"].apply(extract_number)
-  df["engine_power_hp"] = df["engine_power"].apply(extract_hp)
-  df["engine_size_cc"] = df["engine_size"].apply(extract_number)
-  df["empty_weight_kg"] = df["empty_weight"].apply(extract_number)
-  df["fuel_consumption_km_per_l"] = df["fuel_consumption"].apply(convert_fuel_consumption)
-  df["co2_emission_g_per_km"] = df["co2_emission"].apply(extract_number)
-  df["active_since"] = df["active_since"].apply(extract_year_active_on_autoscout)
+  df["manufacturer"] = clean_text_column(df["manufacturer"])
+  df["price"] = extract_number_column(df["price"])
+  df["lease_price_per_month"] = extract_number_column(df["lease_price_per_month"])
+  df["km"] = extract_number_column(df["km"])
+  df["electric_range"] = extract_number_column(df["electric_range"])
+  df["engine_power_hp"] = extract_hp_column(df["engine_power"])
+  df["engine_size_cc"] = extract_number_column(df["engine_size"])
+  df["empty_weight_kg"] = extract_number_column(df["empty_weight"])
+  df["fuel_consumption_km_per_l"] = convert_fuel_consumption_column(df["fuel_consumption"])
+  df["co2_emission_g_per_km"] = extract_number_column(df["co2_emission"])
+  df["active_since"] = extract_year_active_on_autoscout_column(df["active_since"])
   df = extract_zip_code(df)
   df = extract_equipment_features(df)
   df = convert_data_types(df)
@@ -153,11 +497,11 @@ def clean_data():
   ### Other cleanings and business rules ###
 
   # Establish min and max thresholds for numerical columns
-  df["empty_weight_kg"] = df["empty_weight_kg"].apply(lambda x: x if 1_000 <= x <= 3_000 else None)
-  df["km"] = df["km"].apply(lambda x: x if 0 <= x <= 400_000 else None)
-  df["engine_power_hp"] = df["engine_power_hp"].apply(lambda x: x if 70 <= x <= 700 else None)  
-  df["engine_size_cc"] = df["engine_size_cc"].apply(lambda x: x if 600 <= x <= 8_000 else None)
-  df["co2_emission_g_per_km"] = df["co2_emission_g_per_km"].apply(lambda x: x if 0 <= x <= 300 else None)
+  df["empty_weight_kg"] = clip_to_range_column(df["empty_weight_kg"], 1_000, 3_000)
+  df["km"] = clip_to_range_column(df["km"], *KM_RANGE)
+  df["engine_power_hp"] = clip_to_range_column(df["engine_power_hp"], 70, 700)
+  df["engine_size_cc"] = clip_to_range_column(df["engine_size_cc"], 600, 8_000)
+  df["co2_emission_g_per_km"] = clip_to_range_column(df["co2_emission_g_per_km"], 0, 300)
 
   # Drop irrelevant columns according to exploration/explore_car_listing.py
   df.drop(columns=[
@@ -168,22 +512,172 @@ def clean_data():
     "seller_address_1", "seller_address_2", "upholstery_color"
   ], inplace=True)
 
-  # Drop irrelevant rows according to exploration/explore_car_listing.py
-  df.dropna(subset=["manufacturer", "car", "price", "km", "gear_type", "built_in", "fuel", "body_type", "zip_code"], inplace=True)
-  df.drop(df[df["gear_type"] == "Semi-automatic"].index, inplace=True)
-  df.drop(df[df["fuel"] == "Electric/Diesel"].index, inplace=True)
-  df.drop(df[df["emission_class"].isin(["Euro 4", "Euro 5", "Euro 6c"])].index, inplace=True)
-  print(f"\tRows after applying cleaning filters: {len(df)}")
+  return apply_column_dtypes(df)
+
+# Drop irrelevant rows according to exploration/explore_car_listing.py, all at once so that the DataFrame is copied only once
+def drop_irrelevant_rows(df):
+  irrelevant_rows = (
+    df[["manufacturer", "car", "price", "km", "gear_type", "built_in", "fuel", "body_type", "zip_code"]].isna().any(axis=1)
+    | (df["gear_type"] == "Semi-automatic")
+    | (df["fuel"] == "Electric/Diesel")
+    | df["emission_class"].isin(["Euro 4", "Euro 5", "Euro 6c"])
+  )
+  df.drop(df.index[irrelevant_rows], inplace=True)
+  return df
 
-  # Drop duplicate rows
+# Apply every cleaning rule that only depends on the row itself (everything except dropping duplicates)
+def clean_rows(df):
+  return drop_irrelevant_rows(clean_columns(df))
+
+# Drop duplicate rows, keeping the most recent one
+def drop_duplicate_listings(df):
   df.sort_values(by="timestamp", inplace=True)
-  df.drop_duplicates(subset=["km", "price", "car", "listing_url"], keep="last", inplace=True)
+  df.drop_duplicates(subset=DEDUP_COLUMNS, keep="last", inplace=True)
+  return df
+
+# Compact key index used to drop duplicates across chunks and files: a 64-bit hash of DEDUP_COLUMNS and the timestamp of each row
+def build_dedup_key_index(df):
+  keys = df[DEDUP_COLUMNS].astype({"km": "float64", "price": "float64", "car": str}) # Integer and float values must hash the same
+  return pd.DataFrame({
+    "key": pd.util.hash_pandas_object(keys, index=False).to_numpy(),
+    "timestamp": df["timestamp"].to_numpy()
+  })
+
+# Build the key index of a cleaned or transformed Parquet file, reading only the key columns
+def read_dedup_key_index(file_path):
+  key_index = [build_dedup_key_index(batch.to_pandas()) for batch in iter_table_batches(file_path, DEDUP_COLUMNS + ["timestamp"])]
+  return pd.concat(key_index, ignore_index=True) if key_index else pd.DataFrame({"key": pd.Series(dtype="uint64"), "timestamp": pd.Series(dtype="datetime64[ns]")})
+
+# Flag the rows to keep: the last one of each key by timestamp (on equal timestamps, the one further down the index)
+def keep_last_by_timestamp(key_index):
+  key_index = key_index.reset_index(drop=True).sort_values(by="timestamp", kind="stable")
+  keep = np.zeros(len(key_index), dtype=bool)
+  keep[key_index.drop_duplicates(subset="key", keep="last").index] = True
+  return keep
+
+# Merge the rows of new_file into output_file, keeping the last row by timestamp for each key
+# Only the key columns are converted to pandas, the other columns are copied as Arrow data (with the schema of new_file, like append_table)
+def merge_into_table(new_file, output_file):
+  existing_key_index = read_dedup_key_index(output_file)
+  keep = keep_last_by_timestamp(pd.concat([existing_key_index, read_dedup_key_index(new_file)], ignore_index=True))
+  keep_existing, keep_new = keep[:len(existing_key_index)], keep[len(existing_key_index):]
+
+  merged_file = f"{output_file}.merging"
+  with TableWriter(merged_file, pq.read_schema(new_file)) as writer:
+    copy_table_rows(output_file, writer, keep_existing)
+    copy_table_rows(new_file, writer, keep_new)
+  os.replace(merged_file, output_file)
+  print(f"\tMerged {keep_new.sum()} new rows into {output_file} ({(~keep_existing).sum()} existing rows replaced)")
+
+# Clean the raw sources chunk by chunk, so memory depends on chunk_size and on the key index rather than on the raw data size
+def clean_data_in_chunks(output_file, chunk_size, raw_sources):
+  staging_file = f"{output_file}.staging"
+  key_index = []
+  rows_before = 0
+  largest_chunk_mb = 0
+
+  # First pass: clean each chunk and append it to a staging file
+  with TableWriter(staging_file) as staging:
+    for chunk in read_raw_data_in_chunks(raw_sources, chunk_size):
+      rows_before += len(chunk)
+      chunk = clean_rows(chunk)
+      staging.write(chunk) # The first chunk defines the columns of the output
+      key_index.append(build_dedup_key_index(chunk))
+      largest_chunk_mb = max(largest_chunk_mb, get_memory_usage_mb(chunk))
+
+  print(f"\tRows before any filters: {rows_before}")
+  print(f"\tRows after applying cleaning filters: {staging.rows}")
+  if not key_index:
+    print("\tNo raw data to clean.")
+    return
+
+  # Drop duplicates on the key index only
+  key_index = pd.concat(key_index, ignore_index=True) # Index is the row position in the staging file
+  keep = keep_last_by_timestamp(key_index)
+  print(f"\tRows after dropping duplicates: {keep.sum()}")
+  print(f"\tMemory usage: {largest_chunk_mb:.1f} MB for the largest cleaned chunk, {get_memory_usage_mb(key_index):.1f} MB for the key index")
+
+  # Second pass: copy the rows to keep from the staging file to the output file
+  with TableWriter(output_file) as writer:
+    copy_table_rows(staging_file, writer, keep)
+  os.remove(staging_file)
+
+# Clean the raw sources all at once, returning the cleaned DataFrame
+def clean_raw_frame(raw_sources):
+  df = pd.concat(read_raw_data_in_chunks(raw_sources), ignore_index=True)
+  print(f"\tRows before any filters: {len(df)}")
+  df = clean_rows(df)
+  print(f"\tRows after applying cleaning filters: {len(df)}")
+  df = drop_duplicate_listings(df)
   print(f"\tRows after dropping duplicates: {len(df)}")
+  print(f"\tMemory usage of the cleaned data: {get_memory_usage_mb(df):.1f} MB")
+  return df
 
-  ### Save cleaned data as CSV ###
-  df.to_csv(os.path.join(TRANSFORMED_FOLDER_PATH, "cleaned_car_listing.csv"), index=False)
+# Clean the raw sources into output_file, streaming them in chunks of chunk_size rows (or all at once if chunk_size is None)
+def clean_raw_data(output_file, chunk_size, raw_sources):
+  if chunk_size:
+    clean_data_in_chunks(output_file, chunk_size, raw_sources)
+  else:
+    write_table(clean_raw_frame(raw_sources), output_file)
+
+# Record a full run in the checkpoint: the transformation has to start over as well
+def reset_checkpoint_after_full_run(checkpoint):
+  checkpoint["pending_full_transform"] = True
+  if os.path.exists(CLEANED_DELTA_FILE_PATH):
+    os.remove(CLEANED_DELTA_FILE_PATH)
+
+# Clean the raw data. With incremental=True, only the raw segments (and legacy raw lines) added since the last run are cleaned
+# and merged into the existing output
+# With in_memory=True, all the raw data is cleaned at once and returned (and only saved if persist=True), for the next stage to use directly
+def clean_data(chunk_size=CHUNK_SIZE, incremental=True, export_csv=False, in_memory=False, persist=True):
+  print("Initiating data cleaning...")
+  checkpoint = load_checkpoint()
+  # Lines appended and segments registered while cleaning are left for the next run
+  raw_file_size = get_raw_file_size()
+  segments = load_raw_manifest()
+
+  if in_memory:
+    segments = get_readable_segments(segments)
+    df = clean_raw_frame(get_raw_sources(segments, end=raw_file_size))
+    if persist:
+      write_table(df, CLEANED_FILE_PATH)
+      reset_checkpoint_after_full_run(checkpoint)
+      update_raw_checkpoint(checkpoint, raw_file_size, segments)
+      save_checkpoint(checkpoint)
+    print("\tData cleaning completed!")
+    return df
+
+  start = get_raw_resume_offset(checkpoint, raw_file_size) if incremental and os.path.exists(CLEANED_FILE_PATH) else None
+  cleaned_segments = set(checkpoint.get("raw_segments", []))
+  if start is None:
+    segments = get_readable_segments(segments)
+    clean_raw_data(CLEANED_FILE_PATH, chunk_size, get_raw_sources(segments, end=raw_file_size))
+    reset_checkpoint_after_full_run(checkpoint)
+  else:
+    new_segments = get_readable_segments([segment for segment in segments if segment["segment"] not in cleaned_segments])
+    segments = [segment for segment in segments if segment["segment"] in cleaned_segments] + new_segments
+    if start == raw_file_size and not new_segments:
+      print("\tNo new raw data since the last run.")
+    else:
+      # Incremental run: clean the new segments and lines only, then merge them into the cleaned data and queue them for the transformation
+      print(f"\tResuming from byte {start} of {raw_file_size} and {len(new_segments)} new raw segments")
+      new_file = f"{CLEANED_FILE_PATH}.new"
+      clean_raw_data(new_file, chunk_size, get_raw_sources(new_segments, start, raw_file_size))
+      if os.path.exists(new_file):
+        merge_into_table(new_file, CLEANED_FILE_PATH)
+        if os.path.exists(CLEANED_DELTA_FILE_PATH):
+          append_table(new_file, CLEANED_DELTA_FILE_PATH)
+          os.remove(new_file)
+        else:
+          os.replace(new_file, CLEANED_DELTA_FILE_PATH)
+
+  update_raw_checkpoint(checkpoint, raw_file_size, segments)
+  save_checkpoint(checkpoint)
+
+  if export_csv and os.path.exists(CLEANED_FILE_PATH):
+    export_to_csv(CLEANED_FILE_PATH, CLEANED_CSV_FILE_PATH)
   print("\tData cleaning completed!")
 
-# Run cleaning function
+# Run cleaning function, pass --full to clean the whole raw file again and --csv to also export the cleaned data as CSV
 if __name__ == "__main__":
-  clean_data()
+  clean_data(incremental="--full" not in sys.argv, export_csv="--csv" in sys.argv)
@@ -0,0 +1,222 @@
+import os
+import sys
+import pandas as pd
+import numpy as np
+import pyarrow.parquet as pq
+from clean_car_listing import EQUIPMENT_FEATURES, read_table, write_table, export_to_csv
+from transform_car_listing import TRANSFORMED_FOLDER_PATH, TRANSFORMED_FILE_PATH, TRANSFORMED_COLUMN_DTYPES
+
+# Define paths
+DUPLICATE_LABELS_FILE_PATH = "data/reference/duplicate_labels.csv" # Labeled pairs of listings: listing_url_1, listing_url_2, is_duplicate (0 or 1), like tests/fixtures/duplicate_labels.csv
+VEHICLE_CLUSTERS_FILE_PATH = os.path.join(TRANSFORMED_FOLDER_PATH, "vehicle_clusters.parquet") # vehicle_cluster_id of every listing_url and block clustered so far
+VEHICLE_CLUSTERS_CSV_FILE_PATH = os.path.join(TRANSFORMED_FOLDER_PATH, "vehicle_clusters.csv") # Only written with --csv
+VEHICLE_CLUSTERS_COLUMN_DTYPES = {"listing_url": "object", "manufacturer": "object", "block_key": "uint64", "vehicle_cluster_id": "object"}
+
+# Near-duplicate settings
+# Listings can only be duplicates of listings in the same block, found with a hash of these columns
+BLOCK_COLUMNS = ["manufacturer", "car", "built_in", "fuel"]
+# Columns the near duplicates are found on, the only ones read by incremental runs
+DEDUP_INPUT_COLUMNS = BLOCK_COLUMNS + ["km", "price", "engine_power_hp"] + EQUIPMENT_FEATURES + ["listing_url", "timestamp"]
+# Within a block, listings are sorted by km and each one is compared to the next DEDUP_WINDOW ones, so the comparisons grow linearly
+DEDUP_WINDOW = 5
+# Listings are the same vehicle if their km and prices are close, their hp are equal (or unknown) and their equipment barely differs
+DEDUP_TOLERANCES = {
+  "km": 2_000, # Absolute, a re-posted car is driven a little in between
+  "price": 0.05, # Relative to the lower price, dealers and re-posts change the price a bit
+  "equipment": 2 # Equipment features present in one listing and not in the other
+}
+# Tolerances evaluated by evaluate_dedup() on the labeled pairs, from strict to loose
+DEDUP_EVALUATION_GRID = [
+  {"km": 0, "price": 0, "equipment": 0},
+  {"km": 500, "price": 0.02, "equipment": 1},
+  DEDUP_TOLERANCES,
+  {"km": 5_000, "price": 0.1, "equipment": 4},
+  {"km": 10_000, "price": 0.2, "equipment": 8}
+]
+
+# Hash of the block columns of each listing. Categories hash like their values, but dates hash by their unit,
+# so built_in is converted to the unit of the transformed data for the keys saved with the vehicle clusters to match
+def build_block_keys(df):
+  return pd.util.hash_pandas_object(df[BLOCK_COLUMNS].astype({"built_in": "datetime64[ns]"}), index=False).to_numpy()
+
+# Equipment features of each listing packed as bits (5 bytes for 37 features), so that two listings are compared with a XOR
+def build_equipment_signatures(df):
+  features = [feature for feature in EQUIPMENT_FEATURES if feature in df.columns]
+  return np.packbits(df[features].to_numpy(dtype=np.uint8), axis=1)
+
+# Label the connected components of the graph of n nodes with edges (a, b), each node gets the smallest node of its component
+# Each pass links the root of every edge's larger label to the smaller one and then shortcuts every node to its root,
+# edges already inside a component are dropped, so it takes a few vectorized passes over a shrinking set of edges
+def label_connected_components(n, a, b):
+  labels = np.arange(n)
+  while len(a):
+    label_a, label_b = labels[a], labels[b]
+    linked = label_a != label_b
+    a, b, label_a, label_b = a[linked], b[linked], label_a[linked], label_b[linked]
+    np.minimum.at(labels, np.maximum(label_a, label_b), np.minimum(label_a, label_b))
+    while (labels != labels[labels]).any():
+      labels = labels[labels]
+  return labels
+
+# Find the pairs of near-duplicate listings: rows of the same block within DEDUP_WINDOW positions by km, that match the tolerances
+# Rows of the same listing_url are always paired. Returns the positions of the pairs as two arrays
+def find_duplicate_pairs(df, tolerances=DEDUP_TOLERANCES):
+  block_keys = build_block_keys(df)
+  km = df["km"].to_numpy(dtype=float, na_value=np.nan)
+  price = df["price"].to_numpy(dtype=float, na_value=np.nan)
+  hp = df["engine_power_hp"].to_numpy(dtype=float, na_value=np.nan)
+  signatures = build_equipment_signatures(df)
+
+  order = np.lexsort((km, block_keys))
+  pairs_a, pairs_b = [], []
+  for offset in range(1, DEDUP_WINDOW + 1):
+    a, b = order[:-offset], order[offset:]
+    is_duplicate = (
+      (block_keys[a] == block_keys[b])
+      & (np.abs(km[a] - km[b]) <= tolerances["km"])
+      & (np.abs(price[a] - price[b]) <= tolerances["price"] * np.fmin(price[a], price[b]))
+      & ((hp[a] == hp[b]) | np.isnan(hp[a]) | np.isnan(hp[b]))
+      & (np.bitwise_count(signatures[a] ^ signatures[b]).sum(axis=1) <= tolerances["equipment"])
+    )
+    pairs_a.append(a[is_duplicate])
+    pairs_b.append(b[is_duplicate])
+
+  # Rows of the same listing (price or km changed between crawls) are the same vehicle
+  listing_codes = pd.factorize(df["listing_url"])[0]
+  order = np.argsort(listing_codes, kind="stable")
+  same_listing = listing_codes[order[:-1]] == listing_codes[order[1:]]
+  pairs_a.append(order[:-1][same_listing])
+  pairs_b.append(order[1:][same_listing])
+  return np.concatenate(pairs_a), np.concatenate(pairs_b)
+
+# Assign a vehicle_cluster_id to every listing, shared by its near duplicates
+# A cluster keeps the ID known_cluster_ids (indexed by listing_url) holds for its first listing by timestamp that has one, so the ID
+# doesn't change when the cluster's first row is crawled again or when listings join it. If a cluster split, the part holding the first
+# listing keeps the ID. Clusters without a known ID get a hash of the listing_url of their first listing
+def assign_vehicle_clusters(df, tolerances=DEDUP_TOLERANCES, known_cluster_ids=None):
+  labels = label_connected_components(len(df), *find_duplicate_pairs(df, tolerances))
+  clusters = pd.DataFrame({"label": labels, "timestamp": df["timestamp"].to_numpy(), "listing_url": df["listing_url"].to_numpy()})
+  clusters = clusters.sort_values(by=["timestamp", "listing_url"])
+  first_listing_urls = clusters.drop_duplicates(subset="label").set_index("label")["listing_url"]
+  cluster_ids = pd.util.hash_array(first_listing_urls.to_numpy(dtype=object), categorize=False)
+  cluster_ids = pd.Series(np.char.mod("%016x", cluster_ids), index=first_listing_urls.index, dtype=object)
+  if known_cluster_ids is not None and not known_cluster_ids.empty:
+    clusters["known_cluster_id"] = clusters["listing_url"].map(known_cluster_ids)
+    known = clusters.dropna(subset="known_cluster_id").drop_duplicates(subset="label").drop_duplicates(subset="known_cluster_id")
+    cluster_ids.update(known.set_index("label")["known_cluster_id"])
+  df["vehicle_cluster_id"] = cluster_ids.reindex(labels).to_numpy(dtype=object)
+  return df
+
+# vehicle_cluster_id saved for each listing_url and block, empty if nothing was clustered yet
+def load_vehicle_clusters():
+  if os.path.exists(VEHICLE_CLUSTERS_FILE_PATH):
+    return read_table(VEHICLE_CLUSTERS_FILE_PATH, column_dtypes=VEHICLE_CLUSTERS_COLUMN_DTYPES)
+  return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in VEHICLE_CLUSTERS_COLUMN_DTYPES.items()})
+
+# Upsert the clustered listings into the saved vehicle clusters, one row per listing_url and block
+def save_vehicle_clusters(vehicle_clusters, clustered, export_csv=False):
+  clustered = pd.DataFrame({
+    "listing_url": clustered["listing_url"].to_numpy(dtype=object),
+    "manufacturer": clustered["manufacturer"].to_numpy(dtype=object),
+    "block_key": build_block_keys(clustered),
+    "vehicle_cluster_id": clustered["vehicle_cluster_id"].to_numpy(dtype=object)
+  })
+  vehicle_clusters = pd.concat([vehicle_clusters, clustered], ignore_index=True).drop_duplicates(subset=["listing_url", "block_key"], keep="last")
+  vehicle_clusters["block_key"] = vehicle_clusters["block_key"].astype("UInt64") # Stored as uint64, numpy integers are stored as float64
+  write_table(vehicle_clusters, VEHICLE_CLUSTERS_FILE_PATH)
+  if export_csv:
+    export_to_csv(VEHICLE_CLUSTERS_FILE_PATH, VEHICLE_CLUSTERS_CSV_FILE_PATH)
+
+# Add the saved vehicle_cluster_id of each listing, rows of a listing_url always share the same vehicle
+def add_vehicle_cluster_ids(df):
+  vehicle_clusters = load_vehicle_clusters()
+  if not vehicle_clusters.empty:
+    cluster_ids = vehicle_clusters.drop_duplicates(subset="listing_url", keep="last").set_index("listing_url")["vehicle_cluster_id"]
+    df["vehicle_cluster_id"] = df["listing_url"].map(cluster_ids).fillna(df["listing_url"]) # Listings not clustered yet are their own vehicle
+  return df
+
+# Read the transformed rows that new_rows can be near duplicates of: the rows of their blocks, and of every block holding a cluster
+# that one of these rows belongs to (a listing_url in several blocks links them), found on the saved vehicle clusters
+# Only the rows of the blocks' manufacturers and the DEDUP_INPUT_COLUMNS are read
+def read_affected_listings(new_rows, vehicle_clusters):
+  block_keys = set(build_block_keys(new_rows).tolist())
+  manufacturers = set(new_rows["manufacturer"].dropna())
+  listing_urls = set(new_rows["listing_url"])
+  while True:
+    linked = vehicle_clusters["block_key"].isin(block_keys) | vehicle_clusters["listing_url"].isin(listing_urls)
+    linked = vehicle_clusters[vehicle_clusters["vehicle_cluster_id"].isin(vehicle_clusters.loc[linked, "vehicle_cluster_id"])]
+    if set(linked["block_key"]) <= block_keys:
+      break
+    block_keys |= set(linked["block_key"])
+    manufacturers |= set(linked["manufacturer"].dropna())
+
+  columns = [column for column in DEDUP_INPUT_COLUMNS if column in pq.read_schema(TRANSFORMED_FILE_PATH).names]
+  listings = read_table(TRANSFORMED_FILE_PATH, columns, TRANSFORMED_COLUMN_DTYPES, filters=[("manufacturer", "in", sorted(manufacturers))])
+  return listings[np.isin(build_block_keys(listings), np.fromiter(block_keys, dtype=np.uint64))].reset_index(drop=True)
+
+# Keep the most recent listing of each vehicle cluster
+def keep_latest_per_cluster(df):
+  return df.sort_values(by="timestamp").drop_duplicates(subset="vehicle_cluster_id", keep="last")
+
+# Precision and recall of the near-duplicate detection on the labeled pairs, for each tolerances of DEDUP_EVALUATION_GRID
+def evaluate_dedup(df, labels_file_path=DUPLICATE_LABELS_FILE_PATH):
+  labels = pd.read_csv(labels_file_path)
+  results = []
+  for tolerances in DEDUP_EVALUATION_GRID:
+    cluster_ids = assign_vehicle_clusters(df.copy(), tolerances).drop_duplicates(subset="listing_url").set_index("listing_url")["vehicle_cluster_id"]
+    pairs = labels.assign(
+      cluster_id_1=labels["listing_url_1"].map(cluster_ids),
+      cluster_id_2=labels["listing_url_2"].map(cluster_ids)
+    ).dropna(subset=["cluster_id_1", "cluster_id_2"]) # Labeled listings that aren't in the data are skipped
+    predicted = pairs["cluster_id_1"] == pairs["cluster_id_2"]
+    actual = pairs["is_duplicate"] == 1
+    true_positives = (predicted & actual).sum()
+    results.append({
+      **tolerances,
+      "pairs": len(pairs),
+      "precision": true_positives / predicted.sum() if predicted.any() else np.nan,
+      "recall": true_positives / actual.sum() if actual.any() else np.nan
+    })
+  return pd.DataFrame(results)
+
+# Cluster the near-duplicate listings of the transformed data and save their vehicle_cluster_id in VEHICLE_CLUSTERS_FILE_PATH
+# If df is given with in_memory=True, it is the whole transformed data and is clustered instead of the saved one (the clusters are
+# only saved if persist=True). Otherwise df holds the rows transformed by this run: only the rows they can be near duplicates of are
+# clustered again, and those rows are returned with their cluster IDs. Without df, the whole transformed data is clustered
+# Listings keep the cluster IDs saved by the previous runs
+def dedup_data(df=None, in_memory=False, export_csv=False, persist=True):
+  print("Initiating near-duplicate detection...")
+  vehicle_clusters = load_vehicle_clusters()
+  incremental = not in_memory and df is not None and not vehicle_clusters.empty
+  if in_memory and df is not None:
+    listings = df
+  elif not os.path.exists(TRANSFORMED_FILE_PATH):
+    print(f"\t{TRANSFORMED_FILE_PATH} not found, run the transformation first.")
+    return df
+  elif incremental and df.empty:
+    print("\tNo new transformed data since the last run.")
+    return df
+  elif incremental:
+    listings = read_affected_listings(df, vehicle_clusters)
+  else:
+    listings = read_table(TRANSFORMED_FILE_PATH, column_dtypes=TRANSFORMED_COLUMN_DTYPES)
+  known_cluster_ids = vehicle_clusters.drop_duplicates(subset="listing_url", keep="last").set_index("listing_url")["vehicle_cluster_id"]
+  clustered = assign_vehicle_clusters(listings, known_cluster_ids=known_cluster_ids)
+  print(f"\tListings clustered: {len(clustered)}, vehicles: {clustered['vehicle_cluster_id'].nunique()}")
+
+  if persist:
+    save_vehicle_clusters(vehicle_clusters, clustered, export_csv)
+  print("\tNear-duplicate detection completed!")
+
+  if in_memory or df is None:
+    return clustered
+  cluster_ids = clustered.drop_duplicates(subset="listing_url").set_index("listing_url")["vehicle_cluster_id"]
+  return df.assign(vehicle_cluster_id=df["listing_url"].map(cluster_ids))
+
+# Run near-duplicate detection, pass --csv to also export the vehicle clusters as CSV
+# and --evaluate to print the precision and recall of each tolerances on the labeled pairs instead
+if __name__ == "__main__":
+  if "--evaluate" in sys.argv:
+    print(evaluate_dedup(read_table(TRANSFORMED_FILE_PATH, column_dtypes=TRANSFORMED_COLUMN_DTYPES)).to_string(index=False))
+  else:
+    dedup_data(export_csv="--csv" in sys.argv)
@@ -1,9 +1,18 @@
 import pandas as pd
 import os
+import sys
+import time
+import sqlite3
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
+from clean_car_listing import CLEANED_FILE_PATH, CLEANED_DELTA_FILE_PATH, CLEANED_COLUMN_DTYPES, load_checkpoint, save_checkpoint, apply_column_dtypes, get_memory_usage_mb, read_table, read_empty_table, write_table, merge_into_table, export_to_csv
 
 # Load environment variables from .env file
 load_dotenv()  
@@ -11,162 +20,341 @@ GEONAMES_USERNAME = os.getenv("GEONAMES_USERNAME")
 
 # Define paths
 TRANSFORMED_FOLDER_PATH = "data/transformed"
+TRANSFORMED_FILE_PATH = os.path.join(TRANSFORMED_FOLDER_PATH, "transformed_car_listing.parquet")
+TRANSFORMED_CSV_FILE_PATH = os.path.join(TRANSFORMED_FOLDER_PATH, "transformed_car_listing.csv") # Only written with --csv
 
-# Function to fetch Geonames data
-def fetch_geonames_data(zip_code):
-  url = "http://api.geonames.org/postalCodeLookupJSON"
+# Dtypes of the transformed data: the cleaned ones, plus the columns added or changed by the transformation
+TRANSFORMED_COLUMN_DTYPES = {
+  **CLEANED_COLUMN_DTYPES,
+  "car_age_in_months": "Int16", "full_service_history": "Int8", "years_active_on_platform": "Int16",
+  "city": "category", "province": "category",
+  "lat": "float32", "lon": "float32" # About 1 m of precision
+}
+
+# Geonames settings
+GEONAMES_URL = os.getenv("GEONAMES_URL", "http://api.geonames.org/postalCodeLookupJSON") # Can point to a local stub server
+GEONAMES_MAX_WORKERS = 8 # Concurrent lookups, also the size of the HTTP connection pool
+GEONAMES_REQUESTS_PER_SECOND = 5 # Rate limit across all workers, None to disable
+GEONAMES_TIMEOUT = 10 # Seconds
+GEONAMES_MAX_RETRIES = 3 # Retries on connection errors and 429/5xx responses, with exponential backoff
+GEONAMES_BACKOFF_FACTOR = 1 # Seconds
+GEONAMES_MISS_TTL_DAYS = 30 # Zip codes unknown to Geonames are looked up again after this many days
+GEONAMES_CACHE_FILE = os.path.join(TRANSFORMED_FOLDER_PATH, "geonames_cache.sqlite")
+GEONAMES_LEGACY_CACHE_FILE = os.path.join(TRANSFORMED_FOLDER_PATH, "geonames_cache.csv") # Imported into the SQLite cache on first use
+SQLITE_MAX_VARIABLES = 500 # Zip codes per SELECT ... IN (...) query
+
+# Offline geocoding settings, the Geonames API is only used when the reference table is missing
+POSTCODES_FILE_PATH = "data/reference/NL_full.txt" # Geonames postal code dump, unzipped from https://download.geonames.org/export/zip/NL_full.csv.zip
+POSTCODES_FILE_COLUMNS = [
+  "country_code", "postal_code", "place_name", "admin_name1", "admin_code1", "admin_name2",
+  "admin_code2", "admin_name3", "admin_code3", "latitude", "longitude", "accuracy"
+]
+GEODATA_COLUMNS = ["lon", "lat", "city", "province"]
+
+# Spaces out calls so that at most `rate` calls per second are started, across threads
+class RateLimiter:
+  def __init__(self, rate):
+    self.interval = 1 / rate if rate else 0
+    self.lock = threading.Lock()
+    self.next_call = time.monotonic()
+
+  def wait(self):
+    with self.lock:
+      now = time.monotonic()
+      delay = max(self.next_call - now, 0)
+      self.next_call = max(self.next_call, now) + self.interval
+    if delay:
+      time.sleep(delay)
+
+# Create an HTTP session with a connection pool shared by the workers, and retries with backoff
+def create_geonames_session():
+  retry = Retry(
+    total=GEONAMES_MAX_RETRIES,
+    backoff_factor=GEONAMES_BACKOFF_FACTOR,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET"],
+    raise_on_status=False
+  )
+  adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GEONAMES_MAX_WORKERS, max_retries=retry)
+  session = requests.Session()
+  session.mount("http://", adapter)
+  session.mount("https://", adapter)
+  return session
+
+# Function to fetch Geonames data, returns None if the lookup failed (so it is not cached)
+def fetch_geonames_data(zip_code, session, rate_limiter):
   params = {
     "postalcode": zip_code,
     "country": "NL",
     "username": GEONAMES_USERNAME
   }
 
-  response = requests.get(url, params=params)
-  if response.status_code == 200:
-    data = response.json()
-    if "postalcodes" in data and len(data["postalcodes"]) > 0:
-      place = data["postalcodes"][0]
-      return {
-        "lon": place.get("lng"),
-        "lat": place.get("lat"),
-        "city": place.get("placeName"),
-        "province": place.get("adminName1")
-      }
-    else:
-      return {"lon": None, "lat": None, "city": None, "province": None}
-  else:
+  rate_limiter.wait()
+  try:
+    response = session.get(GEONAMES_URL, params=params, timeout=GEONAMES_TIMEOUT)
+    data = response.json() if response.status_code == 200 else None
+  except (requests.RequestException, ValueError) as e:
+    print(f"Error: {e}")
+    return None
+
+  if data is None:
     print(f"Error: {response.status_code}")
-    return {"lon": None, "lat": None, "city": None, "province": None}
+    return None
+  if "status" in data: # Geonames reports errors such as an exceeded quota with a 200 status code
+    print(f"Error: {data['status'].get('message')}")
+    return None
+  if "postalcodes" in data and len(data["postalcodes"]) > 0:
+    place = data["postalcodes"][0]
+    return {
+      "lon": place.get("lng"),
+      "lat": place.get("lat"),
+      "city": place.get("placeName"),
+      "province": place.get("adminName1")
+    }
+  return {"lon": None, "lat": None, "city": None, "province": None} # Unknown zip code, cached as a miss
+
+# Open the SQLite cache of Geonames data, creating it (and importing the legacy CSV cache) if needed
+def open_geonames_cache():
+  os.makedirs(TRANSFORMED_FOLDER_PATH, exist_ok=True)
+  conn = sqlite3.connect(GEONAMES_CACHE_FILE)
+  conn.execute("""
+    CREATE TABLE IF NOT EXISTS geonames_cache (
+      zip_code TEXT PRIMARY KEY,
+      lon REAL,
+      lat REAL,
+      city TEXT,
+      province TEXT,
+      found INTEGER NOT NULL,
+      fetched_at TEXT NOT NULL
+    )
+  """)
+  is_empty = conn.execute("SELECT COUNT(*) FROM geonames_cache").fetchone()[0] == 0
+  if is_empty and os.path.exists(GEONAMES_LEGACY_CACHE_FILE):
+    legacy_cache = pd.read_csv(GEONAMES_LEGACY_CACHE_FILE, dtype={"zip_code": str}).dropna(subset=["zip_code"])
+    legacy_cache = legacy_cache.astype(object).where(legacy_cache.notnull(), None)
+    write_geonames_cache(conn, {
+      row["zip_code"]: {"lon": row["lon"], "lat": row["lat"], "city": row["city"], "province": row["province"]}
+      for row in legacy_cache.to_dict("records")
+    })
+    print(f"\tImported {len(legacy_cache)} zip codes from {GEONAMES_LEGACY_CACHE_FILE}")
+  return conn
+
+# Read the cached Geonames data of the given zip codes only, skipping misses older than GEONAMES_MISS_TTL_DAYS
+def read_geonames_cache(conn, zip_codes):
+  miss_cutoff = (datetime.now() - timedelta(days=GEONAMES_MISS_TTL_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+  geonames_cache = {}
+  for i in range(0, len(zip_codes), SQLITE_MAX_VARIABLES):
+    batch = zip_codes[i:i + SQLITE_MAX_VARIABLES]
+    rows = conn.execute(
+      f"SELECT zip_code, lon, lat, city, province FROM geonames_cache WHERE zip_code IN ({', '.join('?' * len(batch))}) AND (found = 1 OR fetched_at >= ?)",
+      [*batch, miss_cutoff]
+    )
+    for zip_code, lon, lat, city, province in rows:
+      geonames_cache[zip_code] = {"lon": lon, "lat": lat, "city": city, "province": province}
+  return geonames_cache
+
+# Insert or update Geonames data in the SQLite cache
+def write_geonames_cache(conn, geonames_data_by_zip_code):
+  fetched_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+  conn.executemany(
+    "INSERT OR REPLACE INTO geonames_cache (zip_code, lon, lat, city, province, found, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+    [
+      (zip_code, data["lon"], data["lat"], data["city"], data["province"], int(data["lat"] is not None), fetched_at)
+      for zip_code, data in geonames_data_by_zip_code.items()
+    ]
+  )
+  conn.commit()
+
+# Fetch Geonames data for several zip codes concurrently, saving results to the cache as they arrive
+def fetch_missing_geonames_data(conn, zip_codes):
+  session = create_geonames_session()
+  rate_limiter = RateLimiter(GEONAMES_REQUESTS_PER_SECOND)
+  fetched, pending, failed = {}, {}, 0
+
+  with ThreadPoolExecutor(max_workers=GEONAMES_MAX_WORKERS) as executor:
+    futures = {executor.submit(fetch_geonames_data, zip_code, session, rate_limiter): zip_code for zip_code in zip_codes}
+    for future in as_completed(futures):
+      geonames_data = future.result()
+      if geonames_data is None:
+        failed += 1
+        continue
+      pending[futures[future]] = geonames_data
+      if len(pending) >= 100:
+        write_geonames_cache(conn, pending)
+        fetched.update(pending)
+        pending = {}
+  write_geonames_cache(conn, pending)
+  fetched.update(pending)
+  session.close()
+
+  print(f"\tFetched {len(fetched)} zip codes from Geonames ({failed} failed, retried on the next run)")
+  return fetched
 
 # Function to add Geonames data to DataFrame
-def add_geonames_data(df):
-  # Initialize empty lists for new columns
-  lon_list, lat_list, city_list, province_list = [], [], [], []
-
-  # Load existing geonames data from file if it exists
-  geonames_cache_file = os.path.join(TRANSFORMED_FOLDER_PATH, "geonames_cache.csv")
-  if os.path.exists(geonames_cache_file):
-    geonames_cache_df = pd.read_csv(geonames_cache_file)
-    geonames_cache = geonames_cache_df.set_index('zip_code').T.to_dict('dict')
-  else:
-    geonames_cache = {}
-
-  zip_codes = df["zip_code"].unique()
-
-  # Fetch data for new zip codes and update the cache
-  new_data = []
-  for zip_code in zip_codes:
-    if zip_code not in geonames_cache:
-      geonames_data = fetch_geonames_data(zip_code)
-      geonames_cache[zip_code] = geonames_data
-      new_data.append({
-        "zip_code": zip_code,
-        "lon": geonames_data["lon"],
-        "lat": geonames_data["lat"],
-        "city": geonames_data["city"],
-        "province": geonames_data["province"]
-      })
-
-  # Save the updated geonames cache to file
-  if new_data:
-    new_data_df = pd.DataFrame(new_data)
-    if os.path.exists(geonames_cache_file):
-      new_data_df.to_csv(geonames_cache_file, mode='a', header=False, index=False)
-    else:
-      new_data_df.to_csv(geonames_cache_file, index=False)
-
-  # Populate lists with geonames data
-  for zip_code in df["zip_code"]:
-    if pd.notnull(zip_code) and zip_code in geonames_cache:
-      geonames_data = geonames_cache[zip_code]
-      lon_list.append(geonames_data["lon"])
-      lat_list.append(geonames_data["lat"])
-      city_list.append(geonames_data["city"])
-      province_list.append(geonames_data["province"])
-    else:
-      lon_list.append(None)
-      lat_list.append(None)
-      city_list.append(None)
-      province_list.append(None)
+# With fetch_missing=False, zip codes that aren't cached are left without geodata instead of being looked up
+def add_geonames_data(df, fetch_missing=True):
+  # Load cached geonames data of the zip codes in the DataFrame, and fetch the missing ones
+  zip_codes = df["zip_code"].dropna().unique().tolist()
+  conn = open_geonames_cache()
+  try:
+    geonames_cache = read_geonames_cache(conn, zip_codes)
+    missing_zip_codes = [zip_code for zip_code in zip_codes if zip_code not in geonames_cache]
+    if missing_zip_codes and fetch_missing:
+      geonames_cache.update(fetch_missing_geonames_data(conn, missing_zip_codes))
+  finally:
+    conn.close()
 
   # Add new columns to the DataFrame
-  df["lon"] = lon_list
-  df["lat"] = lat_list
-  df["city"] = city_list
-  df["province"] = province_list
+  geodata = pd.DataFrame.from_dict(geonames_cache, orient="index", columns=GEODATA_COLUMNS)
+  return attach_geodata(df, geodata.reindex(df["zip_code"]))
+
+### Offline geocoding ###
+
+# Normalize Dutch postcodes to the "1234AB" format
+def normalize_postcode(series):
+  return series.str.upper().str.replace(r"\s+", "", regex=True)
+
+# Load the postcode reference table once, indexed by full postcode (PC6) and by its 4 digits (PC4)
+@lru_cache(maxsize=1)
+def load_postcode_reference():
+  postcodes = pd.read_csv(
+    POSTCODES_FILE_PATH, sep="\t", header=None, names=POSTCODES_FILE_COLUMNS,
+    usecols=["postal_code", "place_name", "admin_name1", "latitude", "longitude"], dtype={"postal_code": str}
+  )
+  postcodes = pd.DataFrame({
+    "postcode": normalize_postcode(postcodes["postal_code"]),
+    "lon": postcodes["longitude"],
+    "lat": postcodes["latitude"],
+    "city": postcodes["place_name"],
+    "province": postcodes["admin_name1"]
+  })
+  pc6 = postcodes.drop_duplicates(subset="postcode").set_index("postcode")
+  pc4 = postcodes.assign(postcode=postcodes["postcode"].str[:4]).groupby("postcode").agg(
+    lon=("lon", "mean"), lat=("lat", "mean"), city=("city", "first"), province=("province", "first")
+  )
+  return pc6, pc4
 
+# Add coordinates, city and province from the local postcode reference table, falling back to PC4 when the full postcode is unknown
+def add_postcode_data(df, verbose=True):
+  pc6, pc4 = load_postcode_reference()
+  postcode = normalize_postcode(df["zip_code"])
+
+  geodata = pc6.reindex(postcode).reset_index(drop=True)
+  unmatched = geodata["lat"].isna()
+  geodata.loc[unmatched] = pc4.reindex(postcode.str[:4]).reset_index(drop=True).loc[unmatched]
+  if verbose:
+    print(f"\tPostcodes matched: {(~unmatched).sum()} on PC6, {(unmatched & geodata['lat'].notna()).sum()} on PC4, {geodata['lat'].isna().sum()} not found")
+
+  return attach_geodata(df, geodata)
+
+# Add the geodata columns to the DataFrame, geodata holds one row per row of df
+def attach_geodata(df, geodata):
+  for column in GEODATA_COLUMNS:
+    df[column] = geodata[column].to_numpy()
   return df
 
-### Apply transformations ###
-def transform_data():
-  print("Initiating data transformation...")
-  df = pd.read_csv(os.path.join(TRANSFORMED_FOLDER_PATH, "cleaned_car_listing.csv")) # Load cleaned data
+### Business rules ###
 
-  print(f"\tRows before any transformations: {len(df)}")
+DROP = "drop" # Column of the rules that drop the matching rows
 
+# Gears of the models that always have the same gearbox
+GEARS_BY_MODEL = {"1": 7, "3": 6, "CX-30": 6, "Formentor": 6, "HR-V": 6, "Niro": 6, "TUCSON": 6}
+
+# Rules applied in order by apply_transformation_rules(), as (condition, column, value) entries:
+# - condition(df, now) returns the mask of the rows to update, column is DROP to drop them instead
+# - a condition of None computes the whole column with value(df, now)
+TRANSFORMATION_RULES = [
   # Update labels
-  df["body_type"] = df["body_type"].replace("Off-Road/Pick-up", "SUV")
-  df["fuel"] = df["fuel"].replace("Electric/Gasoline", "Hybrid")
+  (lambda df, now: df["body_type"] == "Off-Road/Pick-up", "body_type", "SUV"),
+  (lambda df, now: df["fuel"] == "Electric/Gasoline", "fuel", "Hybrid"),
 
   # Update gear_type
-  df["gear_type"] = df.apply(lambda row: "Automatic" if row["fuel"] == "Electric" else row["gear_type"], axis=1) # If a car is eletric, it is automatic
+  (lambda df, now: df["fuel"] == "Electric", "gear_type", "Automatic"), # If a car is eletric, it is automatic
 
   # Calculate car age
-  df["built_in"] = pd.to_datetime(df["built_in"], errors="coerce")
-  df.drop(df[df["built_in"] > datetime.now() + timedelta(days=30)].index, inplace=True) # If built_in is more than 30 days in the future, then drop the row
-  df["car_age_in_months"] = df["built_in"].apply(lambda x: max((datetime.now().year - x.year) * 12 + datetime.now().month - x.month, 0) if pd.notnull(x) else None) # Expressed in months
+  (lambda df, now: df["built_in"] > now + timedelta(days=30), DROP, None), # If built_in is more than 30 days in the future, then drop the row
+  (None, "car_age_in_months", lambda df, now: ((now.year - df["built_in"].dt.year) * 12 + now.month - df["built_in"].dt.month).clip(lower=0)), # Expressed in months
 
   # Update previous_owners & used_or_new
-  df["previous_owners"] = df.apply(lambda row: 0 if row["used_or_new"] == "New" else row["previous_owners"], axis=1) # If a car is new, it has 0 previous owners
-  df.loc[(df["car_age_in_months"] <= 12) & (df["km"] < 1_000), ["previous_owners", "used_or_new"]] = [0, "New"] # If a car is less than 12 months old and less then 1000 km, it is "New" and has 0 previous owners
-  df["used_or_new"] = df["used_or_new"].apply(lambda x: "Used" if x != "New" else x) # If a car is not new, it is used
-  
+  (lambda df, now: df["used_or_new"] == "New", "previous_owners", 0), # If a car is new, it has 0 previous owners
+  # If a car is less than 12 months old and less then 1000 km, it is "New" and has 0 previous owners
+  (lambda df, now: (df["car_age_in_months"] <= 12) & (df["km"] < 1_000), "previous_owners", 0),
+  (lambda df, now: (df["car_age_in_months"] <= 12) & (df["km"] < 1_000), "used_or_new", "New"),
+  (lambda df, now: df["used_or_new"] != "New", "used_or_new", "Used"), # If a car is not new, it is used
+
   # Update drive_train
-  df["drive_train"] = np.where(df["description"].str.contains("AWD|4WD", na=False), "4WD", df["drive_train"]) # If the description contains AWD or 4WD, the drive train is set to 4WD
-  df.loc[(df["fuel"] == "Electric") & (df["drive_train"].isin([np.nan, "Front"])), "drive_train"] = "Rear" # If car is "Eletric", and the drive train is either empty or "Front", then it is set to "Rear"
-  df.loc[(df["fuel"] != "Electric") & (df["drive_train"].isin([np.nan, "Rear"])), "drive_train"] = "Front" # If the car is not eletric and the drive train is either empty or "Rear", it is set to "Front"
+  (lambda df, now: df["description"].str.contains("AWD|4WD", na=False), "drive_train", "4WD"), # If the description contains AWD or 4WD, the drive train is set to 4WD
+  (lambda df, now: (df["fuel"] == "Electric") & (df["drive_train"].isna() | (df["drive_train"] == "Front")), "drive_train", "Rear"), # If car is "Eletric", and the drive train is either empty or "Front", then it is set to "Rear"
+  (lambda df, now: (df["fuel"] != "Electric") & (df["drive_train"].isna() | (df["drive_train"] == "Rear")), "drive_train", "Front"), # If the car is not eletric and the drive train is either empty or "Rear", it is set to "Front"
 
-  # Update full_service_history
-  df["full_service_history"] = df.apply(lambda row: 1 if pd.isnull(row["full_service_history"]) and row["used_or_new"] == "New" else 0, axis=1) # If "full_service_history" is null, and "used_or_new" is "New", then "full_service_history" is set to 1, else it is set to 0
+  # Update full_service_history: if it is null and "used_or_new" is "New", then it is set to 1, else it is set to 0
+  (lambda df, now: ~(df["full_service_history"].isnull() & (df["used_or_new"] == "New")), "full_service_history", 0),
+  (lambda df, now: df["full_service_history"].isnull() & (df["used_or_new"] == "New"), "full_service_history", 1),
 
   # Update gear
-  df.loc[df["fuel"] == "Electric", "gears"] = 1 # If a car is eletric, it has 1 gear
-  df.loc[(df["gears"] == 8) & (df["manufacturer"] != "Volvo"), "gears"] = pd.NA # If a car has 8 gears and is not a Volvo, it is set to None
-  df.loc[(df["gears"] > 8) | (df["gears"].isin([2, 3, 4])), "gears"] = pd.NA # If a car has more than 8 gears or has 2, 3, or 4 gears, it is set to None 
+  (lambda df, now: df["fuel"] == "Electric", "gears", 1), # If a car is eletric, it has 1 gear
+  (lambda df, now: (df["gears"] == 8) & (df["manufacturer"] != "Volvo"), "gears", pd.NA), # If a car has 8 gears and is not a Volvo, it is set to None
+  (lambda df, now: (df["gears"] > 8) | (df["gears"].isin([2, 3, 4])), "gears", pd.NA), # If a car has more than 8 gears or has 2, 3, or 4 gears, it is set to None
   # If fuel is not Eletric, manufactuer in not Toyota or Lexus, and gears is 1, it is set to None
-  df.loc[(df["fuel"] != "Electric") & (~df["manufacturer"].isin(["Toyota", "Lexus"])) & (df["gears"] == 1), "gears"] = pd.NA
+  (lambda df, now: (df["fuel"] != "Electric") & (~df["manufacturer"].isin(["Toyota", "Lexus"])) & (df["gears"] == 1), "gears", pd.NA),
   # Update gears based on car model
-  df.loc[df["car"] == "1", "gears"] = 7
-  df.loc[df["car"] == "3", "gears"] = 6
-  df.loc[df["car"] == "CX-30", "gears"] = 6
-  df.loc[df["car"] == "Formentor", "gears"] = 6
-  df.loc[df["car"] == "HR-V", "gears"] = 6
-  df.loc[df["car"] == "Niro", "gears"] = 6
-  df.loc[df["car"] == "TUCSON", "gears"] = 6
+  *[(lambda df, now, car=car: df["car"] == car, "gears", gears) for car, gears in GEARS_BY_MODEL.items()],
 
   # Update co2_emission_g_per_km depeding on the fuel
-  df["co2_emission_g_per_km"] = df.apply(lambda row: 0 if row["fuel"] == "Electric" else row["co2_emission_g_per_km"], axis=1) # If a car is eletric, it has 0 co2 emission
-  df["co2_emission_g_per_km"] = df.apply(lambda row: None if row["co2_emission_g_per_km"] == 0 and row["fuel"] != "Electric" else row["co2_emission_g_per_km"], axis=1) # If a car is not eletric and has 0 co2 emission, it is set to None
+  (lambda df, now: df["fuel"] == "Electric", "co2_emission_g_per_km", 0), # If a car is eletric, it has 0 co2 emission
+  (lambda df, now: (df["co2_emission_g_per_km"] == 0) & (df["fuel"] != "Electric"), "co2_emission_g_per_km", None), # If a car is not eletric and has 0 co2 emission, it is set to None
 
   # Calculate years active on the platform
-  df["years_active_on_platform"] = df["active_since"].apply(lambda x: (datetime.now().year - x) if pd.notnull(x) else None)
+  (None, "years_active_on_platform", lambda df, now: now.year - df["active_since"]),
 
   # Drop irrelevant rows
-  df.drop(df[(df["fuel"] == "Gasoline") & (df["electric_range"] > 0)].index, inplace=True) # Drop rows where electric_range is greater than 0 and the fuel is Gasoline
-  df.drop(df[(df["fuel"] == "Electric") & (~df["manufacturer"].isin(["Kia", "Tesla", "Volvo"]))].index, inplace=True) # Only keep Tesla, Kia and Volvo electric cars as other manufacturers do not have electric cars
-  df.drop(df[(df["manufacturer"] == "Lynk & Co") & (df["fuel"] != "Hybrid")].index, inplace=True) # Only keep Lynk & Co hybrid cars
-  df.drop(df[(df["car"] == "Niro") & (df["fuel"] != "Hybrid")].index, inplace=True) # Only keep Kia Niro hybrid cars
-  df.drop(df[(df["manufacturer"] == "Toyota") & (df["fuel"] != "Hybrid")].index, inplace=True) # Only keep Toyota hybrid cars
-  df.drop(df[(df["fuel"] == "Diesel") & (df["car"] != "A3")].index, inplace=True) # Only keep Audi A3 Diesel cars as there are not enough data entries for other Diesel cars
-  df.drop(df[df["car"].isin(["UX 300h", "UX 300e"])].index, inplace=True) # Not enought data entries for these Lexus models
+  (lambda df, now: (df["fuel"] == "Gasoline") & (df["electric_range"] > 0), DROP, None), # Drop rows where electric_range is greater than 0 and the fuel is Gasoline
+  (lambda df, now: (df["fuel"] == "Electric") & (~df["manufacturer"].isin(["Kia", "Tesla", "Volvo"])), DROP, None), # Only keep Tesla, Kia and Volvo electric cars as other manufacturers do not have electric cars
+  (lambda df, now: (df["manufacturer"] == "Lynk & Co") & (df["fuel"] != "Hybrid"), DROP, None), # Only keep Lynk & Co hybrid cars
+  (lambda df, now: (df["car"] == "Niro") & (df["fuel"] != "Hybrid"), DROP, None), # Only keep Kia Niro hybrid cars
+  (lambda df, now: (df["manufacturer"] == "Toyota") & (df["fuel"] != "Hybrid"), DROP, None), # Only keep Toyota hybrid cars
+  (lambda df, now: (df["fuel"] == "Diesel") & (df["car"] != "A3"), DROP, None), # Only keep Audi A3 Diesel cars as there are not enough data entries for other Diesel cars
+  (lambda df, now: df["car"].isin(["UX 300h", "UX 300e"]), DROP, None), # Not enought data entries for these Lexus models
+]
+
+# Apply the rules in order, each one as a single boolean mask over the whole DataFrame
+# Rows are dropped once all rules are applied, so that the DataFrame is only copied once, or kept with drop_rows=False (scoring)
+def apply_transformation_rules(df, rules, now, drop_rows=True):
+  dropped_rows = np.zeros(len(df), dtype=bool)
+  for condition, column, value in rules:
+    if condition is None:
+      df[column] = value(df, now)
+      continue
+    mask = condition(df, now).fillna(False).to_numpy(dtype=bool) # Comparisons with missing values of nullable columns are missing, not False
+    if column == DROP:
+      dropped_rows |= mask
+      continue
+    if isinstance(df[column].dtype, pd.CategoricalDtype) and not pd.isna(value) and value not in df[column].cat.categories:
+      df[column] = df[column].cat.add_categories([value])
+    df.loc[mask, column] = value
+  if drop_rows:
+    df.drop(df.index[dropped_rows], inplace=True)
+  return df
+
+### Apply transformations ###
+def transform_rows(df):
+  print(f"\tRows before any transformations: {len(df)}")
+
+  # Apply business rules, all of them against the same snapshot of "now"
+  df["built_in"] = pd.to_datetime(df["built_in"], errors="coerce")
+  df = apply_transformation_rules(df, TRANSFORMATION_RULES, datetime.now())
 
   # Drop irrelevant columns
   df.drop(["active_since", "description"], axis=1, inplace=True) 
   
   # Create dataframe for zip_code
   if "zip_code" in df.columns:
-    print("\tAdding Geonames data based on zip_code...")
-    df = add_geonames_data(df)
+    if os.path.exists(POSTCODES_FILE_PATH):
+      print("\tAdding postcode data based on zip_code...")
+      df = add_postcode_data(df)
+    else:
+      print(f"\t{POSTCODES_FILE_PATH} not found, adding Geonames data based on zip_code...")
+      df = add_geonames_data(df)
 
   # Reorganizing a few columns
   columns = df.columns.tolist()
@@ -181,14 +369,53 @@ def transform_data():
   columns.append(columns.pop(columns.index("lon")))
   columns.append(columns.pop(columns.index("listing_url")))
   columns.append(columns.pop(columns.index("timestamp")))
-  df = df[columns]
-
-  ### Save transformed data as CSV ###
-  df.to_csv(os.path.join(TRANSFORMED_FOLDER_PATH, "transformed_car_listing.csv"), index=False)
-  print("\tData transformation completed!")
+  df = apply_column_dtypes(df[columns], TRANSFORMED_COLUMN_DTYPES)
 
   print(f"\tRows after applying all transformations: {len(df)}")
+  print(f"\tMemory usage of the transformed data: {get_memory_usage_mb(df):.1f} MB")
+  return df
+
+
+# Transform the cleaned data. With incremental=True, only the cleaned rows added since the last run are transformed and merged into the existing output
+# If df is given, it is transformed instead of the saved cleaned data (and only saved if persist=True)
+# Returns the rows transformed by this run
+def transform_data(df=None, incremental=True, export_csv=False, persist=True):
+  print("Initiating data transformation...")
+  checkpoint = load_checkpoint()
+
+  if df is not None:
+    df = transform_rows(df)
+    if persist:
+      write_table(df, TRANSFORMED_FILE_PATH)
+  elif incremental and not checkpoint.get("pending_full_transform", True) and os.path.exists(TRANSFORMED_FILE_PATH):
+    # Incremental run: transform the rows queued by the cleaning, then merge them into the transformed data
+    df = read_table(CLEANED_DELTA_FILE_PATH) if os.path.exists(CLEANED_DELTA_FILE_PATH) else pd.DataFrame()
+    if df.empty:
+      print("\tNo new cleaned data since the last run.")
+      df = read_empty_table(TRANSFORMED_FILE_PATH, TRANSFORMED_COLUMN_DTYPES) # The next stages get no rows, but the transformed columns
+    else:
+      df = transform_rows(df)
+      new_file = f"{TRANSFORMED_FILE_PATH}.new"
+      write_table(df, new_file)
+      merge_into_table(new_file, TRANSFORMED_FILE_PATH)
+      os.remove(new_file)
+  else:
+    df = transform_rows(read_table(CLEANED_FILE_PATH))
+
+    ### Save transformed data as Parquet ###
+    write_table(df, TRANSFORMED_FILE_PATH)
+
+  if persist:
+    if os.path.exists(CLEANED_DELTA_FILE_PATH):
+      os.remove(CLEANED_DELTA_FILE_PATH)
+    checkpoint["pending_full_transform"] = False
+    save_checkpoint(checkpoint)
+    if export_csv:
+      export_to_csv(TRANSFORMED_FILE_PATH, TRANSFORMED_CSV_FILE_PATH)
+
+  print("\tData transformation completed!")
+  return df
 
-# Run transformation
+# Run transformation, pass --full to transform the whole cleaned data again and --csv to also export the transformed data as CSV
 if __name__ == "__main__":
-  transform_data()
+  transform_data(incremental="--full" not in sys.argv, export_csv="--csv" in sys.argv)
@@ -1,6 +1,9 @@
 import os
+import io
+import re
+import time
 import pandas as pd
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, inspect, text
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -12,65 +15,243 @@ DB_PASS = os.getenv("DB_PASS")
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT")
 DB_NAME = os.getenv("DB_NAME")
+DATABASE_URL = os.getenv("DATABASE_URL", f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}") # e.g. sqlite:///car_listings.db to test locally
 
 # Define file path
-TRANSFORMED_FILE_PATH = "data/transformed/transformed_car_listing.csv"
+TRANSFORMED_FILE_PATH = "data/transformed/transformed_car_listing.parquet"
+
+# SQL types that can't be derived from the transformed DataFrame's dtypes
+COLUMN_TYPES = {
+	"built_in": "DATE",
+	"car_age_in_months": "INTEGER", # Stored as floats in transformed data written before the dtype schema
+	"timestamp": "TIMESTAMP NOT NULL" # Partition key
+}
+
+# Indexes for the pricing queries by model and age, price and recency, and for the upsert lookups on listing_url
+TABLE_INDEXES = {
+	"car_listings_model_age_idx": ["manufacturer", "car", "built_in"],
+	"car_listings_price_idx": ["price"],
+	"car_listings_timestamp_idx": ["timestamp"],
+	"car_listings_listing_url_idx": ["listing_url"]
+}
+
+# Upload settings
+UPLOAD_BATCH_SIZE = 50_000 # Rows copied to the staging table and merged at a time, all batches run in one transaction
+FLOAT32_DECIMALS = 5 # Decimals kept when widening float32 columns, float32 holds about 7 significant digits (5 decimals for coordinates)
+TABLE_NAME = "car_listings"
+STAGING_TABLE = "car_listings_staging"
+LEGACY_TABLE = "car_listings_legacy"
+MIGRATIONS_TABLE = "schema_migrations"
 
 # Database connection
-engine = create_engine(f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}")
+engine = create_engine(DATABASE_URL)
+
+# Turn a transformed column name (e.g. "WLAN / WiFi hotspot") into a snake_case SQL column name
+def to_column_name(name):
+	return re.sub(r"[^0-9a-z]+", "_", str(name).lower()).strip("_")
+
+def quote(identifier):
+	return '"' + identifier.replace('"', '""') + '"'
+
+# Derive the SQL type of a column from its pandas dtype
+def get_sql_type(column, dtype):
+	if column in COLUMN_TYPES:
+		return COLUMN_TYPES[column]
+	if pd.api.types.is_bool_dtype(dtype):
+		return "BOOLEAN"
+	if pd.api.types.is_integer_dtype(dtype):
+		return "BIGINT" if dtype.itemsize > 4 else "INTEGER"
+	if pd.api.types.is_float_dtype(dtype):
+		return "DOUBLE PRECISION"
+	if pd.api.types.is_datetime64_any_dtype(dtype):
+		return "TIMESTAMP"
+	return "TEXT"
+
+# Map every column of the transformed data to its SQL type, this is the source of truth for the table's DDL
+def build_table_schema(df):
+	return {column: get_sql_type(column, dtype) for column, dtype in df.dtypes.items()}
+
+# Rename the columns to their SQL names, cast the integer columns stored as floats and widen float32 columns (e.g. lat and lon)
+# to float64, rounded so that they are stored as 52.08 rather than 52.08000183
+def prepare_data(df):
+	df = df.rename(columns=to_column_name)
+	integer_columns = [column for column, sql_type in COLUMN_TYPES.items() if sql_type == "INTEGER" and column in df.columns]
+	df = df.astype({column: "Int64" for column in integer_columns})
+	return df.assign(**{column: df[column].astype("float64").round(FLOAT32_DECIMALS) for column in df.select_dtypes(["float32", "Float32"]).columns})
+
+# Create the monthly partitions of car_listings the given timestamps fall into (PostgreSQL only)
+def create_partitions(conn, timestamps):
+	if conn.dialect.name != "postgresql":
+		return
+	for month in pd.to_datetime(pd.Series(timestamps)).dropna().dt.to_period("M").unique():
+		conn.execute(text(f"""
+			CREATE TABLE IF NOT EXISTS {TABLE_NAME}_{month.year}_{month.month:02d} PARTITION OF {TABLE_NAME}
+			FOR VALUES FROM ('{month.start_time:%Y-%m-%d}') TO ('{(month + 1).start_time:%Y-%m-%d}')
+		"""))
+
+# Migration 1: create car_listings from the transformed schema, range partitioned by month of timestamp on PostgreSQL.
+# A unique key on a partitioned table must include the partition key, so listing_url is kept unique by the upsert instead,
+# with uploads serialized by insert_data() since nothing stops two concurrent ones from inserting the same listing_url
+def create_partitioned_table(conn, schema):
+	legacy_columns = []
+	if inspect(conn).has_table(TABLE_NAME):
+		legacy_columns = [column["name"] for column in inspect(conn).get_columns(TABLE_NAME) if column["name"] != "id"]
+		conn.execute(text(f"ALTER TABLE {TABLE_NAME} RENAME TO {LEGACY_TABLE}"))
+
+	columns = ", ".join(f"{quote(column)} {sql_type}" for column, sql_type in schema.items())
+	if conn.dialect.name == "postgresql":
+		conn.execute(text(f"CREATE TABLE {TABLE_NAME} (id BIGSERIAL, {columns}, PRIMARY KEY (id, timestamp)) PARTITION BY RANGE (timestamp)"))
+	else:
+		conn.execute(text(f"CREATE TABLE {TABLE_NAME} (id INTEGER PRIMARY KEY, {columns})"))
 
-def create_table():
+	# Move the rows of a table created before the migrations were introduced. listing_url was UNIQUE there, so it holds one row
+	# per listing: DISTINCT ON only keeps the upsert's key unique if the constraint was dropped. timestamp could be NULL there
+	# but is the partition key here, the rows without it have no partition and aren't copied
+	if legacy_columns:
+		copied = ", ".join(quote(column) for column in legacy_columns if column in schema)
+		skipped = conn.execute(text(f"SELECT COUNT(*) FROM {LEGACY_TABLE} WHERE timestamp IS NULL")).scalar()
+		if skipped:
+			print(f"\tSkipped {skipped} rows of '{LEGACY_TABLE}' without timestamp, they have no partition in '{TABLE_NAME}'.")
+		if conn.dialect.name == "postgresql":
+			create_partitions(conn, [row[0] for row in conn.execute(text(f"SELECT DISTINCT date_trunc('month', timestamp) FROM {LEGACY_TABLE}"))])
+			latest_rows = f"SELECT DISTINCT ON (listing_url) {copied} FROM {LEGACY_TABLE} WHERE timestamp IS NOT NULL ORDER BY listing_url, timestamp DESC"
+		else:
+			latest_rows = f"""
+				SELECT {copied} FROM (
+					SELECT *, ROW_NUMBER() OVER (PARTITION BY listing_url ORDER BY timestamp DESC) AS row_number FROM {LEGACY_TABLE} WHERE timestamp IS NOT NULL
+				) WHERE row_number = 1
+			"""
+		conn.execute(text(f"INSERT INTO {TABLE_NAME} ({copied}) {latest_rows}"))
+		conn.execute(text(f"DROP TABLE {LEGACY_TABLE}"))
+
+# Migration 2: index car_listings, the indexes on the partitioned table are created on every partition
+def create_indexes(conn, schema):
+	for index, columns in TABLE_INDEXES.items():
+		conn.execute(text(f"CREATE INDEX IF NOT EXISTS {index} ON {TABLE_NAME} ({', '.join(quote(column) for column in columns)})"))
+
+# Ordered migrations of car_listings: (version, description, function(conn, schema))
+MIGRATIONS = [
+	(1, "create car_listings partitioned by timestamp", create_partitioned_table),
+	(2, "index car_listings on (manufacturer, car, built_in), price, timestamp and listing_url", create_indexes)
+]
+
+# Add the columns of the transformed data that car_listings doesn't have yet (e.g. new equipment features)
+def add_missing_columns(conn, schema):
+	existing_columns = {column["name"] for column in inspect(conn).get_columns(TABLE_NAME)}
+	for column, sql_type in schema.items():
+		if column not in existing_columns:
+			conn.execute(text(f"ALTER TABLE {TABLE_NAME} ADD COLUMN {quote(column)} {sql_type.replace(' NOT NULL', '')}"))
+			print(f"\tAdded column '{column}' ({sql_type}) to '{TABLE_NAME}'.")
+
+# Apply the pending migrations, then bring the table's columns in line with the transformed schema
+def migrate_table(schema):
 	with engine.begin() as conn:
-		conn.execute(text("""
-			CREATE TABLE IF NOT EXISTS car_listings (
-				id SERIAL PRIMARY KEY,
-				manufacturer TEXT,
-				car TEXT,
-				price NUMERIC,
-				lease_price_per_month NUMERIC,
-				km NUMERIC,
-				gear_type TEXT,
-				built_in DATE,
-				car_age_in_months INTEGER,
-				fuel TEXT,
-				body_type TEXT,
-				seller_type TEXT,
-				seller_name TEXT,
-				years_active_on_platform NUMERIC,
-				zip_code TEXT,
-				city TEXT,
-				province TEXT,
-				lat NUMERIC,
-				lon NUMERIC,
-				listing_url TEXT UNIQUE,
-				timestamp TIMESTAMP
+		conn.execute(text(f"CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} (version INTEGER PRIMARY KEY, description TEXT, applied_at TIMESTAMP)"))
+		applied_versions = {row[0] for row in conn.execute(text(f"SELECT version FROM {MIGRATIONS_TABLE}"))}
+		for version, description, migration in MIGRATIONS:
+			if version in applied_versions:
+				continue
+			migration(conn, schema)
+			conn.execute(
+				text(f"INSERT INTO {MIGRATIONS_TABLE} (version, description, applied_at) VALUES (:version, :description, CURRENT_TIMESTAMP)"),
+				{"version": version, "description": description}
 			)
-		"""))
-		print("Table 'car_listings' is ready.")
+			print(f"\tApplied migration {version}: {description}.")
+		add_missing_columns(conn, schema)
+		print(f"Table '{TABLE_NAME}' is ready.")
 
-def load_csv():
+def load_transformed_data():
 	try:
-		df = pd.read_csv(TRANSFORMED_FILE_PATH)
-		print(f"Loaded {len(df)} rows from CSV file.")
+		df = pd.read_parquet(TRANSFORMED_FILE_PATH, memory_map=True, dtype_backend="numpy_nullable") # Integer columns with missing values stay integers
+		print(f"Loaded {len(df)} rows from Parquet file.")
 		return df
 	except Exception as e:
-		print(f"Failed to load CSV file: {e}")
+		print(f"Failed to load Parquet file: {e}")
 		return None
 
-def insert_data(df):
+# Create the staging table the batches are copied into, dropped at the end of the transaction
+def create_staging_table(conn):
+	if conn.dialect.name == "postgresql":
+		conn.execute(text(f"CREATE TEMP TABLE {STAGING_TABLE} (LIKE {TABLE_NAME} INCLUDING DEFAULTS) ON COMMIT DROP"))
+	else:
+		conn.execute(text(f"DROP TABLE IF EXISTS temp.{STAGING_TABLE}"))
+		conn.execute(text(f"CREATE TEMP TABLE {STAGING_TABLE} AS SELECT * FROM {TABLE_NAME} WHERE 0"))
+
+# Copy a batch into the staging table: COPY FROM STDIN on PostgreSQL, a multi-row INSERT on other databases (e.g. SQLite)
+def copy_to_staging_table(conn, batch):
+	columns = ", ".join(quote(column) for column in batch.columns)
+	if conn.dialect.name == "postgresql":
+		buffer = io.StringIO()
+		batch.to_csv(buffer, index=False, header=False)
+		buffer.seek(0)
+		with conn.connection.dbapi_connection.cursor() as cursor:
+			cursor.copy_expert(f"COPY {STAGING_TABLE} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+	else:
+		batch = batch.assign(**{
+			column: batch[column].dt.strftime("%Y-%m-%d" if COLUMN_TYPES.get(column) == "DATE" else "%Y-%m-%d %H:%M:%S")
+			for column in batch.select_dtypes("datetime").columns
+		})
+		# Bind parameters by position, the column names aren't valid parameter names
+		conn.execute(
+			text(f"INSERT INTO {STAGING_TABLE} ({columns}) VALUES ({', '.join(f':p{i}' for i in range(len(batch.columns)))})"),
+			[dict(zip((f"p{i}" for i in range(len(batch.columns))), row)) for row in batch.astype(object).where(batch.notnull(), None).itertuples(index=False)]
+		)
+
+# Merge the staging table into car_listings, returns the number of rows (inserted, updated).
+# Older rows of the same listing_url are replaced, rows older than the stored ones are skipped
+def merge_staging_table(conn, columns):
+	columns = ", ".join(quote(column) for column in columns)
+	updated = conn.execute(text(f"""
+		DELETE FROM {TABLE_NAME} WHERE EXISTS (
+			SELECT 1 FROM {STAGING_TABLE} s WHERE s.listing_url = {TABLE_NAME}.listing_url AND s.timestamp >= {TABLE_NAME}.timestamp
+		)
+	""")).rowcount
+	merged = conn.execute(text(f"""
+		INSERT INTO {TABLE_NAME} ({columns})
+		SELECT {columns} FROM {STAGING_TABLE} s
+		WHERE NOT EXISTS (SELECT 1 FROM {TABLE_NAME} c WHERE c.listing_url = s.listing_url)
+	""")).rowcount
+	conn.execute(text(f"DELETE FROM {STAGING_TABLE}"))
+	return merged - updated, updated
+
+# Upsert the rows into car_listings on listing_url, batch by batch through a staging table, in a single transaction
+def insert_data(df, batch_size=UPLOAD_BATCH_SIZE):
 	if df is None or df.empty:
 		print("No data to insert.")
 		return
+
+	# A listing_url can only be merged once per statement, keep its most recent row. Rows without timestamp have no partition
+	df = df.dropna(subset=["timestamp"]).sort_values(by="timestamp", kind="stable").drop_duplicates(subset="listing_url", keep="last")
+
+	inserted, updated = 0, 0
+	start = time.perf_counter()
 	try:
-		# Bulk insert using to_sql for efficiency
-		df.to_sql("car_listings", engine, if_exists="append", index=False, method="multi")
-		print(f"Inserted {len(df)} rows into car_listings.")
+		with engine.begin() as conn:
+			# One upload at a time: without a unique constraint on listing_url, concurrent merges could both insert the same listing
+			if conn.dialect.name == "postgresql":
+				conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:table))"), {"table": TABLE_NAME})
+			create_staging_table(conn)
+			for i in range(0, len(df), batch_size):
+				batch = df.iloc[i:i + batch_size]
+				create_partitions(conn, batch["timestamp"])
+				copy_to_staging_table(conn, batch)
+				batch_inserted, batch_updated = merge_staging_table(conn, batch.columns)
+				inserted += batch_inserted
+				updated += batch_updated
 	except Exception as e:
-		print(f"Failed to insert data: {e}")
+		print(f"Failed to insert data, the transaction was rolled back: {e}")
+		raise
+
+	elapsed = time.perf_counter() - start
+	print(f"Inserted {inserted} and updated {updated} rows in {TABLE_NAME} in {elapsed:.1f}s ({(inserted + updated) / elapsed:.0f} rows/s).")
 
-def upload_data_to_db():
-	create_table()
-	df = load_csv()
+# Upload the given transformed DataFrame, or the saved transformed data if df is None
+def upload_data_to_db(df=None):
+	df = load_transformed_data() if df is None else df
+	if df is None:
+		return
+	df = prepare_data(df)
+	migrate_table(build_table_schema(df))
 	insert_data(df)
 	print("Upload process completed.")
 
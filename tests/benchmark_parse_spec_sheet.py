@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scrapy", "src"))
+from scrapy.http import HtmlResponse, Request
+from spiders.scrape_car_listing import CarListingSpider
+
+FIXTURES_FOLDER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+FIXTURE_FILES = ["car_listing_dealer.html", "car_listing_private.html"]
+BENCHMARK_PAGES = 2_000 # Pages parsed per benchmark, cycling through the fixtures
+
+# Spec sheet fields read by parse_car(), as the per-field selectors used before parse_spec_sheet()
+LEGACY_SPEC_SELECTORS = {
+  "body_type": "dt:contains('Body type') + dd::text", "used_or_new": "dt:contains('Type') + dd::text",
+  "drive_train": "dt:contains('Drivetrain') + dd::text", "seats": "dt:contains('Seats') + dd::text",
+  "doors": "dt:contains('Doors') + dd::text", "previous_owners": "dt:contains('Previous owner') + dd::text",
+  "full_service_history": "dt:contains('Full service history') + dd::text", "non-smoker": "dt:contains('Non-smoker vehicle') + dd::text",
+  "engine_size": "dt:contains('Engine size') + dd::text", "gears": "dt:contains('Gears') + dd::text",
+  "cylinders": "dt:contains('Cylinders') + dd::text", "empty_weight": "dt:contains('Empty weight') + dd::text",
+  "emission_class": "dt:contains('Emission class') + dd::text", "co2_emission": "dt:contains('CO₂-emissions') + dd::text",
+  "electric_range": "dt:contains('Electric Range') + dd::text", "car_color": "dt:contains('Colour') + dd::text",
+  "manufacturer_color": "dt:contains('Manufacturer colour') + dd::text", "paint": "dt:contains('Paint') + dd::text",
+  "upholstery_color": "dt:contains('Upholstery colour') + dd::text", "upholstery": "dt:contains('Upholstery') + dd::text"
+}
+
+def load_detail_pages():
+  pages = []
+  for file_name in FIXTURE_FILES:
+    with open(os.path.join(FIXTURES_FOLDER_PATH, file_name), "rb") as file:
+      url = f"https://www.autoscout24.com/offers/{os.path.splitext(file_name)[0]}"
+      pages.append((url, file.read()))
+  return pages
+
+def read_legacy_spec_sheet(response):
+  spec_sheet = {field: response.css(selector).get(default=None) for field, selector in LEGACY_SPEC_SELECTORS.items()}
+  spec_sheet["fuel_consumption"] = " ".join(response.css("dt:contains('Fuel consumption') + dd p::text").getall())
+  return spec_sheet
+
+# Pages/s of a function called on each page, every page parsed from its HTML again like a response of the crawl
+def benchmark(pages, function):
+  start = time.perf_counter()
+  for i in range(BENCHMARK_PAGES):
+    url, body = pages[i % len(pages)]
+    function(HtmlResponse(url=url, body=body, encoding="utf-8", request=Request(url, meta={"manufacturer": "kia", "model": "niro", "page": 1})))
+  return BENCHMARK_PAGES / (time.perf_counter() - start)
+
+# Benchmark the spec sheet extraction on the saved detail pages: the per-field selectors it replaced, parse_spec_sheet()
+# and the whole parse_car()
+def run_benchmark():
+  pages = load_detail_pages()
+  spider = CarListingSpider()
+  spider.scraped_listings = []
+  spider.extraction_mode = "css"
+  functions = {
+    "HTML parsing only": lambda response: response.selector,
+    "Per-field selectors (before)": read_legacy_spec_sheet,
+    "parse_spec_sheet()": spider.parse_spec_sheet,
+    "parse_car() in css mode": lambda response: next(spider.parse_car(response))
+  }
+  print(f"Parsing {BENCHMARK_PAGES} pages of {len(pages)} saved detail pages...")
+  for name, function in functions.items():
+    print(f"\t{name}: {benchmark(pages, function):.0f} pages/s")
+    spider.scraped_listings = []
+
+# Run from the repository root: python tests/benchmark_parse_spec_sheet.py
+if __name__ == "__main__":
+  run_benchmark()
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The pipeline modules import each other by module name from their folders, like the stages run from the command line
+SRC_FOLDER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scrapy", "src")
+for folder in ["transformation", "training", "upload_to_db", ""]:
+  sys.path.insert(0, os.path.join(SRC_FOLDER_PATH, folder))
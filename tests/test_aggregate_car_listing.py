@@ -0,0 +1,45 @@
+import os
+import pandas as pd
+import pytest
+from clean_car_listing import write_table
+from transform_car_listing import TRANSFORMED_FILE_PATH
+from aggregate_car_listing import AGGREGATES_FILE_PATH, AGGREGATED_ROWS_FILE_PATH, aggregate_data
+
+OFFERS_URL = "https://www.autoscout24.com/offers/"
+
+# Transformed rows, with the columns the aggregates are built from
+def build_listings(rows):
+  df = pd.DataFrame(rows, columns=["manufacturer", "car", "fuel", "car_age_in_months", "price", "km", "listing_url"])
+  return df.astype({"car_age_in_months": "Int16", "price": "Int32", "km": "Int32"})
+
+HISTORY = build_listings([
+  ("Kia", "Niro", "Hybrid", 48, 22_950, 45_210, f"{OFFERS_URL}kia-niro-a"),
+  ("Kia", "Niro", "Hybrid", 50, 21_500, 52_000, f"{OFFERS_URL}kia-niro-b"),
+  ("Tesla", "Model 3", "Electric", 52, 27_500, 78_400, f"{OFFERS_URL}tesla-model-3-e")
+])
+DELTA = build_listings([("Kia", "Niro", "Hybrid", 49, 23_500, 41_000, f"{OFFERS_URL}kia-niro-c")])
+
+# Run aggregate_data() in an empty project, whose transformed data holds the history and the delta
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  write_table(pd.concat([HISTORY, DELTA], ignore_index=True), TRANSFORMED_FILE_PATH)
+
+# Without saved aggregates, the whole transformed data is aggregated rather than the delta handed by the dedup stage
+def test_first_incremental_run_aggregates_the_whole_transformed_data(project):
+  assert not os.path.exists(AGGREGATES_FILE_PATH) and not os.path.exists(AGGREGATED_ROWS_FILE_PATH)
+  summary = aggregate_data(DELTA)
+  assert summary["listings"].sum() == 4
+  assert summary.loc[("Kia", "Niro", "Hybrid", 4), "listings"] == 3
+
+  # The delta is then only aggregated once
+  assert aggregate_data(DELTA)["listings"].sum() == 4
+
+# A run without new rows, handed an empty frame with or without the transformed columns, keeps the saved aggregates
+@pytest.mark.parametrize("df", [pd.DataFrame(), DELTA.iloc[:0]])
+def test_run_without_new_rows_keeps_saved_aggregates(project, df, capsys):
+  aggregate_data()
+  modified_time = os.path.getmtime(AGGREGATES_FILE_PATH)
+  assert aggregate_data(df)["listings"].sum() == 4
+  assert "No new rows since the last run." in capsys.readouterr().out
+  assert os.path.getmtime(AGGREGATES_FILE_PATH) == modified_time
@@ -0,0 +1,84 @@
+import os
+import json
+import gzip
+import math
+import hashlib
+import pandas as pd
+import pytest
+from clean_car_listing import (
+  RAW_FILE_PATH, RAW_FOLDER_PATH, RAW_MANIFEST_FILE_PATH, CLEANED_FILE_PATH, clean_data, load_checkpoint, read_table, get_raw_file_size, get_raw_sources, read_raw_data_in_chunks, update_raw_checkpoint, get_raw_resume_offset,
+  extract_number, extract_hp, convert_fuel_consumption, extract_year_active_on_autoscout,
+  extract_number_column, extract_hp_column, convert_fuel_consumption_column, extract_year_active_on_autoscout_column
+)
+
+FIXTURE_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "car_listing.jsonl")
+
+# Raw values as the spider yields them, with missing, empty and unparseable ones
+RAW_VALUES = [
+  None, "", "  ", "abc", "1,234 km", "€ 12.500,-", "150 kW (204 hp)", "204hp", "no hp", "5.6 l/100 km (comb.)",
+  "0 l/100 km", "Customer since 2015", "2015 x"
+]
+
+# The column-wise functions return the same values as the scalar ones, missing results being NaN
+@pytest.mark.parametrize("scalar_function, column_function", [
+  (extract_number, extract_number_column),
+  (extract_hp, extract_hp_column),
+  (convert_fuel_consumption, convert_fuel_consumption_column),
+  (extract_year_active_on_autoscout, extract_year_active_on_autoscout_column)
+])
+def test_column_functions_match_scalar_functions(scalar_function, column_function):
+  column_values = column_function(pd.Series(RAW_VALUES, dtype=object)).tolist()
+  for raw_value, column_value in zip(RAW_VALUES, column_values):
+    expected = scalar_function(raw_value)
+    if expected is None:
+      assert math.isnan(column_value), raw_value
+    else:
+      assert column_value == expected, raw_value
+
+# A raw line still being written is neither read nor checkpointed, the next run reads it whole
+def test_partial_last_raw_line_is_left_for_the_next_run(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  os.makedirs(os.path.dirname(RAW_FILE_PATH))
+  with open(RAW_FILE_PATH, "w", encoding="utf-8") as file:
+    file.write('{"price": "1"}\n{"price": "2"}\n{"price": "3')
+  raw_file_size = get_raw_file_size()
+  assert raw_file_size == len('{"price": "1"}\n{"price": "2"}\n')
+  df = pd.concat(read_raw_data_in_chunks(get_raw_sources([], end=raw_file_size)))
+  assert df["price"].tolist() == ["1", "2"]
+  checkpoint = {}
+  update_raw_checkpoint(checkpoint, raw_file_size, [])
+
+  with open(RAW_FILE_PATH, "a", encoding="utf-8") as file:
+    file.write('"}\n')
+  start = get_raw_resume_offset(checkpoint, get_raw_file_size())
+  assert start == raw_file_size
+  df = pd.concat(read_raw_data_in_chunks(get_raw_sources([], start, get_raw_file_size())))
+  assert df["price"].tolist() == ["3"]
+
+# Write a compressed raw segment and register it in the manifest like the RawSegmentManifest extension
+def write_raw_segment(segment, lines, registered_lines=None):
+  content = gzip.compress("".join(lines).encode("utf-8"), mtime=0)
+  registered_content = gzip.compress("".join(registered_lines or lines).encode("utf-8"), mtime=0)
+  with open(os.path.join(RAW_FOLDER_PATH, segment), "wb") as file:
+    file.write(content)
+  with open(RAW_MANIFEST_FILE_PATH, "a", encoding="utf-8") as file:
+    file.write(json.dumps({"segment": segment, "rows": len(lines), "sha256": hashlib.sha256(registered_content).hexdigest()}) + "\n")
+
+# A segment skipped for its checksum isn't checkpointed, the next run reads it once it's restored
+def test_skipped_raw_segment_is_read_once_restored(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  os.makedirs(RAW_FOLDER_PATH)
+  with open(FIXTURE_FILE_PATH, encoding="utf-8") as file:
+    dealer_line, private_line = file.readlines()
+  write_raw_segment("car_listing_1.jsonl.gz", [dealer_line])
+  write_raw_segment("car_listing_2.jsonl.gz", [private_line[:50]], registered_lines=[private_line]) # Truncated copy
+
+  clean_data()
+  assert load_checkpoint()["raw_segments"] == ["car_listing_1.jsonl.gz"]
+  assert len(read_table(CLEANED_FILE_PATH)) == 1
+
+  with open(os.path.join(RAW_FOLDER_PATH, "car_listing_2.jsonl.gz"), "wb") as file:
+    file.write(gzip.compress(private_line.encode("utf-8"), mtime=0))
+  clean_data()
+  assert load_checkpoint()["raw_segments"] == ["car_listing_1.jsonl.gz", "car_listing_2.jsonl.gz"]
+  assert len(read_table(CLEANED_FILE_PATH)) == 2
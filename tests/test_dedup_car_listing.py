@@ -0,0 +1,82 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from clean_car_listing import write_table, merge_into_table
+from transform_car_listing import TRANSFORMED_FILE_PATH
+from dedup_car_listing import VEHICLE_CLUSTERS_FILE_PATH, assign_vehicle_clusters, evaluate_dedup, dedup_data, load_vehicle_clusters
+
+FIXTURES_FOLDER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+LISTINGS_FILE_PATH = os.path.join(FIXTURES_FOLDER_PATH, "dedup_car_listing.csv")
+LABELS_FILE_PATH = os.path.join(FIXTURES_FOLDER_PATH, "duplicate_labels.csv")
+OFFERS_URL = "https://www.autoscout24.com/offers/"
+
+# Transformed listings: reposts of the same vehicle and different vehicles of the same blocks
+def read_listings():
+  df = pd.read_csv(LISTINGS_FILE_PATH, parse_dates=["built_in", "timestamp"])
+  return df.astype({"km": "Int32", "price": "Int32", "engine_power_hp": "Int16"})
+
+def get_cluster_ids(df):
+  return df.set_index(df["listing_url"].str.removeprefix(OFFERS_URL))["vehicle_cluster_id"]
+
+# Run dedup_data() in an empty project, with the fixture listings as the transformed data
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  write_table(read_listings(), TRANSFORMED_FILE_PATH)
+
+# Transform a new crawl: its rows are merged into the transformed data and handed to dedup_data()
+def merge_new_rows(rows):
+  new_file = f"{TRANSFORMED_FILE_PATH}.new"
+  write_table(rows, new_file)
+  merge_into_table(new_file, TRANSFORMED_FILE_PATH)
+  os.remove(new_file)
+  return rows
+
+def test_assign_vehicle_clusters():
+  cluster_ids = get_cluster_ids(assign_vehicle_clusters(read_listings()))
+  assert cluster_ids["kia-niro-a"] == cluster_ids["kia-niro-b"] == cluster_ids["kia-niro-d"]
+  assert cluster_ids["tesla-model-3-e"] == cluster_ids["tesla-model-3-g"]
+  assert cluster_ids.nunique() == 7
+
+# Precision and recall of each tolerances on the labeled sample, the pair of a listing missing from the data is skipped
+def test_evaluate_dedup_on_labeled_sample():
+  results = evaluate_dedup(read_listings(), LABELS_FILE_PATH)
+  assert (results["pairs"] == 7).all()
+  assert results["precision"].tolist()[2:] == [1.0, 0.75, 0.8]
+  assert np.isnan(results["precision"].tolist()[:2]).all()
+  assert results["recall"].tolist() == [0.0, 0.0, 0.75, 0.75, 1.0]
+
+# The first listing of a cluster crawled again isn't its first listing by timestamp anymore, the cluster keeps its ID
+def test_cluster_ids_are_kept_when_the_first_listing_is_crawled_again(project):
+  cluster_ids = get_cluster_ids(dedup_data())
+  listings = read_listings()
+  recrawled = merge_new_rows(listings[listings["listing_url"] == f"{OFFERS_URL}kia-niro-a"].assign(timestamp=pd.Timestamp("2025-03-20 10:00:00")))
+  assert get_cluster_ids(dedup_data(recrawled))["kia-niro-a"] == cluster_ids["kia-niro-a"]
+  assert get_cluster_ids(load_vehicle_clusters()).to_dict() == cluster_ids.to_dict()
+
+  # Without the saved IDs, the cluster would be named after its new first listing
+  listings.loc[listings["listing_url"] == f"{OFFERS_URL}kia-niro-a", "timestamp"] = pd.Timestamp("2025-03-20 10:00:00")
+  assert get_cluster_ids(assign_vehicle_clusters(listings))["kia-niro-a"] != cluster_ids["kia-niro-a"]
+
+# New rows are only clustered with the rows of their blocks, and get the IDs a full run would give them
+def test_incremental_dedup_clusters_the_affected_blocks(project, capsys):
+  dedup_data()
+  capsys.readouterr()
+  listings = read_listings()
+  repost = listings[listings["listing_url"] == f"{OFFERS_URL}volkswagen-golf-h"].assign(
+    km=120_800, price=14_800, listing_url=f"{OFFERS_URL}volkswagen-golf-k", timestamp=pd.Timestamp("2025-03-20 10:00:00")
+  )
+  new_rows = dedup_data(merge_new_rows(repost))
+  assert "Listings clustered: 4," in capsys.readouterr().out # The Golf block only
+  cluster_ids = get_cluster_ids(load_vehicle_clusters())
+  assert get_cluster_ids(new_rows)["volkswagen-golf-k"] == cluster_ids["volkswagen-golf-h"]
+  assert cluster_ids.to_dict() == get_cluster_ids(dedup_data()).to_dict()
+
+# A run without new transformed rows doesn't cluster or save anything
+def test_incremental_dedup_skips_runs_without_new_rows(project, capsys):
+  dedup_data()
+  modified_time = os.path.getmtime(VEHICLE_CLUSTERS_FILE_PATH)
+  assert dedup_data(pd.DataFrame()).empty
+  assert "No new transformed data since the last run." in capsys.readouterr().out
+  assert os.path.getmtime(VEHICLE_CLUSTERS_FILE_PATH) == modified_time
@@ -0,0 +1,22 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+# Stands for a shard's crawl: writes its JOBDIR and its Prometheus metrics where the settings passed with -s point
+def fake_crawl(command, cwd, check):
+  settings = dict(command[i + 1].split("=", 1) for i, argument in enumerate(command) if argument == "-s")
+  os.makedirs(settings["JOBDIR"], exist_ok=True)
+  os.makedirs(os.path.dirname(settings["TELEMETRY_FILE"]), exist_ok=True)
+  with open(settings["TELEMETRY_FILE"], "w", encoding="utf-8") as file:
+    file.write("crawl_items_total 1\n")
+
+# The JOBDIRs are removed once every shard finished, the metrics of the shards are kept
+def test_sharded_crawl_keeps_shard_metrics(tmp_path, monkeypatch):
+  monkeypatch.setattr(main, "SHARDS_PATH", str(tmp_path / "shards"))
+  monkeypatch.setattr(main, "SHARD_METRICS_PATH", str(tmp_path / "metrics"))
+  monkeypatch.setattr(main.subprocess, "run", fake_crawl)
+  main.run_sharded_crawl(2, workers=2)
+  assert not os.path.exists(tmp_path / "shards")
+  assert sorted(os.listdir(tmp_path / "metrics")) == ["shard-0-of-2.prom", "shard-1-of-2.prom"]
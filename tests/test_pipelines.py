@@ -0,0 +1,60 @@
+import os
+import math
+import pandas as pd
+from clean_car_listing import write_table, merge_into_table
+from pipelines import load_price_reference, save_price_reference, refresh_price_reference
+
+OFFERS_URL = "https://www.autoscout24.com/offers/"
+NIRO_BUCKET = ("Kia", "Niro", 4, 2) # Built in 03/2021, listed in 03/2025 with 40,000 to 60,000 km
+
+# Transformed rows, with the columns the price reference is built from
+def build_listings(rows):
+  df = pd.DataFrame(rows, columns=["manufacturer", "car", "built_in", "km", "price", "listing_url", "timestamp"])
+  return df.astype({"km": "Int32", "price": "Int32", "built_in": "datetime64[ns]", "timestamp": "datetime64[ns]"})
+
+# Merge the rows of a new crawl into the transformed data, like the incremental transformation does
+def merge_new_rows(source_file_path, rows):
+  new_file = f"{source_file_path}.new"
+  write_table(build_listings(rows), new_file)
+  merge_into_table(new_file, source_file_path)
+  os.remove(new_file)
+
+# Refresh the saved reference from the transformed data like the pipeline does when the spider opens
+def refresh(reference_file_path, source_file_path):
+  buckets, watermark, row_hashes = load_price_reference(reference_file_path)
+  refreshed_watermark, row_hashes = refresh_price_reference(buckets, watermark, row_hashes, source_file_path)
+  if refreshed_watermark != watermark:
+    save_price_reference(reference_file_path, buckets, refreshed_watermark, row_hashes)
+  return buckets
+
+# A listing crawled again replaces its transformed row with a newer one: it's only counted again if its price or km changed
+def test_refresh_price_reference_skips_recrawled_rows(tmp_path):
+  reference_file_path = str(tmp_path / "reference" / "price_reference.json")
+  source_file_path = str(tmp_path / "transformed_car_listing.parquet")
+  write_table(build_listings([
+    ("Kia", "Niro", "2021-03-01", 45_210, 22_950, f"{OFFERS_URL}kia-niro-a", "2025-03-01 10:00:00"),
+    ("Kia", "Niro", "2021-03-01", 52_000, 21_500, f"{OFFERS_URL}kia-niro-b", "2025-03-01 10:05:00")
+  ]), source_file_path)
+  assert refresh(reference_file_path, source_file_path)[NIRO_BUCKET][0] == 2
+
+  merge_new_rows(source_file_path, [("Kia", "Niro", "2021-03-01", 45_210, 22_950, f"{OFFERS_URL}kia-niro-a", "2025-03-08 10:00:00")])
+  assert refresh(reference_file_path, source_file_path)[NIRO_BUCKET][0] == 2
+  assert refresh(reference_file_path, source_file_path)[NIRO_BUCKET][0] == 2
+
+  merge_new_rows(source_file_path, [
+    ("Kia", "Niro", "2021-03-01", 52_000, 20_500, f"{OFFERS_URL}kia-niro-b", "2025-03-08 10:05:00"), # Price changed
+    ("Kia", "Niro", "2021-03-01", 41_000, 23_500, f"{OFFERS_URL}kia-niro-c", "2025-03-08 10:05:00")
+  ])
+  count, log_price_sum = refresh(reference_file_path, source_file_path)[NIRO_BUCKET]
+  assert count == 4
+  assert math.isclose(log_price_sum, sum(math.log(price) for price in [22_950, 21_500, 20_500, 23_500]))
+
+# A reference saved without its row hashes is rebuilt from the transformed data
+def test_price_reference_without_row_hashes_is_rebuilt(tmp_path):
+  reference_file_path = str(tmp_path / "price_reference.json")
+  source_file_path = str(tmp_path / "transformed_car_listing.parquet")
+  write_table(build_listings([("Kia", "Niro", "2021-03-01", 45_210, 22_950, f"{OFFERS_URL}kia-niro-a", "2025-03-01 10:00:00")]), source_file_path)
+  refresh(reference_file_path, source_file_path)
+  os.remove(tmp_path / "price_reference_rows.parquet")
+  assert load_price_reference(reference_file_path)[:2] == ({}, None)
+  assert refresh(reference_file_path, source_file_path)[NIRO_BUCKET][0] == 1
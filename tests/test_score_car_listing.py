@@ -0,0 +1,90 @@
+import os
+import json
+import threading
+import joblib
+import numpy as np
+import pytest
+import requests
+from sklearn.dummy import DummyRegressor
+import transform_car_listing
+from score_car_listing import PriceScorer, MicroBatcher, normalize_record, create_server
+
+FIXTURE_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "car_listing.jsonl")
+
+def load_records():
+  with open(FIXTURE_FILE_PATH, encoding="utf-8") as file:
+    return [json.loads(line) for line in file]
+
+# The same records with their numeric fields sent as JSON numbers
+def as_numbers(record):
+  return {**record, "price": 22950, "km": 45210.0, "seats": 5, "previous_owners": 1}
+
+# Predicts the same price for every record, fails on records with an invalid price
+class StubScorer:
+  def predict(self, records):
+    if any(record.get("price") == "fail" for record in records):
+      raise ValueError("Invalid price")
+    return np.full(len(records), 20_000.0)
+
+@pytest.fixture
+def scorer(tmp_path, monkeypatch):
+  monkeypatch.setattr(transform_car_listing, "GEONAMES_CACHE_FILE", str(tmp_path / "geonames_cache.sqlite"))
+  model_file_path = tmp_path / "model.joblib"
+  joblib.dump(DummyRegressor().fit(np.zeros((2, 1)), [20_000, 30_000]), model_file_path)
+  return PriceScorer(model_file_path)
+
+def test_normalize_record():
+  record = normalize_record({"price": 22950, "km": 45210.0, "gear_type": None, "equipment": ["Armrest"], "manufacturer": "Kia Niro"})
+  assert record == {"price": "22950", "km": "45210", "gear_type": None, "equipment": ["Armrest"], "manufacturer": "Kia Niro"}
+  for record in [{"price": {"amount": 22950}}, {"seats": True}, {"equipment": "Armrest"}, {"equipment": [1, 2]}]:
+    with pytest.raises(ValueError):
+      normalize_record(record)
+
+# Numbers are cleaned like the text the spider yields
+def test_numeric_fields_are_prepared_like_text(scorer):
+  records = load_records()
+  text_records = scorer.prepare_records([{**records[0], "price": "22950", "km": "45210", "seats": "5", "previous_owners": "1"}])
+  numeric_records = scorer.prepare_records([as_numbers(records[0])])
+  assert text_records.equals(numeric_records)
+  assert numeric_records["price"].iloc[0] == 22_950
+  assert numeric_records["km"].iloc[0] == 45_210
+  assert len(scorer.predict([as_numbers(record) for record in records])) == len(records)
+
+# A request failing in a batch is scored alone, the other requests of the batch get their predictions
+def test_failing_request_does_not_fail_the_batch():
+  batcher = MicroBatcher(StubScorer(), max_batch_wait_ms=200)
+  results = {}
+
+  def submit(name, records):
+    try:
+      results[name] = list(batcher.submit(records))
+    except ValueError as e:
+      results[name] = str(e)
+
+  threads = [
+    threading.Thread(target=submit, args=("valid", [{"price": "€ 22,950"}, {"price": "€ 27,500"}])),
+    threading.Thread(target=submit, args=("invalid", [{"price": "fail"}])),
+    threading.Thread(target=submit, args=("other", [{"price": "€ 19,000"}]))
+  ]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert results == {"valid": [20_000.0, 20_000.0], "invalid": "Invalid price", "other": [20_000.0]}
+  assert batcher.get_metrics()["records"] == 3
+
+# Records that aren't listings are rejected with a 400 before reaching the batcher
+def test_server_rejects_invalid_records():
+  server = create_server(MicroBatcher(StubScorer()), port=0)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  url = f"http://127.0.0.1:{server.server_address[1]}/predict"
+  try:
+    response = requests.post(url, json={"price": 22950, "km": 45210})
+    assert response.status_code == 200
+    assert response.json() == {"predicted_prices": [20_000]}
+    response = requests.post(url, json=[{"price": 22950}, {"price": {"amount": 22950}}])
+    assert response.status_code == 400
+    assert response.json() == {"error": "Field price must be text or a number"}
+  finally:
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,115 @@
+import os
+import json
+import pandas as pd
+import pytest
+from scrapy.http import HtmlResponse, Request
+from spiders.scrape_car_listing import CRAWL_CONFIG_FILE, CarListingSpider, load_project_variables
+from clean_car_listing import clean_rows
+
+FIXTURES_FOLDER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# A saved detail page as the spider receives it, with the meta parse() sets on its request
+def load_detail_page(file_name, manufacturer, model):
+  with open(os.path.join(FIXTURES_FOLDER_PATH, file_name), "rb") as file:
+    body = file.read()
+  url = f"https://www.autoscout24.com/offers/{os.path.splitext(file_name)[0]}"
+  request = Request(url, meta={"manufacturer": manufacturer, "model": model, "page": 1, "listing_url": url, "fingerprint": None})
+  return HtmlResponse(url=url, body=body, encoding="utf-8", request=request)
+
+@pytest.fixture
+def spider():
+  spider = CarListingSpider()
+  spider.scraped_listings = []
+  return spider
+
+# Every dt/dd pair is read, the paragraphs of a dd are kept apart
+def test_parse_spec_sheet(spider):
+  spec_sheet = spider.parse_spec_sheet(load_detail_page("car_listing_dealer.html", "kia", "niro"))
+  assert spec_sheet["Body type"] == ("Off-Road/Pick-up", [])
+  assert spec_sheet["Engine size"] == ("1,580 cc", [])
+  assert spec_sheet["Fuel consumption"] == (None, ["4.4 l/100 km (comb.)", "4.6 l/100 km (city)", "4.3 l/100 km (country)"])
+  assert spec_sheet["Comfort & Convenience"][0] is None
+
+# Labels are matched exactly first, then by substring like the former "dt:contains(...)" selectors
+def test_get_spec(spider):
+  dealer_spec_sheet = spider.parse_spec_sheet(load_detail_page("car_listing_dealer.html", "kia", "niro"))
+  assert spider.get_spec(dealer_spec_sheet, "Type") == "Used"
+  assert spider.get_spec(dealer_spec_sheet, "Upholstery") == "Cloth"
+  assert spider.get_spec(dealer_spec_sheet, "Upholstery colour") == "Black"
+  assert spider.get_spec(dealer_spec_sheet, "Electric Range") is None
+  assert spider.get_spec(dealer_spec_sheet, "Electric Range", paragraphs=True) == []
+  private_spec_sheet = spider.parse_spec_sheet(load_detail_page("car_listing_private.html", "tesla", "model-3"))
+  assert spider.get_spec(private_spec_sheet, "Electric Range") == "580 km"
+
+# Both extraction modes yield the same cleaned row, the embedded state being formatted like the page
+@pytest.mark.parametrize("file_name, manufacturer, model", [
+  ("car_listing_dealer.html", "kia", "niro"),
+  ("car_listing_private.html", "tesla", "model-3")
+])
+def test_json_and_css_modes_give_the_same_cleaned_row(spider, file_name, manufacturer, model):
+  items = []
+  for extraction_mode in ["json", "css"]:
+    spider.extraction_mode = extraction_mode
+    item = next(spider.parse_car(load_detail_page(file_name, manufacturer, model)))
+    item["timestamp"] = "2025-03-15 12:00:00"
+    items.append(item)
+  df = clean_rows(pd.DataFrame(items))
+  assert len(df) == 2
+  json_row, css_row = df.astype(object).where(df.notna(), None).to_dict("records")
+  assert json_row == css_row
+
+# Fields missing from the embedded state, or in an unknown format, are read with the selectors one by one
+def test_json_mode_falls_back_to_selectors_per_field(spider):
+  response = load_detail_page("car_listing_private.html", "tesla", "model-3")
+  listing_details = spider.load_next_data(response)["props"]["pageProps"]["listingDetails"]
+  assert listing_details["vehicle"]["transmissionType"] is None
+  header = spider.parse_car_header_json(listing_details)
+  assert header["gear_type"] is None
+  assert header["manufacturer"] == "Tesla Model 3"
+  assert header["engine_power"] == "441 hp"
+  assert header["built_in"] == "11/2020"
+  item = next(spider.parse_car(response))
+  assert item["gear_type"] == "Automatic"
+  assert item["manufacturer"] == "Tesla Model 3"
+
+# The fields a private seller doesn't have aren't read from the page, only the fields missing from the embedded state are
+def test_json_mode_reads_only_the_missing_fields_with_selectors(spider, monkeypatch):
+  parse_car_header = spider.parse_car_header
+  calls = []
+
+  def record_call(response, fields):
+    calls.append(fields)
+    return parse_car_header(response, fields)
+
+  monkeypatch.setattr(spider, "parse_car_header", record_call)
+  item = next(spider.parse_car(load_detail_page("car_listing_private.html", "tesla", "model-3")))
+  assert calls == [["gear_type"]]
+  assert item["seller_type"] == "Private seller"
+  assert item["seller_name"] is None
+  assert item["seller_address_2"] is None
+
+  calls.clear()
+  next(spider.parse_car(load_detail_page("car_listing_dealer.html", "kia", "niro")))
+  assert calls == []
+
+# A configuration file that can't be loaded while the spider runs keeps the previous configuration until it's fixed
+def test_refresh_config_keeps_previous_config_on_invalid_file(tmp_path):
+  config_file = tmp_path / "crawl_config.json"
+  variables = load_project_variables(CRAWL_CONFIG_FILE)
+  config_file.write_text(json.dumps({**variables, "MAX_PAGES": 3}))
+  spider = CarListingSpider(config=str(config_file))
+  assert spider.max_pages == 3
+
+  config_file.write_text('{"MAX_PAGES": 5, ') # Partially written
+  os.utime(config_file, (spider.config_mtime + 1, spider.config_mtime + 1))
+  spider.refresh_config()
+  assert spider.max_pages == 3
+  config_file.write_text(json.dumps({"MAX_PAGES": 5})) # Missing variables
+  os.utime(config_file, (spider.config_mtime + 2, spider.config_mtime + 2))
+  spider.refresh_config()
+  assert spider.max_pages == 3
+
+  config_file.write_text(json.dumps({**variables, "MAX_PAGES": 5}))
+  os.utime(config_file, (spider.config_mtime + 3, spider.config_mtime + 3))
+  spider.refresh_config()
+  assert spider.max_pages == 5
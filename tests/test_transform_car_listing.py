@@ -0,0 +1,168 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+import pytest
+from clean_car_listing import apply_column_dtypes, save_checkpoint, read_table, write_table
+import transform_car_listing
+from transform_car_listing import (
+  GEONAMES_CACHE_FILE, TRANSFORMATION_RULES, TRANSFORMED_FILE_PATH, TRANSFORMED_COLUMN_DTYPES, add_geonames_data, apply_transformation_rules,
+  transform_data
+)
+
+FIXTURE_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "cleaned_car_listing.csv")
+NOW = datetime(2025, 3, 15, 12, 0)
+
+def read_fixture():
+  return pd.read_csv(FIXTURE_FILE_PATH, parse_dates=["built_in"])
+
+# The business rules as transform_rows() applied them before the rule table, row by row, with datetime.now() replaced by now
+def apply_legacy_rules(df, now):
+  # Update labels
+  df["body_type"] = df["body_type"].replace("Off-Road/Pick-up", "SUV")
+  df["fuel"] = df["fuel"].replace("Electric/Gasoline", "Hybrid")
+
+  # Update gear_type
+  df["gear_type"] = df.apply(lambda row: "Automatic" if row["fuel"] == "Electric" else row["gear_type"], axis=1)
+
+  # Calculate car age
+  df.drop(df[df["built_in"] > now + timedelta(days=30)].index, inplace=True)
+  df["car_age_in_months"] = df["built_in"].apply(lambda x: max((now.year - x.year) * 12 + now.month - x.month, 0) if pd.notnull(x) else None)
+
+  # Update previous_owners & used_or_new
+  df["previous_owners"] = df.apply(lambda row: 0 if row["used_or_new"] == "New" else row["previous_owners"], axis=1)
+  df.loc[(df["car_age_in_months"] <= 12) & (df["km"] < 1_000), ["previous_owners", "used_or_new"]] = [0, "New"]
+  df["used_or_new"] = df["used_or_new"].apply(lambda x: "Used" if x != "New" else x)
+
+  # Update drive_train
+  df["drive_train"] = np.where(df["description"].str.contains("AWD|4WD", na=False), "4WD", df["drive_train"])
+  df.loc[(df["fuel"] == "Electric") & (df["drive_train"].isin([np.nan, "Front"])), "drive_train"] = "Rear"
+  df.loc[(df["fuel"] != "Electric") & (df["drive_train"].isin([np.nan, "Rear"])), "drive_train"] = "Front"
+
+  # Update full_service_history
+  df["full_service_history"] = df.apply(lambda row: 1 if pd.isnull(row["full_service_history"]) and row["used_or_new"] == "New" else 0, axis=1)
+
+  # Update gear
+  df.loc[df["fuel"] == "Electric", "gears"] = 1
+  df.loc[(df["gears"] == 8) & (df["manufacturer"] != "Volvo"), "gears"] = pd.NA
+  df.loc[(df["gears"] > 8) | (df["gears"].isin([2, 3, 4])), "gears"] = pd.NA
+  df.loc[(df["fuel"] != "Electric") & (~df["manufacturer"].isin(["Toyota", "Lexus"])) & (df["gears"] == 1), "gears"] = pd.NA
+  df.loc[df["car"] == "1", "gears"] = 7
+  df.loc[df["car"] == "3", "gears"] = 6
+  df.loc[df["car"] == "CX-30", "gears"] = 6
+  df.loc[df["car"] == "Formentor", "gears"] = 6
+  df.loc[df["car"] == "HR-V", "gears"] = 6
+  df.loc[df["car"] == "Niro", "gears"] = 6
+  df.loc[df["car"] == "TUCSON", "gears"] = 6
+
+  # Update co2_emission_g_per_km depeding on the fuel
+  df["co2_emission_g_per_km"] = df.apply(lambda row: 0 if row["fuel"] == "Electric" else row["co2_emission_g_per_km"], axis=1)
+  df["co2_emission_g_per_km"] = df.apply(lambda row: None if row["co2_emission_g_per_km"] == 0 and row["fuel"] != "Electric" else row["co2_emission_g_per_km"], axis=1)
+
+  # Calculate years active on the platform
+  df["years_active_on_platform"] = df["active_since"].apply(lambda x: (now.year - x) if pd.notnull(x) else None)
+
+  # Drop irrelevant rows
+  df.drop(df[(df["fuel"] == "Gasoline") & (df["electric_range"] > 0)].index, inplace=True)
+  df.drop(df[(df["fuel"] == "Electric") & (~df["manufacturer"].isin(["Kia", "Tesla", "Volvo"]))].index, inplace=True)
+  df.drop(df[(df["manufacturer"] == "Lynk & Co") & (df["fuel"] != "Hybrid")].index, inplace=True)
+  df.drop(df[(df["car"] == "Niro") & (df["fuel"] != "Hybrid")].index, inplace=True)
+  df.drop(df[(df["manufacturer"] == "Toyota") & (df["fuel"] != "Hybrid")].index, inplace=True)
+  df.drop(df[(df["fuel"] == "Diesel") & (df["car"] != "A3")].index, inplace=True)
+  df.drop(df[df["car"].isin(["UX 300h", "UX 300e"])].index, inplace=True)
+  return df
+
+# Values as comparable Python objects, missing values as None
+def to_records(df):
+  df = df.astype(object)
+  return df.where(df.notna(), None).to_dict("records")
+
+# The rule table gives the same rows and values as the former row-wise rules, for the same "now"
+def test_rule_table_matches_legacy_rules():
+  expected = apply_legacy_rules(read_fixture(), NOW)
+  actual = apply_transformation_rules(apply_column_dtypes(read_fixture()), TRANSFORMATION_RULES, NOW)
+  assert actual.index.tolist() == expected.index.tolist()
+  assert to_records(actual[expected.columns]) == to_records(expected)
+
+# Rows are kept, and still transformed, when scoring
+def test_rule_table_keeps_rows_without_dropping():
+  df = apply_transformation_rules(apply_column_dtypes(read_fixture()), TRANSFORMATION_RULES, NOW, drop_rows=False)
+  assert len(df) == len(read_fixture())
+  assert (df["body_type"] != "Off-Road/Pick-up").all()
+
+# An incremental run without new cleaned rows hands the next stages an empty frame with the transformed columns
+def test_incremental_run_without_new_rows_returns_transformed_columns(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  transformed = apply_column_dtypes(read_fixture().assign(listing_url="https://www.autoscout24.com/offers/a", timestamp=pd.Timestamp(NOW)), TRANSFORMED_COLUMN_DTYPES)
+  write_table(transformed, TRANSFORMED_FILE_PATH)
+  save_checkpoint({"pending_full_transform": False})
+  df = transform_data()
+  assert df.empty
+  saved = read_table(TRANSFORMED_FILE_PATH, column_dtypes=TRANSFORMED_COLUMN_DTYPES)
+  assert df.columns.tolist() == saved.columns.tolist()
+  assert df.dtypes.astype(str).to_dict() == saved.dtypes.astype(str).to_dict()
+
+# A Geonames stub that rate limits the first lookup of a zip code with a 429 and a Retry-After header, then answers it
+class GeonamesStubHandler(BaseHTTPRequestHandler):
+  def do_GET(self):
+    zip_code = parse_qs(urlparse(self.path).query)["postalcode"][0]
+    with self.server.lock:
+      is_retry = zip_code in self.server.rate_limited
+      self.server.rate_limited.add(zip_code)
+      self.server.requests.append((time.monotonic(), zip_code))
+    if not is_retry:
+      self.send_response(429)
+      self.send_header("Retry-After", "1")
+      self.send_header("Content-Length", "0")
+      self.end_headers()
+      return
+    body = json.dumps({"postalcodes": [{"lng": 4.9, "lat": 52.37, "placeName": f"City {zip_code}", "adminName1": "Noord-Holland"}]}).encode()
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+@pytest.fixture
+def geonames_server(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  server = ThreadingHTTPServer(("127.0.0.1", 0), GeonamesStubHandler)
+  server.lock, server.rate_limited, server.requests = threading.Lock(), set(), []
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  monkeypatch.setattr(transform_car_listing, "GEONAMES_URL", f"http://127.0.0.1:{server.server_address[1]}/postalCodeLookupJSON")
+  monkeypatch.setattr(transform_car_listing, "GEONAMES_REQUESTS_PER_SECOND", 10)
+  yield server
+  server.shutdown()
+  server.server_close()
+
+# Lookups answered with a 429 are retried after Retry-After, the first lookups are spaced by the rate limiter and the
+# results are cached, so a second run doesn't call Geonames
+def test_geonames_lookups_are_retried_rate_limited_and_cached(geonames_server):
+  zip_codes = ["1011AB", "1012CD", "1013EF", "1014GH"]
+  df = add_geonames_data(pd.DataFrame({"zip_code": zip_codes + ["1011AB"]}))
+  assert df["city"].tolist() == [f"City {zip_code}" for zip_code in zip_codes + ["1011AB"]]
+
+  requests = geonames_server.requests
+  assert sorted(zip_code for _, zip_code in requests) == sorted(zip_codes * 2)
+  first_requests = {}
+  for requested_at, zip_code in requests:
+    first_requests.setdefault(zip_code, requested_at)
+  retries = {zip_code: requested_at for requested_at, zip_code in requests if requested_at != first_requests[zip_code]}
+  assert all(retries[zip_code] - first_requests[zip_code] >= 0.95 for zip_code in zip_codes) # Retry-After: 1
+  started = sorted(first_requests.values())
+  assert all(later - earlier >= 0.09 for earlier, later in zip(started, started[1:])) # 10 requests per second
+
+  with sqlite3.connect(GEONAMES_CACHE_FILE) as conn:
+    cached = dict(conn.execute("SELECT zip_code, city FROM geonames_cache WHERE found = 1").fetchall())
+  assert cached == {zip_code: f"City {zip_code}" for zip_code in zip_codes}
+  add_geonames_data(pd.DataFrame({"zip_code": zip_codes}))
+  assert len(geonames_server.requests) == len(zip_codes) * 2
@@ -0,0 +1,118 @@
+import os
+from datetime import datetime
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+
+os.environ.setdefault("DATABASE_URL", "sqlite://") # Before the module creates its engine
+import upload_car_listing
+from upload_car_listing import TABLE_NAME, prepare_data, build_table_schema, migrate_table, insert_data
+
+# Transformed rows, as the upload reads them
+def build_listings(rows):
+  df = pd.DataFrame(rows, columns=["listing_url", "price", "built_in", "lat", "timestamp"])
+  return df.astype({"price": "Int32", "built_in": "datetime64[ns]", "lat": "float32", "timestamp": "datetime64[ns]"})
+
+def read_listings(engine):
+  with engine.connect() as conn:
+    return {row[0]: row[1:] for row in conn.execute(text(f"SELECT listing_url, price, timestamp, lat FROM {TABLE_NAME}"))}
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+  engine = create_engine(f"sqlite:///{tmp_path / 'car_listings.db'}")
+  monkeypatch.setattr(upload_car_listing, "engine", engine)
+  return engine
+
+# A PostgreSQL database to run the partitioned table against, in a schema of its own. Set TEST_DATABASE_URL to run these tests
+@pytest.fixture
+def postgres_engine(monkeypatch):
+  database_url = os.getenv("TEST_DATABASE_URL")
+  if not database_url:
+    pytest.skip("TEST_DATABASE_URL is not set")
+  schema = f"test_car_listings_{os.getpid()}"
+  admin_engine = create_engine(database_url)
+  with admin_engine.begin() as conn:
+    conn.execute(text(f"CREATE SCHEMA {schema}"))
+  engine = create_engine(database_url, connect_args={"options": f"-csearch_path={schema}"})
+  monkeypatch.setattr(upload_car_listing, "engine", engine)
+  yield engine
+  engine.dispose()
+  with admin_engine.begin() as conn:
+    conn.execute(text(f"DROP SCHEMA {schema} CASCADE"))
+  admin_engine.dispose()
+
+# Rows of a table created before the migrations: several rows of a listing_url if its UNIQUE constraint was dropped, and a row
+# without timestamp which has no partition
+LEGACY_ROWS = [
+  {"listing_url": "https://www.autoscout24.com/offers/a", "price": 21_000, "timestamp": "2025-01-01 10:00:00"},
+  {"listing_url": "https://www.autoscout24.com/offers/a", "price": 20_000, "timestamp": "2025-02-01 10:00:00"},
+  {"listing_url": "https://www.autoscout24.com/offers/a", "price": 22_000, "timestamp": "2024-12-01 10:00:00"},
+  {"listing_url": "https://www.autoscout24.com/offers/b", "price": 30_000, "timestamp": "2025-01-15 10:00:00"},
+  {"listing_url": "https://www.autoscout24.com/offers/c", "price": 40_000, "timestamp": None}
+]
+
+def create_legacy_table(engine):
+  with engine.begin() as conn:
+    conn.execute(text(f"CREATE TABLE {TABLE_NAME} (id INTEGER PRIMARY KEY, listing_url TEXT, price INTEGER, timestamp TIMESTAMP)"))
+    conn.execute(text(f"INSERT INTO {TABLE_NAME} (id, listing_url, price, timestamp) VALUES (:id, :listing_url, :price, :timestamp)"), [
+      {"id": i, **row} for i, row in enumerate(LEGACY_ROWS)
+    ])
+
+# Rows are copied through the staging table: new listings are inserted, a newer row of a listing replaces the stored one
+# and an older row is skipped
+def test_upload_inserts_updates_and_skips_older_rows(engine, capsys):
+  first = prepare_data(build_listings([
+    ("https://www.autoscout24.com/offers/a", 20_000, "2020-01-01", 52.08, "2025-03-01 10:00:00"),
+    ("https://www.autoscout24.com/offers/b", 30_000, "2021-06-01", 51.44, "2025-03-01 10:00:00")
+  ]))
+  migrate_table(build_table_schema(first))
+  insert_data(first)
+  assert "Inserted 2 and updated 0 rows" in capsys.readouterr().out
+
+  second = prepare_data(build_listings([
+    ("https://www.autoscout24.com/offers/a", 19_000, "2020-01-01", 52.08, "2025-03-08 10:00:00"), # Newer: updated
+    ("https://www.autoscout24.com/offers/b", 35_000, "2021-06-01", 51.44, "2025-02-01 10:00:00"), # Older: skipped
+    ("https://www.autoscout24.com/offers/c", 25_000, "2022-02-01", 53.21, "2025-03-08 10:00:00") # New: inserted
+  ]))
+  migrate_table(build_table_schema(second))
+  insert_data(second)
+  assert "Inserted 1 and updated 1 rows" in capsys.readouterr().out
+  assert read_listings(engine) == {
+    "https://www.autoscout24.com/offers/a": (19_000, "2025-03-08 10:00:00", 52.08),
+    "https://www.autoscout24.com/offers/b": (30_000, "2025-03-01 10:00:00", 51.44),
+    "https://www.autoscout24.com/offers/c": (25_000, "2025-03-08 10:00:00", 53.21)
+  }
+
+# A table created before the migrations keeps only the latest row of each listing_url when it's migrated, the rows without
+# timestamp are counted as skipped
+def test_migration_copies_latest_legacy_row_per_listing(engine, capsys):
+  create_legacy_table(engine)
+  migrate_table(build_table_schema(prepare_data(build_listings([]))))
+  assert "Skipped 1 rows of 'car_listings_legacy' without timestamp" in capsys.readouterr().out
+  assert read_listings(engine) == {
+    "https://www.autoscout24.com/offers/a": (20_000, "2025-02-01 10:00:00", None),
+    "https://www.autoscout24.com/offers/b": (30_000, "2025-01-15 10:00:00", None)
+  }
+
+# On PostgreSQL the legacy rows are copied with DISTINCT ON into the monthly partitions of their timestamp, and the uploads
+# create the partitions of new months
+def test_migration_partitions_legacy_rows_on_postgres(postgres_engine, capsys):
+  create_legacy_table(postgres_engine)
+  migrate_table(build_table_schema(prepare_data(build_listings([]))))
+  assert "Skipped 1 rows of 'car_listings_legacy' without timestamp" in capsys.readouterr().out
+  insert_data(prepare_data(build_listings([("https://www.autoscout24.com/offers/d", 25_000, "2022-02-01", 53.21, "2025-03-08 10:00:00")])))
+  assert read_listings(postgres_engine) == {
+    "https://www.autoscout24.com/offers/a": (20_000, datetime(2025, 2, 1, 10), None),
+    "https://www.autoscout24.com/offers/b": (30_000, datetime(2025, 1, 15, 10), None),
+    "https://www.autoscout24.com/offers/d": (25_000, datetime(2025, 3, 8, 10), 53.21)
+  }
+
+  with postgres_engine.connect() as conn:
+    partition_key = conn.execute(text(f"SELECT pg_get_partkeydef('{TABLE_NAME}'::regclass)")).scalar()
+    partitions = dict(conn.execute(text(f"""
+      SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+      WHERE i.inhparent = '{TABLE_NAME}'::regclass
+    """)).all())
+  assert partition_key.replace('"', "") == "RANGE (timestamp)"
+  assert sorted(partitions) == [f"{TABLE_NAME}_2025_01", f"{TABLE_NAME}_2025_02", f"{TABLE_NAME}_2025_03"]
+  assert partitions[f"{TABLE_NAME}_2025_02"] == "FOR VALUES FROM ('2025-02-01 00:00:00') TO ('2025-03-01 00:00:00')"